@@ -0,0 +1,208 @@
+"""
+#
+#  AssetCache - Read-through local disk cache for files on a network share
+#
+#  PyiCom is usually run from a network drive, so every config, sequence,
+#  EFS and icon read would otherwise go over SMB. fetch() returns a local
+#  copy of a file instead, copying it from the share only when its size or
+#  mtime has changed (or, with checksum = True, when its content has).
+#  A path is checked against the share at most every `revalidate` seconds,
+#  so repeated reads cost a dictionary lookup.
+#
+#  If the share cannot be reached, the last good copy keeps being served.
+#  The manifest of cached files is kept on disk, so this also works after a
+#  restart. prefetch() copies files in the background, e.g. every EFS of a
+#  sequence as soon as it is selected.
+#
+"""
+
+import os
+import json
+import time
+import queue
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('LOCALAPPDATA', tempfile.gettempdir()), "PyiCom", "cache")
+MANIFEST = "manifest.json"
+
+
+class AssetCache:
+
+    def __init__(self, cacheDir = DEFAULT_CACHE_DIR, revalidate = 2.0, checksum = False):
+        self.cacheDir = cacheDir
+        self.revalidate = revalidate    # Seconds between checks of one path against the share
+        self.checksum = checksum        # Compare content rather than size/mtime
+        self._lock = threading.RLock()
+        self._entries = {}              # source path -> {'local', 'size', 'mtime', 'sha1'}
+        self._checked = {}              # source path -> time of the last check
+        self._offline = set()           # Paths currently served from cache because the share is down
+        self._prefetch = queue.Queue()
+        self._worker = None
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        self._load()
+
+    # --- Manifest ---
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.cacheDir, MANIFEST)) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        self._entries = dict((path, e) for path, e in entries.items() if os.path.isfile(e['local']))
+
+    def _save(self):
+        path = os.path.join(self.cacheDir, MANIFEST)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, path)
+
+    # --- Lookup ---
+
+    def _signature(self, entry):
+        # What callers compare to see if the content changed.
+        if entry is None:
+            return None
+        return entry['sha1'] if self.checksum else (entry['size'], entry['mtime'])
+
+    def fetch(self, path):
+        # Returns (local path, signature), or (None, None) if the file does not
+        # exist and was never cached. The signature changes when the content does.
+        src = os.path.abspath(path)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(src)
+            if entry is not None and now - self._checked.get(src, 0) < self.revalidate:
+                return entry['local'], self._signature(entry)
+            self._checked[src] = now
+        # Checked and copied outside the lock so a slow share never blocks other lookups
+        entry = self._validate(src, entry)
+        if entry is None:
+            return None, None
+        return entry['local'], self._signature(entry)
+
+    def localPath(self, path):
+        return self.fetch(path)[0]
+
+    def signature(self, path):
+        return self.fetch(path)[1]
+
+    def _validate(self, src, entry):
+        try:
+            st = os.stat(src)
+        except OSError:
+            if entry is not None and not os.path.isdir(os.path.dirname(src)):
+                # The share is unreachable rather than the file deleted - keep serving the copy
+                with self._lock:
+                    if src not in self._offline:
+                        self._offline.add(src)
+                        logging.info("WARNING: %s is unavailable, using the cached copy." % src)
+                return entry
+            self._drop(src)
+            return None
+        with self._lock:
+            if src in self._offline:
+                self._offline.discard(src)
+                logging.info("%s is available again." % src)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry
+        try:
+            return self._copy(src, st, entry)
+        except (IOError, OSError) as e:
+            logging.info("ERROR: Unable to cache %s - %s" % (src, e))
+            return entry
+
+    def _copy(self, src, st, entry):
+        local = entry['local'] if entry else os.path.join(
+            self.cacheDir, hashlib.sha1(src.encode('utf-8')).hexdigest()[:16] + "-" + os.path.basename(src))
+        fd, tmp = tempfile.mkstemp(dir = self.cacheDir)
+        sha = hashlib.sha1()
+        try:
+            with open(src, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+                for block in iter(lambda: fin.read(65536), b""):
+                    sha.update(block)
+                    fout.write(block)
+            digest = sha.hexdigest()
+            if entry is not None and self.checksum and entry['sha1'] == digest:
+                os.remove(tmp)          # Touched, not changed
+            else:
+                os.replace(tmp, local)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        entry = {'local': local, 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest}
+        with self._lock:
+            self._entries[src] = entry
+            self._save()
+        return entry
+
+    def _drop(self, src):
+        with self._lock:
+            entry = self._entries.pop(src, None)
+            if entry is not None:
+                try:
+                    os.remove(entry['local'])
+                except OSError:
+                    pass
+                self._save()
+
+    # --- Background prefetch ---
+
+    def prefetch(self, paths):
+        # Copy files to the cache on a background thread.
+        for path in paths:
+            self._prefetch.put(path)
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target = self._prefetchWorker, name = "AssetPrefetch")
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _prefetchWorker(self):
+        while True:
+            path = self._prefetch.get()
+            if path is None:
+                return
+            try:
+                self.fetch(path)
+            except Exception as e:
+                logging.info("ERROR: Unable to prefetch %s - %s" % (path, e))
+
+    def clear(self):
+        with self._lock:
+            for src in list(self._entries):
+                self._drop(src)
+            self._checked.clear()
+
+
+if __name__ == "__main__":
+    # Local vs share read latency for the files given, e.g. every EFS on the share.
+    import sys
+    cache = AssetCache(tempfile.mkdtemp())
+    paths = sys.argv[1:]
+    start = time.time()
+    for p in paths:
+        with open(p, 'rb') as f:
+            f.read()
+    direct = time.time() - start
+    cache.revalidate = 0
+    start = time.time()
+    for p in paths:
+        cache.fetch(p)
+    first = time.time() - start
+    cache.revalidate = 2.0
+    start = time.time()
+    for p in paths:
+        with open(cache.localPath(p), 'rb') as f:
+            f.read()
+    cached = time.time() - start
+    print("%s files: direct %.1f ms, first fetch %.1f ms, cached %.1f ms"
+          % (len(paths), direct * 1000, first * 1000, cached * 1000))
+    shutil.rmtree(cache.cacheDir)
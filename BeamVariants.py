@@ -0,0 +1,101 @@
+"""
+#
+#  BeamVariants - Per-linac personalised tag records for each beam
+#
+#  Before a beam can be sent, its EFS records have to be personalised for
+#  the connected linac: the machine name tag, the MU/dose rate overrides and
+#  the patient name/ID overrides, where the QA patient gets the linac's site
+#  suffix. BeamVariants does this once per beam and linac, when the FX link
+#  connects or the first time a field is sent, and caches the result (with
+#  the elided records as well, if enabled). Sending a repeat is then a cache
+#  lookup with no string work at all.
+#
+#  The cache is keyed by (linac, beam), so variants for different linacs
+#  never mix.
+#
+"""
+
+import threading
+import collections
+from SequenceLibrary import parseEFS, elideRecords
+from iCOMTags import TAG_MU, TAG_DOSE_RATE, TAG_MACHINE, TAG_PATIENT_ID, TAG_PATIENT_NAME
+
+QA_PATIENT = "1QASNC"           # Overridden patient name/ID that gets the linac's site appended
+
+# records are the personalised (tag, cp, value) records. elided is the same
+# with unchanged control point tags left out, or None if elision is off or
+# saves nothing.
+BeamVariant = collections.namedtuple("BeamVariant", ["linac", "records", "elided"])
+
+
+def _patient(value, site):
+    value = str(value)
+    return value + site if value == QA_PATIENT else value
+
+
+def makeVariant(records, linac, site = "", mu = None, dr = None, ptid = None, ptname = None, elide = False):
+    # Personalise records for one linac. site is the linac's entry in linacMap.
+    subs = {TAG_MACHINE: linac}
+    if ptname is not None:
+        subs[TAG_PATIENT_NAME] = _patient(ptname, site)
+    if ptid is not None:
+        subs[TAG_PATIENT_ID] = _patient(ptid, site)
+    if dr is not None:
+        subs[TAG_DOSE_RATE] = str(dr)
+    if mu is not None:
+        subs[TAG_MU] = str(mu)
+    records = tuple((tag, cp, subs[tag] if tag in subs else val) for tag, cp, val in records)
+    elided = None
+    if elide:
+        elided = elideRecords(records)
+        if len(elided) == len(records):
+            elided = None
+    return BeamVariant(linac, records, elided)
+
+
+class BeamVariants:
+
+    def __init__(self, siteMap = None, elide = False, maxEntries = 512):
+        self.siteMap = siteMap or {}    # linac name -> site suffix
+        self.elide = elide
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()     # (linac, id(BeamPlan)) -> (BeamPlan, BeamVariant)
+
+    def get(self, fld, linac):
+        # BeamVariant for a BeamPlan on a linac, or None if it is not an EFS field.
+        key = (linac, id(fld))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] is fld:
+                self._cache.move_to_end(key)
+                return entry[1]
+        if fld.filename.split(".")[-1].lower() != "efs":
+            return None
+        records = fld.tags if fld.tags is not None else parseEFS(fld.filename)
+        variant = makeVariant(records, linac, self.siteMap.get(linac, ""),
+                              fld.mu, fld.dr, fld.ptid, fld.ptname, self.elide)
+        with self._lock:
+            self._cache[key] = (fld, variant)
+            while len(self._cache) > self.maxEntries:
+                self._cache.popitem(last = False)
+        return variant
+
+    def prepare(self, fields, linac):
+        # Build the variants of every distinct beam in fields. Returns how many were built.
+        built = 0
+        seen = set()
+        for fld in fields:
+            if id(fld) in seen:
+                continue
+            seen.add(id(fld))
+            with self._lock:
+                entry = self._cache.get((linac, id(fld)))
+                cached = entry is not None and entry[0] is fld
+            if not cached and self.get(fld, linac) is not None:
+                built += 1
+        return built
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
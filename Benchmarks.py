@@ -0,0 +1,391 @@
+"""
+#
+#  Benchmarks - Performance benchmarks and regression gate for PyiCom
+#
+#  Times the paths a QA session spends its time in, against the simulated
+#  linac in iCOMBridge.StubBackend, so it runs on any PC without the DLL
+#  or a linac:
+#
+#      loadefs.*    Beam.loadEFS on the shipped sequences/ files and on
+#                   synthetic VMAT EFS files of growing size
+#      dcm2efs.*    convert_dcm2efs on synthetic RTPLANs of growing size
+#      delivery.*   a sequence delivered by FxThread/VxThread: the dead time
+#                   from one field terminating to the next being sent
+#      vx.*         VX messages VxThread processes per second
+#      logqa.*      LogQA comparing a recorded VMAT delivery with its plan
+#
+#  run writes the median of each metric over --repeats runs to JSON.
+#  compare checks one results file against a baseline and exits with 1 if
+#  any metric got worse by more than the threshold (20% by default):
+#
+#      python Benchmarks.py run --out baseline.json
+#      python Benchmarks.py run --out current.json
+#      python Benchmarks.py compare baseline.json current.json
+#
+#  The delivery dead time includes the 0.5 s waitForState sleeps between
+#  VX state polls, so it shows up here before it shows up at the linac.
+#
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 0.20            # Relative change that counts as a regression
+VMAT_CONTROL_POINTS = (91, 181, 361)
+DCM_CONTROL_POINTS = (10, 50, 100, 180, 360)
+DELIVERY_FIELDS = 4
+STATE_TIME = 0.02                   # Seconds the simulated linac spends in each delivery state
+BEAM_TIME_SCALE = 0.02              # Simulated beam on time, as a fraction of real time
+VX_SECONDS = 1.0
+LOGQA_SAMPLES = 5000                # VX messages recorded during the arc
+GROUPS = ("loadefs", "dcm2efs", "delivery", "vx", "logqa")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def metric(value, unit, better = "lower"):
+    return {'value': round(value, 4), 'unit': unit, 'better': better}
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def timeMs(fn, repeats):
+    # Median wall time of fn() in ms.
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return median(times)
+
+
+def makeRTPlan(path, controlPoints, beams = 1):
+    # Write a synthetic VMAT RTPLAN: full arcs with a moving MLC, controlPoints per beam.
+    import pydicom
+    from pydicom.dataset import Dataset, FileDataset
+    from pydicom.sequence import Sequence
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+    try:
+        from pydicom.dataset import FileMetaDataset     # pydicom 2.0+
+    except ImportError:
+        FileMetaDataset = Dataset                       # pydicom 1.x, as pinned in requirements.txt
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.5"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta = meta, preamble = b"\0" * 128)
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "RTPLAN"
+    ds.PatientID = "1QASNC"
+    ds.PatientName = "Benchmark^VMAT"
+    ds.RTPlanLabel = "BENCH%s" % controlPoints
+    references = []
+    beamSeq = []
+    for number in range(1, beams + 1):
+        ref = Dataset()
+        ref.ReferencedBeamNumber = number
+        ref.BeamMeterset = 250.0
+        references.append(ref)
+        beam = Dataset()
+        beam.BeamNumber = number
+        beam.BeamName = "Arc%s" % number
+        beam.BeamDescription = "Arc %s" % number
+        beam.TreatmentMachineName = "BENCH"
+        cps = []
+        for i in range(controlPoints):
+            f = i / (controlPoints - 1.0)
+            cp = Dataset()
+            cp.ControlPointIndex = i
+            cp.GantryAngle = (180.1 + f * 359.8) % 360
+            cp.GantryRotationDirection = "CW"
+            cp.BeamLimitingDeviceAngle = 0
+            cp.NominalBeamEnergy = 6
+            cp.CumulativeMetersetWeight = f
+            x = Dataset()
+            x.RTBeamLimitingDeviceType = "X"
+            x.LeafJawPositions = [-200.0, 200.0]
+            y = Dataset()
+            y.RTBeamLimitingDeviceType = "ASYMY"
+            y.LeafJawPositions = [-50.0, 50.0]
+            mlc = Dataset()
+            mlc.RTBeamLimitingDeviceType = "MLCX"
+            mlc.LeafJawPositions = ([round(-20 - 10 * math.sin(f * 6 + l / 10.0), 1) for l in range(80)] +
+                                    [round(20 + 10 * math.sin(f * 5 + l / 7.0), 1) for l in range(80)])
+            cp.BeamLimitingDevicePositionSequence = Sequence([x, y, mlc])
+            cps.append(cp)
+        beam.ControlPointSequence = Sequence(cps)
+        beamSeq.append(beam)
+    group = Dataset()
+    group.ReferencedBeamSequence = Sequence(references)
+    ds.FractionGroupSequence = Sequence([group])
+    ds.BeamSequence = Sequence(beamSeq)
+    try:
+        ds.save_as(path, enforce_file_format = True)
+    except TypeError:
+        # pydicom < 3 writes with the dataset's own encoding, not the transfer syntax
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(path, write_like_original = False)
+    return path
+
+
+def shippedEFS():
+    paths = []
+    for root, dirs, files in os.walk(os.path.join(HERE, "sequences")):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(".efs"))
+    return sorted(paths)
+
+
+class Runner:
+
+    def __init__(self, repeats = DEFAULT_REPEATS):
+        self.repeats = repeats
+        self.workDir = tempfile.mkdtemp(prefix = "pyicom-bench-")
+        self.metrics = {}
+        self._plans = {}
+        os.chdir(HERE)                  # PyiCom reads config.txt etc. from the working directory
+        # Never open the real session journal - PyiCom opens it on import
+        os.environ["PYICOM_JOURNAL"] = os.path.join(self.workDir, "session.journal")
+        import PyiCom
+        import iCOMBridge
+        import DCM2EFS
+        self.app = PyiCom
+        self.stubBackend = iCOMBridge.StubBackend
+        self.converter = DCM2EFS
+        self.app.iCOM = self.stubBackend()
+        logging.disable(logging.CRITICAL)       # Per-field logging would be timed too
+
+    def close(self):
+        logging.disable(logging.NOTSET)
+        self.app.sessionJournal.close()
+        shutil.rmtree(self.workDir, ignore_errors = True)
+
+    def add(self, name, value, unit, better = "lower"):
+        self.metrics[name] = metric(value, unit, better)
+        print("  %-28s %10.3f %s" % (name, value, unit))
+
+    def plan(self, controlPoints):
+        # Synthetic RTPLAN and its EFS, made once per size.
+        if controlPoints not in self._plans:
+            outDir = os.path.join(self.workDir, "vmat%s" % controlPoints)
+            os.makedirs(outDir)
+            dcm = makeRTPlan(os.path.join(outDir, "plan.dcm"), controlPoints)
+            self._plans[controlPoints] = (dcm, self.convert(dcm, outDir)[0])
+        return self._plans[controlPoints]
+
+    def convert(self, dcm, outDir):
+        efs = self.converter.convert_dcm2efs(dcm, outDir)
+        if not efs:
+            raise RuntimeError("convert_dcm2efs failed on %s" % dcm)
+        return efs
+
+    def loadBeam(self, handle, path):
+        beam = self.app.Beam(handle, path)
+        self.app.iCOM.deleteMessage(beam.fxMsg)
+
+    # --- Benchmarks ---
+
+    def loadefs(self):
+        iCOM = self.app.iCOM = self.stubBackend()
+        handle = iCOM.fxConnect("127.0.0.1", 1000, "BENCH")
+        shipped = shippedEFS()
+        if shipped:
+            times = [timeMs(lambda: self.loadBeam(handle, path), self.repeats) for path in shipped]
+            self.add("loadefs.shipped_mean_ms", sum(times) / len(times), "ms")
+        for cps in VMAT_CONTROL_POINTS:
+            efs = self.plan(cps)[1]
+            self.add("loadefs.vmat_%scp_ms" % cps, timeMs(lambda: self.loadBeam(handle, efs), self.repeats), "ms")
+        iCOM.disconnect(handle)
+
+    def dcm2efs(self):
+        out = os.path.join(self.workDir, "convert")
+        os.makedirs(out)
+        for cps in DCM_CONTROL_POINTS:
+            dcm = self.plan(cps)[0]
+            self.add("dcm2efs.%scp_ms" % cps,
+                     timeMs(lambda: self.convert(dcm, out), self.repeats), "ms")
+
+    def delivery(self):
+        import EventBus
+        from FieldQueue import FieldSweep
+        from SequenceLibrary import compileBeam
+        app = self.app
+        shipped = shippedEFS()
+        if not shipped:
+            return
+        beam = compileBeam({'name': "Bench", 'filename': shipped[0], 'mu': 10, 'dr': 600})
+        deadTimes = []
+        fieldTimes = []
+        for i in range(self.repeats):
+            # Each state lasts well over a VX message interval so none is missed
+            app.iCOM = self.stubBackend(stepTime = STATE_TIME, beamTimeScale = BEAM_TIME_SCALE,
+                                        messageInterval = 0.001)
+            app.statesQueue[:] = []
+            app.fldQueue.clear()
+            app.fldQueue.extend(FieldSweep(((beam, DELIVERY_FIELDS),)))
+            sub = app.eventBus.subscribe(types = [EventBus.MESSAGE_SENT, EventBus.FIELD_TERMINATED,
+                                                  EventBus.SEQUENCE_DONE], name = "benchmark")
+            vx = app.vxThread = app.VxThread("127.0.0.1")
+            fx = app.fxThread = app.FxThread("127.0.0.1", "BENCH")
+            fx.showPlaylist = False
+            vx.start()
+            fx.start()
+            fx.startPlaying()
+            sent = []
+            terminated = []
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                event = sub.get(timeout = 1.0)
+                if event is None:
+                    continue
+                if event.type == EventBus.SEQUENCE_DONE:
+                    break
+                (sent if event.type == EventBus.MESSAGE_SENT else terminated).append(event.time)
+            sub.unsubscribe()
+            fx.stop()
+            vx.stop()
+            fx.join(5)
+            vx.join(5)
+            if len(sent) != DELIVERY_FIELDS or len(terminated) != DELIVERY_FIELDS:
+                raise RuntimeError("Delivery did not complete: %s sent, %s terminated" % (len(sent), len(terminated)))
+            deadTimes.extend((sent[k + 1] - terminated[k]) * 1000 for k in range(DELIVERY_FIELDS - 1))
+            fieldTimes.append((terminated[-1] - sent[0]) * 1000 / DELIVERY_FIELDS)
+        app.fldQueue.clear()
+        self.add("delivery.dead_time_ms", median(deadTimes), "ms")
+        self.add("delivery.field_ms", median(fieldTimes), "ms")
+
+    def vx(self):
+        app = self.app
+        rates = []
+        for i in range(max(1, self.repeats // 2)):
+            stub = app.iCOM = self.stubBackend(messageInterval = 0.0)
+            vx = app.VxThread("127.0.0.1")
+            vx.start()
+            time.sleep(0.1)             # Let it connect
+            start, count = time.perf_counter(), stub.vxMessages
+            time.sleep(VX_SECONDS)
+            rates.append((stub.vxMessages - count) / (time.perf_counter() - start))
+            vx.stop()
+            vx.join(5)
+        app.statesQueue[:] = []
+        self.add("vx.messages_per_s", median(rates), "msg/s", better = "higher")
+
+    def logqa(self):
+        import LogQA
+        for cps in VMAT_CONTROL_POINTS:
+            records = LogQA.syntheticArc(cps)
+            samples = LogQA.syntheticSamples(LogQA.plannedTrajectory(records), LOGQA_SAMPLES)
+            self.add("logqa.vmat_%scp_ms" % cps,
+                     timeMs(lambda: LogQA.compare(LogQA.plannedTrajectory(records), samples), self.repeats), "ms")
+
+    def run(self, groups = GROUPS):
+        for group in groups:
+            print(group)
+            getattr(self, group)()
+        return self.metrics
+
+
+def results(metrics, repeats):
+    return {'meta': {'created': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'repeats': repeats},
+            'metrics': metrics}
+
+
+def compare(baseline, current, threshold = DEFAULT_THRESHOLD):
+    # Returns (lines, regressions). A metric missing from current is a regression.
+    lines = []
+    regressions = []
+    for name in sorted(baseline['metrics']):
+        base = baseline['metrics'][name]
+        cur = current['metrics'].get(name)
+        if cur is None:
+            regressions.append(name)
+            lines.append("%-28s %10.3f -> %10s            MISSING" % (name, base['value'], "-"))
+            continue
+        if base['value'] == 0:
+            change = 0.0
+        else:
+            change = (cur['value'] - base['value']) / float(base['value'])
+        worse = change if base.get('better', "lower") == "lower" else -change
+        if worse > threshold:
+            regressions.append(name)
+            verdict = "REGRESSED"
+        elif worse < -threshold:
+            verdict = "improved"
+        else:
+            verdict = "ok"
+        lines.append("%-28s %10.3f -> %10.3f %-6s %+6.1f%%  %s"
+                     % (name, base['value'], cur['value'], base['unit'], change * 100, verdict))
+    for name in sorted(set(current['metrics']) - set(baseline['metrics'])):
+        lines.append("%-28s %10s -> %10.3f %-6s          new" % (name, "-", current['metrics'][name]['value'],
+                                                                current['metrics'][name]['unit']))
+    return lines, regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "PyiCom performance benchmarks.")
+    sub = parser.add_subparsers(dest = "action")
+    runParser = sub.add_parser("run", help = "Run the benchmarks and write the results to JSON")
+    runParser.add_argument("--out", default = "benchmarks.json")
+    runParser.add_argument("--repeats", type = int, default = DEFAULT_REPEATS)
+    runParser.add_argument("--only", help = "Comma separated groups: %s" % ",".join(GROUPS))
+    cmpParser = sub.add_parser("compare", help = "Compare results to a baseline, exit 1 on a regression")
+    cmpParser.add_argument("baseline")
+    cmpParser.add_argument("current")
+    cmpParser.add_argument("--threshold", type = float, default = DEFAULT_THRESHOLD,
+                           help = "Relative change that fails, default %s" % DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.action == "run":
+        groups = args.only.split(",") if args.only else GROUPS
+        unknown = set(groups) - set(GROUPS)
+        if unknown:
+            parser.error("Unknown groups: %s" % ", ".join(sorted(unknown)))
+        out = os.path.abspath(args.out)
+        runner = Runner(args.repeats)
+        try:
+            metrics = runner.run(groups)
+        finally:
+            runner.close()
+        with open(out, 'w') as f:
+            json.dump(results(metrics, args.repeats), f, indent = 2, sort_keys = True)
+        print("Results written to %s" % out)
+        return 0
+    elif args.action == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        lines, regressions = compare(baseline, current, args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            print("%s regression(s) over %.0f%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+            return 1
+        print("No regressions over %.0f%%" % (args.threshold * 100))
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""
+#
+#  ControlServer - Local HTTP control API for automated QA sessions
+#
+#  Lets other software on the same PC (a QA database, electrometer software)
+#  drive PyiCom without anyone clicking between fields. The server listens
+#  on loopback only and speaks JSON:
+#
+#      GET  /status      connection, playing, current field and linac state
+#      GET  /queue       the queued fields as (field, count) runs, with progress
+#      GET  /sequences   the sequences that can be submitted
+#      POST /submit      queue sequences, files and/or fields in one call
+#      POST /command     play, pause, stop, next, prev, repeat or restart
+#      GET  /events      stream of events, one JSON object per line
+#
+#  A /submit is checked as a whole before anything is queued, so a bad
+#  entry never leaves half a batch on the queue. /events keeps the
+#  connection open and writes every EventBus event (state transitions,
+#  field starts, ...) as it happens, so a client does not need to poll.
+#  Each stream is a bounded bus subscription: a client that stops reading
+#  loses events (reported in the next event's 'dropped' count) rather than
+#  holding up the linac.
+#
+#  The requests are handled by a controller object, see RemoteControl in
+#  PyiCom. The server will not start without a token, and every request
+#  must send it in the X-PyiCom-Token header. Since the API can start a
+#  beam, requests a web browser could make on a page's behalf are refused
+#  as well: any request with an Origin header or a Host other than
+#  127.0.0.1/localhost, and any POST whose Content-Type is not
+#  application/json.
+#
+"""
+
+import hmac
+import json
+import time
+import socket
+import logging
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from EventBus import eventToDict
+
+DEFAULT_PORT = 8765
+TOKEN_HEADER = "X-PyiCom-Token"
+STREAM_QUEUE_SIZE = 256         # Events buffered per /events client
+HEARTBEAT_INTERVAL = 10.0       # Seconds between keep-alive lines on an idle stream
+MAX_BODY = 1024 * 1024
+LOCAL_HOSTS = ("127.0.0.1", "localhost")
+
+
+class RequestError(Exception):
+    # Raised by a controller to answer with an HTTP error status.
+    def __init__(self, message, status = 400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+
+    server_version = "PyiCom"
+
+    def log_message(self, format, *args):
+        pass                    # Requests are logged by the controller, not to stderr
+
+    def _authorised(self):
+        if self.headers.get("Origin") is not None:
+            self._reply(403, {'error': "Cross-origin requests are not accepted"})
+            return False
+        host = (self.headers.get("Host") or "").rsplit(":", 1)[0].lower()
+        if host not in LOCAL_HOSTS:
+            self._reply(403, {'error': "Host must be 127.0.0.1 or localhost"})
+            return False
+        # Constant time, so response timing does not leak how much of a guess matched
+        given = (self.headers.get(TOKEN_HEADER) or "").encode('utf-8')
+        if not hmac.compare_digest(given, self.server.control.token.encode('utf-8')):
+            self._reply(403, {'error': "Invalid or missing token"})
+            return False
+        return True
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, call, *args):
+        try:
+            self._reply(200, call(*args))
+        except RequestError as e:
+            self._reply(e.status, {'error': str(e)})
+        except Exception as e:
+            logging.info("ERROR: Control request %s failed - %s" % (self.path, e))
+            self._reply(500, {'error': str(e)})
+
+    def do_GET(self):
+        if not self._authorised():
+            return
+        controller = self.server.control.controller
+        path = self.path.split("?")[0]
+        if path == "/status":
+            self._dispatch(controller.status)
+        elif path == "/queue":
+            self._dispatch(controller.queue)
+        elif path == "/sequences":
+            self._dispatch(controller.sequences)
+        elif path == "/events":
+            self._stream()
+        else:
+            self._reply(404, {'error': "Unknown resource %s" % path})
+
+    def do_POST(self):
+        if not self._authorised():
+            return
+        controller = self.server.control.controller
+        path = self.path.split("?")[0]
+        contentType = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if contentType != "application/json":
+            self._reply(415, {'error': "Content-Type must be application/json"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            self._reply(413, {'error': "Request too large"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8') or "{}")
+        except ValueError:
+            self._reply(400, {'error': "Body is not valid JSON"})
+            return
+        if not isinstance(request, dict):
+            self._reply(400, {'error': "Body must be a JSON object"})
+        elif path == "/submit":
+            self._dispatch(controller.submit, request)
+        elif path == "/command":
+            self._dispatch(controller.command, request.get('command'))
+        else:
+            self._reply(404, {'error': "Unknown resource %s" % path})
+
+    def _stream(self):
+        # Newline-delimited JSON until the client disconnects or the server stops.
+        sub = self.server.control.bus.subscribe(maxQueued = STREAM_QUEUE_SIZE, name = "control-stream")
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self._writeEvent(self.server.control.controller.status(), "status")
+            while not self.server.control.stopping.is_set():
+                event = sub.get(timeout = HEARTBEAT_INTERVAL)
+                if event is not None:
+                    data = eventToDict(event)
+                else:
+                    data = {'event': "heartbeat", 't': round(time.time(), 3)}
+                if sub.dropped:
+                    data = dict(data, dropped = sub.dropped)
+                    sub.dropped = 0
+                self._writeEvent(data)
+        except (IOError, OSError):
+            pass                # Client went away
+        finally:
+            sub.unsubscribe()
+
+    def _writeEvent(self, data, event = None):
+        if event is not None:
+            data = dict(data, event = event, t = round(time.time(), 3))
+        self.wfile.write(json.dumps(data).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+
+class ControlServer:
+
+    def __init__(self, controller, bus, port = DEFAULT_PORT, token = None, host = "127.0.0.1"):
+        if not token:
+            raise ValueError("No token set - the control API needs one")
+        self.controller = controller
+        self.bus = bus                  # EventBus whose events /events streams
+        self.token = str(token)
+        self.stopping = threading.Event()
+        self._server = _ThreadedHTTPServer((host, port), _ControlHandler)
+        self._server.control = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, name = "ControlServer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    # Submit from the command line, e.g.
+    #   python ControlServer.py submit --token secret --sequence photonop --file field.efs
+    #   python ControlServer.py status | queue | events | command next --token secret
+    import sys
+    import argparse
+    try:
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+    except ImportError:
+        sys.exit("Python 3 required")
+
+    parser = argparse.ArgumentParser(description = "Talk to a running PyiCom.")
+    parser.add_argument("action", choices = ["status", "queue", "sequences", "submit", "command", "events"])
+    parser.add_argument("command", nargs = "?", help = "Command for 'command' (play, pause, stop, next, ...)")
+    parser.add_argument("--sequence", action = "append", default = [], help = "Sequence key or name to submit")
+    parser.add_argument("--file", action = "append", default = [], help = "EFS or DICOM file to submit")
+    parser.add_argument("--clear", action = "store_true", help = "Replace the current queue")
+    parser.add_argument("--optimise", action = "store_true", help = "Optimise delivery order of submitted sequences")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT)
+    parser.add_argument("--token", required = True, help = "The token in the [control] section of config.txt")
+    args = parser.parse_args()
+
+    url = "http://127.0.0.1:%s/" % args.port
+    headers = {TOKEN_HEADER: args.token, "Content-Type": "application/json"}
+    body = None
+    if args.action == "submit":
+        body = {'sequences': args.sequence, 'files': args.file, 'clear': args.clear, 'optimise': args.optimise}
+    elif args.action == "command":
+        body = {'command': args.command}
+    request = Request(url + args.action, headers = headers,
+                      data = json.dumps(body).encode('utf-8') if body is not None else None)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        sys.exit(e.read().decode('utf-8'))
+    if args.action == "events":
+        for line in response:
+            print(line.decode('utf-8').rstrip())
+    else:
+        print(json.dumps(json.loads(response.read().decode('utf-8')), indent = 2))
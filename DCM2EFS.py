@@ -1,13 +1,45 @@
 from http.client import EXPECTATION_FAILED
 import pydicom
 import os
+import collections
+import iCOMTags
 import tkinter as tk
 from tkinter import filedialog
 
+# Tolerances for downsample_control_points. A VMAT control point is dropped
+# when interpolating between the kept control points either side of it
+# reproduces it within all of these.
+DEFAULT_TOLERANCES = {
+    'mlc': 0.5,         # mm, worst leaf
+    'jaw': 0.5,         # mm, worst jaw
+    'gantry': 1.0,      # degrees
+    'meterset': 0.5,    # % of the final cumulative meterset weight
+}
+
+# Axis positions of one control point, as used for downsampling. Gantry is
+# unwrapped (continuous through 0/360) so arcs interpolate correctly.
+ControlPoint = collections.namedtuple("ControlPoint", ["gantry", "rotation", "jaws", "mlc", "meterset"])
+
+# Result of downsampling one beam. max_error has the keys of DEFAULT_TOLERANCES.
+DownsampleReport = collections.namedtuple("DownsampleReport", ["beam", "cp_before", "cp_after", "max_error"])
+
+# RTBeamLimitingDeviceType of the Y jaws and the MLC, in order of preference.
+# The X jaws are always written fully open.
+Y_JAW_DEVICES = ('ASYMY', 'Y')
+MLC_DEVICES = ('MLCX',)
+
+# One beam of a PlanModel. devices has the (Y jaw, MLC) index in each control
+# point's BeamLimitingDevicePositionSequence, None for a device it leaves out.
+# first_y is the Y jaws of control point 0, for control points without them.
+# final_weight is the beam's FinalCumulativeMetersetWeight, which DICOM lets
+# be any scale; control point weights are divided by it for the EFS.
+BeamModel = collections.namedtuple("BeamModel", ["beam", "number", "meterset", "energy", "machine", "devices", "first_y",
+                                                 "final_weight"])
+
 
 def create_efs(efs_file_path):
     # Specify the file name with the .efs extension
-    file_name = 'efs_file_path'
+    file_name = efs_file_path
 
     with open(file_name, 'w') as file:
     # Writing an empty string to create an empty file
@@ -16,217 +48,29 @@ def create_efs(efs_file_path):
 
 
 def MLCX1_Lookup(leave):
-    MLC_code = {
-        '1': '101',
-        '2': '102',
-        '3': '103',
-        '4': '104',
-        '5': '105',
-        '6': '106',
-        '7': '107',
-        '8': '108',
-        '9': '109',
-        '10': '10a',
-        '11': '10b',
-        '12': '10c',
-        '13': '10d',
-        '14': '10e',
-        '15': '10f',
-        '16': '110',
-        '17': '111',
-        '18': '112',
-        '19': '113',
-        '20': '114',
-        '21': '115',
-        '22': '116',
-        '23': '117',
-        '24': '118',
-        '25': '119',
-        '26': '11a',
-        '27': '11b',
-        '28': '11c',
-        '29': '11d',
-        '30': '11e',
-        '31': '11f',
-        '32': '120',
-        '33': '121',
-        '34': '122',
-        '35': '123',
-        '36': '124',
-        '37': '125',
-        '38': '126',
-        '39': '127',
-        '40': '128',
-        '41': '129',
-        '42': '12a',
-        '43': '12b',
-        '44': '12c',
-        '45': '12d',
-        '46': '12e',
-        '47': '12f',
-        '48': '130',
-        '49': '131',
-        '50': '132',
-        '51': '133',
-        '52': '134',
-        '53': '135',
-        '54': '136',
-        '55': '137',
-        '56': '138',
-        '57': '139',
-        '58': '13a',
-        '59': '13b',
-        '60': '13c',
-        '61': '13d',
-        '62': '13e',
-        '63': '13f',
-        '64': '140',
-        '65': '141',
-        '66': '142',
-        '67': '143',
-        '68': '144',
-        '69': '145',
-        '70': '146',
-        '71': '147',
-        '72': '148',
-        '73': '149',
-        '74': '14a',
-        '75': '14b',
-        '76': '14c',
-        '77': '14d',
-        '78': '14e',
-        '79': '14f',
-        '80': '150',
-    }
-    return MLC_code[leave]
+    # EFS element of MLCX1 leaf '1'..'80', e.g. '101'
+    return "%x" % (iCOMTags.leafTag(1, int(leave)) & 0xffff)
+
 
 def MLCX2_Lookup(leave):
-    MLC_code = {
-        '1': '201',
-        '2': '202',
-        '3': '203',
-        '4': '204',
-        '5': '205',
-        '6': '206',
-        '7': '207',
-        '8': '208',
-        '9': '209',
-        '10': '20a',
-        '11': '20b',
-        '12': '20c',
-        '13': '20d',
-        '14': '20e',
-        '15': '20f',
-        '16': '210',
-        '17': '211',
-        '18': '212',
-        '19': '213',
-        '20': '214',
-        '21': '215',
-        '22': '216',
-        '23': '217',
-        '24': '218',
-        '25': '219',
-        '26': '21a',
-        '27': '21b',
-        '28': '21c',
-        '29': '21d',
-        '30': '21e',
-        '31': '21f',
-        '32': '220',
-        '33': '221',
-        '34': '222',
-        '35': '223',
-        '36': '224',
-        '37': '225',
-        '38': '226',
-        '39': '227',
-        '40': '228',
-        '41': '229',
-        '42': '22a',
-        '43': '22b',
-        '44': '22c',
-        '45': '22d',
-        '46': '22e',
-        '47': '22f',
-        '48': '230',
-        '49': '231',
-        '50': '232',
-        '51': '233',
-        '52': '234',
-        '53': '235',
-        '54': '236',
-        '55': '237',
-        '56': '238',
-        '57': '239',
-        '58': '23a',
-        '59': '23b',
-        '60': '23c',
-        '61': '23d',
-        '62': '23e',
-        '63': '23f',
-        '64': '240',
-        '65': '241',
-        '66': '242',
-        '67': '243',
-        '68': '244',
-        '69': '245',
-        '70': '246',
-        '71': '247',
-        '72': '248',
-        '73': '249',
-        '74': '24a',
-        '75': '24b',
-        '76': '24c',
-        '77': '24d',
-        '78': '24e',
-        '79': '24f',
-        '80': '250',
-    }
-    return MLC_code[leave]
+    # EFS element of MLCX2 leaf '1'..'80', e.g. '201'
+    return "%x" % (iCOMTags.leafTag(2, int(leave)) & 0xffff)
 
 
 def write_efs(file_name, cp, code, data): #f-string formatting changed to .format for 3.4 compatibility.
-    codes_Dict = {
-        'MUs': "5001,1-0 {}\n".format(data),
-        'LINAC':  "7001,1-0 {}\n".format(data),
-        'PID':  "7001,2-0 {}\n".format(data),
-        'PName':  "7001,3-0 {}\n".format(data),
-        'PlanName':  "7001,4-0 {}\n".format(data),
-        'TxName':  "7001,5-0 {}\n".format(data),
-        'BeamName':  "7001,7-0 {}\n".format(data),
-        'BeamID':  "7001,6-0 {}\n".format(data),
-        'FieldComplexity':  "7002,5-0 {}\n".format(data),
-        'LeafWidth':  "7002,6-0 {}\n".format(data),
-        'RadType':  "5001,2-{0} {1}\n".format(cp, data),
-        'Energy':  "5001,3-{0} {1} MV\n".format(cp, data),
-        'Wedge':  "5001,4-{0} {1}\n".format(cp, data),  # OUT
-        'Gantry':  "5001,7-{0} {1}\n".format(cp, data),
-        'Acc':  "5001,f-{0} {1}\n".format(cp, data),
-        'GantryDirection':  "5001,19-{0} {1}\n".format(cp, data),
-        'Collimator':  "5001,8-{0} {1}\n".format(cp, data),
-        'CollimatorDir':  "5001,bb-{0} {1}\n".format(cp, data),
-        'X1':  "5001,9-{0} {1}\n".format(cp, data),
-        'X2':  "5001,a-{0} {1}\n".format(cp, data),
-        'Y1':  "5001,b-{0} {1}\n".format(cp, data),
-        'Y2':  "5001,c-{0} {1}\n".format(cp, data),
-        'MeterSet':  "7002,4-{0} {1}\n".format(cp, data),  # is zero
-        # Add more cases as needed
-    }
     with open(file_name, 'a') as file:
         if "MLC" not in code:
             # Create the string to write to the file
-            line_to_write = codes_Dict[code]
-            file.write(line_to_write)
+            if code == 'Energy':
+                data = "{} MV".format(data)
+            file.write(iCOMTags.efsLine(iCOMTags.TAGS_BY_KEY[code].tag, cp, data))
         else:
             mlc = 1
             for leave in data:
                 if mlc < 81:
-                    mlc_code = MLCX2_Lookup(str(81 - mlc))  # changed MLCX1 to MLCX2 and str(mlc) to str(81-mlc)
-                    line_to_write = "5001,{0}-{1} {2}\n".format(mlc_code, cp, round(-leave / 10, 2))
+                    line_to_write = iCOMTags.efsLine(iCOMTags.leafTag(2, 81 - mlc), cp, round(-leave / 10, 2))  # MLCX2, leaf 81-mlc
                 else:
-                    mlc_code = MLCX1_Lookup(str(161 - mlc))  # changed MLCX2 to MLCX1 and str(mlc-80) to str(161-mlc)
-                    line_to_write = "5001,{0}-{1} {2}\n".format(mlc_code, cp, round(leave / 10, 2))
+                    line_to_write = iCOMTags.efsLine(iCOMTags.leafTag(1, 161 - mlc), cp, round(leave / 10, 2))  # MLCX1, leaf 161-mlc
                 mlc += 1
                 file.write(line_to_write)
 
@@ -248,16 +92,56 @@ def getCollimator(beam):
         collimator=coll
     return collimator
 
-def get_total_MUs(rtplan,beam_number):
-    #beam_number=beam.BeamNumber
-    # Get the total MUs for the beam from Fraction Group
-    fraction_group = rtplan.FractionGroupSequence[0]
-    for referenced_beam in fraction_group.ReferencedBeamSequence:            
-        if referenced_beam.ReferencedBeamNumber == beam_number:
-           total_mus = referenced_beam.BeamMeterset
-      
-    print("Total MUs: %s" % total_mus)
-    return total_mus
+def deviceIndices(Beam_Lim_Dev_Pos_Seq):
+    # (Y jaw index, MLC index) of a control point's devices, found by RTBeamLimitingDeviceType.
+    index = dict((device.RTBeamLimitingDeviceType, i) for i, device in enumerate(Beam_Lim_Dev_Pos_Seq))
+    y = next((index[t] for t in Y_JAW_DEVICES if t in index), None)
+    mlc = next((index[t] for t in MLC_DEVICES if t in index), None)
+    return y, mlc
+
+class PlanModel:
+    # Everything the conversion looks up across beams and control points,
+    # read once per RTPLAN: the beam number -> meterset map of the fraction
+    # group, and each beam's energy, machine and device indices. Beams
+    # without an energy or machine of their own use the first beam's.
+
+    def __init__(self, rtplan):
+        self.rtplan = rtplan
+        self.patient_id = rtplan.PatientID
+        self.patient_name = rtplan.PatientName
+        self.metersets = {}
+        for referenced_beam in rtplan.FractionGroupSequence[0].ReferencedBeamSequence:
+            self.metersets[referenced_beam.ReferencedBeamNumber] = referenced_beam.BeamMeterset
+        self.beams = []
+        for beam in rtplan.BeamSequence:
+            self.beams.append(self._beamModel(beam))
+
+    def _beamModel(self, beam):
+        first = self.beams[0] if self.beams else None
+        if beam.BeamNumber not in self.metersets:
+            raise ValueError("Beam %s is not in the fraction group" % beam.BeamName)
+        cp0 = beam.ControlPointSequence[0]
+        energy = getattr(cp0, 'NominalBeamEnergy', None)
+        if energy is None and first is not None:
+            energy = first.energy
+        machine = getattr(beam, 'TreatmentMachineName', None) or (first.machine if first is not None else None)
+        if energy is None or machine is None:
+            raise ValueError("Beam %s has no %s" % (beam.BeamName, "energy" if energy is None else "treatment machine"))
+        devices = []
+        for cp in beam.ControlPointSequence:
+            if 'BeamLimitingDevicePositionSequence' in cp:
+                devices.append(deviceIndices(cp.BeamLimitingDevicePositionSequence))
+            else:
+                devices.append((None, None))
+        y = devices[0][0]
+        first_y = cp0.BeamLimitingDevicePositionSequence[y].LeafJawPositions if y is not None else None
+        final_weight = getattr(beam, 'FinalCumulativeMetersetWeight', None)
+        if final_weight is None:
+            final_weight = beam.ControlPointSequence[-1].CumulativeMetersetWeight
+        if not final_weight:
+            raise ValueError("Beam %s has no final cumulative meterset weight" % beam.BeamName)
+        return BeamModel(beam, beam.BeamNumber, self.metersets[beam.BeamNumber], energy, machine, devices, first_y,
+                         final_weight)
 
 def getFirstGantry(beam):
     first_gantry_rot=beam.ControlPointSequence[0].GantryRotationDirection
@@ -269,38 +153,126 @@ def getFirstGantry(beam):
         first_gantry_angle=first_gantry
     return first_gantry_angle,first_gantry_rot
 
-def getBeamDelimiters(Beam_Lim_Dev_Pos_Seq,First_Yjaw_position):
-    
-    number_beamLimitingDevice=len(Beam_Lim_Dev_Pos_Seq)
-    if number_beamLimitingDevice==1:
-        Xjaw_position=[-200,200]    
-        Yjaw_position=First_Yjaw_position	    
-        mlc_positions = Beam_Lim_Dev_Pos_Seq[0].LeafJawPositions
-    elif number_beamLimitingDevice==2:
-        Xjaw_position = [-200,200] #cp.BeamLimitingDevicePositionSequence[0].LeafJawPositions
-        Yjaw_position = Beam_Lim_Dev_Pos_Seq[0].LeafJawPositions
-        mlc_positions = Beam_Lim_Dev_Pos_Seq[1].LeafJawPositions
+def getFieldTech(beam):
+    # Check technique for the beam. Static, IMRT, VMAT
+    first_gantry_rot=beam.ControlPointSequence[0].GantryRotationDirection
+    cp_len=len(beam.ControlPointSequence)
+    if 'NONE' in first_gantry_rot and cp_len>2: # Static FiF field.
+        return 'IMRT'
+    elif 'NONE' in first_gantry_rot and cp_len==2: # Static field 
+        return 'Static'
+    return 'VMAT'
+
+def getBeamDelimiters(cp,devices,First_Yjaw_position):
+    # devices - the control point's (Y jaw, MLC) indices from its BeamModel
+    y, mlc = devices
+    if mlc is None:
+        raise ValueError("Control point %s has no MLC positions" % cp.ControlPointIndex)
+    Xjaw_position = [-200,200]
+    if y is None:
+        if First_Yjaw_position is None:
+            raise ValueError("Control point %s has no Y jaw positions" % cp.ControlPointIndex)
+        Yjaw_position = First_Yjaw_position
     else:
-        Xjaw_position = [-200,200] #cp.BeamLimitingDevicePositionSequence[0].LeafJawPositions
-        Yjaw_position = Beam_Lim_Dev_Pos_Seq[1].LeafJawPositions
-        mlc_positions = Beam_Lim_Dev_Pos_Seq[2].LeafJawPositions
+        Yjaw_position = cp.BeamLimitingDevicePositionSequence[y].LeafJawPositions
+    mlc_positions = cp.BeamLimitingDevicePositionSequence[mlc].LeafJawPositions
     return Xjaw_position,Yjaw_position,mlc_positions
 
-def efs_standard_header_struct(crtplan,cbeam,efs_file):
-    #total_monitor_units = round(crtplan.FractionGroupSequence[0].ReferencedBeamSequence[0].BeamMeterset,2)
-    PatientID=crtplan.PatientID    
-    patient_name = crtplan.PatientName
-    treatment_name = crtplan.BeamSequence[0].TreatmentMachineName
+def loadTolerances(settings):
+    # Downsampling tolerances from the [dcm2efs] section of config.txt, or None if it is off.
+    if not settings.get('downsample', False):
+        return None
+    return dict((key, float(settings.get(key, DEFAULT_TOLERANCES[key]))) for key in DEFAULT_TOLERANCES)
+
+def getControlPoints(beam_model):
+    points = []
+    prev_angle = None
+    for cp, devices in zip(beam_model.beam.ControlPointSequence, beam_model.devices):
+        angle = float(cp.GantryAngle) if 'GantryAngle' in cp else prev_angle
+        if prev_angle is None:
+            gantry = angle
+        else:
+            gantry = points[-1].gantry + (angle - prev_angle + 180.0) % 360.0 - 180.0
+        prev_angle = angle
+        if 'GantryRotationDirection' in cp:
+            rotation = str(cp.GantryRotationDirection)
+        else:
+            rotation = points[-1].rotation if points else 'NONE'
+        if 'BeamLimitingDevicePositionSequence' in cp:
+            Xjaw_position,Yjaw_position,mlc_positions = getBeamDelimiters(cp,devices,beam_model.first_y)
+            jaws = tuple(float(v) for v in list(Xjaw_position) + list(Yjaw_position))
+            mlc = tuple(float(v) for v in mlc_positions)
+        else:
+            jaws, mlc = points[-1].jaws, points[-1].mlc
+        points.append(ControlPoint(gantry, rotation, jaws, mlc, float(cp.CumulativeMetersetWeight)))
+    return points
+
+def _fraction(a, b, x):
+    if b == a:
+        return None
+    return (x - a) / (b - a)
+
+def _interpolation_error(points, i, j, k, total):
+    # Error at control point k if it is dropped and the linac interpolates
+    # between i and j. Axes are interpolated against meterset, as the linac
+    # does; meterset is checked against gantry so the MU per degree is kept.
+    a, b, p = points[i], points[j], points[k]
+    t = _fraction(a.meterset, b.meterset, p.meterset)
+    if t is None:
+        t = _fraction(a.gantry, b.gantry, p.gantry)
+    if t is None:
+        t = float(k - i) / (j - i)
+    s = _fraction(a.gantry, b.gantry, p.gantry)
+    if s is None:
+        s = t
+    mlc = max([abs(u + (v - u) * t - w) for u, v, w in zip(a.mlc, b.mlc, p.mlc)] or [0.0])
+    jaw = max([abs(u + (v - u) * t - w) for u, v, w in zip(a.jaws, b.jaws, p.jaws)] or [0.0])
+    return {'mlc': mlc,
+            'jaw': jaw,
+            'gantry': abs(a.gantry + (b.gantry - a.gantry) * t - p.gantry),
+            'meterset': abs(a.meterset + (b.meterset - a.meterset) * s - p.meterset) / total * 100.0}
+
+def downsample_control_points(points, tolerances = None):
+    # Greedy pass: from each kept control point, reach as far forward as
+    # possible while every skipped point stays within tolerance. The first and
+    # last points and any change of gantry direction are always kept.
+    # Returns (kept indices, worst error of the dropped points).
+    tol = dict(DEFAULT_TOLERANCES)
+    tol.update(tolerances or {})
+    total = max([p.meterset for p in points] + [1e-9])
+    worst = dict((key, 0.0) for key in DEFAULT_TOLERANCES)
+    keep = [0]
+    i = 0
+    while i < len(points) - 1:
+        best, best_error = i + 1, {}
+        j = i + 2
+        while j < len(points) and points[j - 1].rotation == points[i].rotation:
+            errors = [_interpolation_error(points, i, j, k, total) for k in range(i + 1, j)]
+            if any(e[key] > tol[key] for e in errors for key in DEFAULT_TOLERANCES):
+                break
+            best = j
+            best_error = dict((key, max(e[key] for e in errors)) for key in DEFAULT_TOLERANCES)
+            j += 1
+        for key in best_error:
+            worst[key] = max(worst[key], best_error[key])
+        keep.append(best)
+        i = best
+    return keep, worst
+
+def efs_standard_header_struct(plan,beam_model,efs_file):
+    cbeam = beam_model.beam
+    PatientID = plan.patient_id
+    patient_name = plan.patient_name
+    treatment_name = beam_model.machine
 
     try:
         beam_id=int(cbeam.BeamNumber)
     except:
         beam_id = 1
-    beam_number=cbeam.BeamNumber
     beam_name=cbeam.BeamDescription
     leaf_width = 0.5
     
-    total_monitor_units=round(get_total_MUs(crtplan,beam_number),2)
+    total_monitor_units=round(beam_model.meterset,2)
     
     create_efs(efs_file)
     write_efs(efs_file,0,'MUs',total_monitor_units)
@@ -314,18 +286,22 @@ def efs_standard_header_struct(crtplan,cbeam,efs_file):
     write_efs(efs_file,0,'LeafWidth',leaf_width)
 
 def efs_control_point_struct(FieldTech,energy,gantry_angle,gantry_rot,collimator,Xjaw_position,Yjaw_position,mlc_positions,monitor_units,cp_count,efs_file):
-    write_efs(efs_file,cp_count,'RadType','XRAY')              
-    write_efs(efs_file,cp_count,'Energy',energy)
-    write_efs(efs_file,cp_count,'Wedge','OUT')
-    write_efs(efs_file,cp_count,'Gantry',gantry_angle)
-    write_efs(efs_file,cp_count,'Collimator',collimator)
-    write_efs(efs_file,cp_count,'X1',Yjaw_position[1]/10)#changed from [0] to [1] removed -
-    write_efs(efs_file,cp_count,'X2',-Yjaw_position[0]/10)#changed from [1] to [0] added -
-    write_efs(efs_file,cp_count,'Y1',-Xjaw_position[0]/10) 
-    write_efs(efs_file,cp_count,'Y2',Xjaw_position[1]/10)
-    write_efs(efs_file,cp_count,'Acc',0)
-    write_efs(efs_file,cp_count,'GantryDirection',gantry_rot)
-    write_efs(efs_file,cp_count,'CollimatorDir','NONE')
+    # Every tag is written. Tags the linac carries forward are left out at
+    # send time instead ([icom] elide), so a rejected field can be resent whole.
+    values = [('RadType','XRAY'),
+              ('Energy',energy),
+              ('Wedge','OUT'),
+              ('Gantry',gantry_angle),
+              ('Collimator',collimator),
+              ('X1',Yjaw_position[1]/10),#changed from [0] to [1] removed -
+              ('X2',-Yjaw_position[0]/10),#changed from [1] to [0] added -
+              ('Y1',-Xjaw_position[0]/10),
+              ('Y2',Xjaw_position[1]/10),
+              ('Acc',0),
+              ('GantryDirection',gantry_rot),
+              ('CollimatorDir','NONE')]
+    for code, data in values:
+        write_efs(efs_file,cp_count,code,data)
 
     if ('IMRT' in FieldTech) and (cp_count %2 !=0):
       write_efs(efs_file,cp_count,'MLC',mlc_positions)
@@ -333,56 +309,65 @@ def efs_control_point_struct(FieldTech,energy,gantry_angle,gantry_rot,collimator
       write_efs(efs_file,cp_count,'MLC',mlc_positions)
     write_efs(efs_file,cp_count,'MeterSet',100*monitor_units)
 
-def convert_dcm2efs(file_path,efs_name_path = None):
+def convert_dcm2efs(file_path,efs_name_path = None,tolerances = None,reports = None):
+    # tolerances (see DEFAULT_TOLERANCES) turns on control point downsampling
+    # for VMAT beams. A DownsampleReport is appended to reports for each
+    # downsampled beam if a list is given.
     try:
-        # Load the RTPlan DICOM file
+        # Load the RTPlan DICOM file and index it
         rtplan = pydicom.dcmread(file_path)
+        plan = PlanModel(rtplan)
         # If efs_file is not defined, then define the same as dcm file.
         if efs_name_path is None:
             efs_name_path = os.path.dirname(file_path)
         efs_names=[]
         # Extract information for each control point
-        for beam in rtplan.BeamSequence:
+        for beam_model in plan.beams:
+            beam = beam_model.beam
             # Create the efs file to complete
             efs_file=os.path.join(efs_name_path,'Beam_' +beam.BeamName+ '.efs')
         
             # General information - Standard for all type of beam
-            efs_standard_header_struct(rtplan,beam,efs_file)
+            efs_standard_header_struct(plan,beam_model,efs_file)
 
-            # Get control points, coll, energy and first gantry and Limiting devices
+            # Get control points, coll, energy and first gantry
             control_points = beam.ControlPointSequence
             collimator = int(getCollimator(beam))
-            energy = rtplan.BeamSequence[0].ControlPointSequence[0].NominalBeamEnergy
+            energy = beam_model.energy
             
             cp_count=1
             cp_len=len(control_points)
             First_gantry,First_gantry_rot=getFirstGantry(beam)
-            First_Yjaw_position = beam.ControlPointSequence[0].BeamLimitingDevicePositionSequence[1].LeafJawPositions
 
             # Check technique for the beam. Static, IMRT, VMAT
-            if 'NONE' in First_gantry_rot and cp_len>2: # Static FiF field.
-                FieldTech='IMRT'
+            FieldTech=getFieldTech(beam)
+            if 'IMRT' in FieldTech:
                 write_efs(efs_file,0,'FieldComplexity','Dynamic')
-            elif 'NONE' in First_gantry_rot and cp_len==2: # Static field 
-                FieldTech='Static'
-            else:
-                FieldTech='VMAT'
+            elif 'VMAT' in FieldTech:
                 write_efs(efs_file,0,'FieldComplexity','IMAT')
        
+            kept = None
+            if tolerances is not None and 'VMAT' in FieldTech:
+                kept, max_error = downsample_control_points(getControlPoints(beam_model), tolerances)
+                if reports is not None:
+                    reports.append(DownsampleReport(str(beam.BeamName), cp_len, len(kept), max_error))
+                kept = set(kept)
+
             # Control Point specific information
-            for cp in control_points:
+            for idx, cp in enumerate(control_points):
+                if kept is not None and idx not in kept:
+                    continue
                 if 'VMAT' in FieldTech:              
                   gantry_angle,gantry_rot = getGantry(cp)
                 else:
-                  gantry_angleFl,gantry_rot = getFirstGantry(beam)
-                  gantry_angle = int(gantry_angleFl)
+                  gantry_angle,gantry_rot = int(First_gantry),First_gantry_rot
                 
                 
                 
-                monitor_units = cp.CumulativeMetersetWeight
+                monitor_units = cp.CumulativeMetersetWeight / beam_model.final_weight     # Fraction of the beam
                 
                 if not ('Static' in FieldTech and cp_count == cp_len): # All cases except static field in cp 1 (only meterset needed)
-                    Xjaw_position,Yjaw_position,mlc_positions= getBeamDelimiters(cp.BeamLimitingDevicePositionSequence,First_Yjaw_position)
+                    Xjaw_position,Yjaw_position,mlc_positions= getBeamDelimiters(cp,beam_model.devices[idx],beam_model.first_y)
                     efs_control_point_struct(FieldTech,energy,gantry_angle,gantry_rot,collimator,Xjaw_position,Yjaw_position,mlc_positions,monitor_units,cp_count,efs_file)                
                 else:                                                   # Case for static field and cp 1 where only meterset is needed
                     write_efs(efs_file,cp_count,'MeterSet',100*monitor_units)
@@ -406,4 +391,63 @@ def open_file_dialog():
         print("Selected file: %s" % file_path)
     else:
         print("No file selected")
-    return file_path
\ No newline at end of file
+    return file_path
+
+def downsample_report(file_path, tolerances = None, repeats = 20):
+    # Converts the plan with and without downsampling and compares the tag
+    # counts and the time to build each beam's iCOM message (against the stub
+    # backend, so only the build cost is measured).
+    import time
+    import shutil
+    import tempfile
+    import iCOMBridge
+    from SequenceLibrary import parseEFS
+
+    def build_time(backend, handle, records):
+        start = time.time()
+        for i in range(repeats):
+            msg = backend.beginMessage(handle)
+            backend.insertTags(msg, records)
+            backend.deleteMessage(msg)
+        return (time.time() - start) / repeats * 1000.0
+
+    tmp = tempfile.mkdtemp()
+    try:
+        full_dir, reduced_dir = os.path.join(tmp, "full"), os.path.join(tmp, "reduced")
+        os.makedirs(full_dir)
+        os.makedirs(reduced_dir)
+        reports = []
+        full_files = convert_dcm2efs(file_path, full_dir)
+        reduced_files = convert_dcm2efs(file_path, reduced_dir, tolerances or DEFAULT_TOLERANCES, reports)
+        if not full_files or not reduced_files:
+            return "Conversion failed"
+        backend = iCOMBridge.StubBackend()
+        handle = backend.fxConnect("127.0.0.1", 1000, "REPORT")
+        by_beam = dict((r.beam, r) for r in reports)
+        lines = []
+        for full_file, reduced_file in zip(full_files, reduced_files):
+            full, reduced = parseEFS(full_file), parseEFS(reduced_file)
+            name = os.path.splitext(os.path.basename(full_file))[0][len("Beam_"):]
+            lines.append("%s: %s -> %s tags, message build %.2f -> %.2f ms"
+                         % (name, len(full), len(reduced), build_time(backend, handle, full), build_time(backend, handle, reduced)))
+            report = by_beam.get(name)
+            if report:
+                e = report.max_error
+                lines.append("    control points %s -> %s, max error: MLC %.2f mm, jaw %.2f mm, gantry %.2f deg, meterset %.2f%%"
+                             % (report.cp_before, report.cp_after, e['mlc'], e['jaw'], e['gantry'], e['meterset']))
+            else:
+                lines.append("    not downsampled (not VMAT)")
+        return "\n".join(lines)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Report the effect of VMAT control point downsampling on an RTPLAN.")
+    parser.add_argument("plan", help = "RTPLAN DICOM file")
+    for key in sorted(DEFAULT_TOLERANCES):
+        parser.add_argument("--" + key, type = float, default = DEFAULT_TOLERANCES[key])
+    args = parser.parse_args()
+    print(downsample_report(args.plan, dict((key, getattr(args, key)) for key in DEFAULT_TOLERANCES)))
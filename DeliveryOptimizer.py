@@ -0,0 +1,184 @@
+"""
+#
+#  DeliveryOptimizer - Reorder sequence fields to cut mode-up and motion time
+#
+#  Each field's machine setup (energy, wedge, accessory, gantry, collimator)
+#  is read from the first control point of its EFS tags. Fields that share a
+#  'group' in config.txt and sit next to each other form a reorderable block;
+#  everything else (including beams marked 'pin = true', e.g. reference MU
+#  bookends) keeps its position. Within a block the order is chosen to
+#  minimise the estimated transition cost from the field before the block
+#  to the field after it.
+#
+"""
+
+import collections
+from iCOMTags import TAG_ENERGY, TAG_WEDGE, TAG_GANTRY, TAG_COLLIMATOR, TAG_ACCESSORY
+
+Setup = collections.namedtuple("Setup", ["energy", "wedge", "accessory", "gantry", "collimator"])
+
+# Estimated transition costs in seconds
+COSTS = {
+    'energy':       25.0,       # Mode-up to a new energy
+    'wedge':        10.0,       # Internal wedge in/out
+    'accessory':    30.0,       # Someone has to enter the room
+    'gantrySpeed':   6.0,       # deg/s
+    'collSpeed':    15.0,       # deg/s
+}
+
+EXACT_LIMIT = 9                 # Distinct setups per block solved exactly, above this use a heuristic
+
+
+def _angle(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def fieldSetup(fld):
+    # Machine setup at the first control point of a BeamPlan's EFS records.
+    vals = {}
+    for tag, cp, val in fld.tags or ():
+        if cp <= 1 and tag not in vals:
+            vals[tag] = val.strip()
+    return Setup(energy = vals.get(TAG_ENERGY),
+                 wedge = vals.get(TAG_WEDGE),
+                 accessory = vals.get(TAG_ACCESSORY),
+                 gantry = _angle(vals.get(TAG_GANTRY)),
+                 collimator = _angle(vals.get(TAG_COLLIMATOR)))
+
+
+def transitionCost(a, b, costs = COSTS):
+    # Seconds to go from setup a to setup b. Gantry and collimator move together.
+    if a is None or b is None:
+        return 0.0
+    cost = 0.0
+    if a.energy != b.energy:
+        cost += costs['energy']
+    if a.wedge != b.wedge:
+        cost += costs['wedge']
+    if a.accessory != b.accessory:
+        cost += costs['accessory']
+    motion = 0.0
+    if a.gantry is not None and b.gantry is not None:
+        motion = abs(a.gantry - b.gantry) / costs['gantrySpeed']
+    if a.collimator is not None and b.collimator is not None:
+        motion = max(motion, abs(a.collimator - b.collimator) / costs['collSpeed'])
+    return cost + motion
+
+
+def orderCost(setups, start = None, end = None, costs = COSTS):
+    total = 0.0
+    prev = start
+    for s in setups:
+        total += transitionCost(prev, s, costs)
+        prev = s
+    return total + transitionCost(prev, end, costs)
+
+
+def _solveExact(nodes, start, end, costs):
+    # Held-Karp over distinct setups. nodes is a list of Setups, returns an index order.
+    n = len(nodes)
+    best = {}
+    for i in range(n):
+        best[(1 << i, i)] = (transitionCost(start, nodes[i], costs), None)
+    for mask in range(1, 1 << n):
+        for last in range(n):
+            if (mask, last) not in best:
+                continue
+            cost = best[(mask, last)][0]
+            for nxt in range(n):
+                if mask & (1 << nxt):
+                    continue
+                key = (mask | (1 << nxt), nxt)
+                c = cost + transitionCost(nodes[last], nodes[nxt], costs)
+                if key not in best or c < best[key][0]:
+                    best[key] = (c, last)
+    full = (1 << n) - 1
+    last = min(range(n), key = lambda i: best[(full, i)][0] + transitionCost(nodes[i], end, costs))
+    order = []
+    mask = full
+    while last is not None:
+        order.append(last)
+        prev = best[(mask, last)][1]
+        mask &= ~(1 << last)
+        last = prev
+    return order[::-1]
+
+
+def _solveHeuristic(nodes, start, end, costs):
+    # Nearest neighbour from the start setup, then 2-opt until no move helps.
+    remaining = list(range(len(nodes)))
+    order = []
+    prev = start
+    while remaining:
+        nxt = min(remaining, key = lambda i: transitionCost(prev, nodes[i], costs))
+        remaining.remove(nxt)
+        order.append(nxt)
+        prev = nodes[nxt]
+    def cost(o):
+        return orderCost([nodes[i] for i in o], start, end, costs)
+    current = cost(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                c = cost(candidate)
+                if c < current - 1e-9:
+                    order, current, improved = candidate, c, True
+    return order
+
+
+def optimiseBlock(fields, start = None, end = None, costs = COSTS):
+    # Reorder one block. Fields with the same setup stay together in their
+    # original relative order, so repeats are never split up.
+    clusters = collections.OrderedDict()
+    for fld in fields:
+        clusters.setdefault(fieldSetup(fld), []).append(fld)
+    nodes = list(clusters.keys())
+    if len(nodes) < 2:
+        return list(fields)
+    if len(nodes) <= EXACT_LIMIT:
+        order = _solveExact(nodes, start, end, costs)
+    else:
+        order = _solveHeuristic(nodes, start, end, costs)
+    result = []
+    for i in order:
+        result.extend(clusters[nodes[i]])
+    return result
+
+
+def blocks(fields):
+    # Split fields into (reorderable, [fields]) runs. A run is reorderable if its
+    # fields share a non-empty group and none of them is pinned.
+    runs = []
+    for fld in fields:
+        group = getattr(fld, 'group', None)
+        movable = bool(group) and not getattr(fld, 'pinned', False)
+        if runs and movable and runs[-1][0] and runs[-1][1] == group:
+            runs[-1][2].append(fld)
+        else:
+            runs.append((movable, group, [fld]))
+    return [(movable, flds) for movable, group, flds in runs]
+
+
+def optimise(fields, costs = COSTS):
+    # Returns (ordered fields, estimated cost before, estimated cost after) in seconds.
+    fields = list(fields)
+    runs = blocks(fields)
+    result = []
+    for idx, (movable, flds) in enumerate(runs):
+        if movable and len(flds) > 1:
+            start = fieldSetup(result[-1]) if result else None
+            end = fieldSetup(runs[idx + 1][1][0]) if idx + 1 < len(runs) else None
+            result.extend(optimiseBlock(flds, start, end, costs))
+        else:
+            result.extend(flds)
+    before = orderCost([fieldSetup(f) for f in fields], costs = costs)
+    after = orderCost([fieldSetup(f) for f in result], costs = costs)
+    if after > before:
+        return fields, before, before     # Never make things worse
+    return result, before, after
@@ -0,0 +1,183 @@
+"""
+#
+#  EventBus - Publish/subscribe hooks for delivery and state events
+#
+#  The FX/VX threads publish an Event at each step of a session, so plugins
+#  and the control API can follow delivery without patching FxThread or
+#  reading PyiCom.log. Each subscriber gets its own bounded queue and
+#  dispatcher thread. Publishing only puts the event on the queues of the
+#  matching subscribers, so a slow subscriber can never delay a confirm: if
+#  its queue fills up, it loses events (counted in `dropped`) instead.
+#
+#  Subscribe with a callback, which is called on the subscriber's own
+#  thread, or without one and call get() to pull events yourself.
+#
+#  Run directly to benchmark the cost of publish(). The pass mark is on the
+#  99th percentile only: the worst single publish also includes waiting for
+#  the GIL while dispatcher threads run, each wait as long as the
+#  interpreter's thread switch interval (5 ms by default), which the bus
+#  has no control over.
+#
+"""
+
+import time
+import queue
+import logging
+import threading
+import collections
+
+# Event types and the data each one carries
+CONNECTED        = "connected"          # link ('FX'/'VX'), linac, handle
+DISCONNECTED     = "disconnected"       # link, linac
+FIELD_QUEUED     = "field_queued"       # fields (how many were added)
+QUEUE_CLEARED    = "queue_cleared"
+FIELD_STARTED    = "field_started"      # index, count, name
+MESSAGE_SENT     = "message_sent"       # filename, tags, response, errorCode
+TAG_ERROR        = "tag_error"          # tag, code, tagName, error
+STATE_CHANGED    = "state_changed"      # state, name, previous
+FIELD_TERMINATED = "field_terminated"   # index, name
+SEQUENCE_DONE    = "sequence_done"      # fields
+FIELD_ANALYSED   = "field_analysed"     # index, name, samples, passed, failures, deviations (see LogQA)
+
+EVENT_TYPES = frozenset([CONNECTED, DISCONNECTED, FIELD_QUEUED, QUEUE_CLEARED, FIELD_STARTED,
+                         MESSAGE_SENT, TAG_ERROR, STATE_CHANGED, FIELD_TERMINATED, SEQUENCE_DONE,
+                         FIELD_ANALYSED])
+
+DEFAULT_QUEUE_SIZE = 1024       # Events buffered per subscriber
+
+Event = collections.namedtuple("Event", ["type", "seq", "time", "data"])
+
+
+def eventToDict(event):
+    # Flat dict for JSON, e.g. the control API's /events stream.
+    d = dict(event.data)
+    d['event'] = event.type
+    d['seq'] = event.seq
+    d['t'] = round(event.time, 3)
+    return d
+
+
+class Subscription:
+
+    def __init__(self, bus, callback, types, maxQueued, name):
+        self.bus = bus
+        self.callback = callback
+        self.types = frozenset(types) if types is not None else None
+        self.name = name or (getattr(callback, '__name__', None) or "subscriber")
+        self.queue = queue.Queue(maxQueued)
+        self.dropped = 0                # Events lost because the queue was full
+        self._thread = None
+        if callback is not None:
+            self._thread = threading.Thread(target = self._dispatch, name = "Event-%s" % self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout = None):
+        # Next event for a subscription without a callback, or None on timeout/close.
+        try:
+            return self.queue.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+    def _dispatch(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            try:
+                self.callback(event)
+            except Exception as e:
+                logging.info("ERROR: Event subscriber %s failed on %s - %s" % (self.name, event.type, e))
+
+    def unsubscribe(self):
+        self.bus._remove(self)
+        while True:
+            try:
+                self.queue.put_nowait(None)     # Wakes the dispatcher or a waiting get()
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()     # Make room - the subscriber is going anyway
+                except queue.Empty:
+                    pass
+
+
+class EventBus:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = ()      # Replaced, never mutated, so publish needs no lock to iterate
+        self._seq = 0
+
+    def subscribe(self, callback = None, types = None, maxQueued = DEFAULT_QUEUE_SIZE, name = None):
+        # types limits the subscription to those event types, None for all.
+        if types is not None:
+            unknown = set(types) - EVENT_TYPES
+            if unknown:
+                raise ValueError("Unknown event types: %s" % ", ".join(sorted(unknown)))
+        sub = Subscription(self, callback, types, maxQueued, name)
+        with self._lock:
+            self._subscribers = self._subscribers + (sub,)
+        return sub
+
+    def _remove(self, sub):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not sub)
+
+    def publish(self, eventType, **data):
+        # Called on the FX/VX threads - never blocks on a subscriber.
+        if eventType not in EVENT_TYPES:
+            raise ValueError("Unknown event type: %s" % eventType)
+        subscribers = self._subscribers
+        if not subscribers:
+            return None
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        event = Event(eventType, seq, time.time(), data)
+        for sub in subscribers:
+            if sub.types is None or eventType in sub.types:
+                sub._put(event)
+        return event
+
+    def close(self):
+        for sub in self._subscribers:
+            sub.unsubscribe()
+
+
+def benchmark(subscribers = 4, events = 20000):
+    # Publish cost with fast subscribers plus one that sleeps on every event.
+    # Returns (mean, p99, max) in microseconds and the slow subscriber's dropped count.
+    bus = EventBus()
+    received = [0]
+
+    def fast(event):
+        received[0] += 1
+
+    for i in range(subscribers):
+        bus.subscribe(fast, name = "fast-%s" % i)
+    slow = bus.subscribe(lambda event: time.sleep(0.01), name = "slow", maxQueued = 64)
+    times = []
+    for i in range(events):
+        start = time.perf_counter()
+        bus.publish(STATE_CHANGED, state = i % 14, name = "BENCH", previous = None)
+        times.append((time.perf_counter() - start) * 1e6)
+    bus.close()
+    times.sort()
+    return (sum(times) / len(times), times[int(len(times) * 0.99)], times[-1]), slow.dropped
+
+
+if __name__ == "__main__":
+    import sys
+    (mean, p99, worst), dropped = benchmark()
+    print("publish(): mean %.1f us, p99 %.1f us, max %.1f us (slow subscriber dropped %s events)"
+          % (mean, p99, worst, dropped))
+    print("Sub-millisecond publish, p99: %s" % ("PASSED" if p99 < 1000 else "FAILED"))
+    print("Max is not gated - it includes GIL waits of %.0f ms (the thread switch interval) each"
+          % (sys.getswitchinterval() * 1000))
@@ -0,0 +1,349 @@
+"""
+#
+#  FieldQueue - Thread-safe field queue for PyiCom
+#
+#  The GUI thread adds fields while the FX thread walks through them with
+#  a cursor. All access goes through a single lock, and snapshots are
+#  cached immutable FieldSweeps so the playlist can be redrawn without
+#  copying the queue every time.
+#
+#  Fields are stored as runs of the same field object, the way sequences
+#  repeat them, so queueing a sweep with thousands of repeats costs one
+#  entry per distinct field rather than one per delivery.
+#
+#  An optional observer is called with (op, args) for every change, while
+#  the lock is held, so it sees changes in exactly the order they happened.
+#
+"""
+
+import bisect
+import itertools
+import threading
+
+
+def fieldRuns(fields):
+    # (field, count) runs of consecutive identical field objects.
+    if isinstance(fields, FieldSweep):
+        return fields.runs()
+    runs = []
+    for fld in fields:
+        if runs and runs[-1][0] is fld:
+            runs[-1][1] += 1
+        else:
+            runs.append([fld, 1])
+    return tuple((fld, count) for fld, count in runs)
+
+
+def _runStarts(runs):
+    # Index of the first field of each run.
+    return [0] + list(itertools.accumulate(count for fld, count in runs))[:-1] if runs else []
+
+
+class FieldSweep:
+    # Immutable sequence of fields held as (field, count) runs and expanded
+    # lazily: len(), indexing and slicing work out the field from the runs,
+    # and iterating yields the fields one by one, so a field repeated 1000
+    # times costs one entry, not 1000.
+
+    __slots__ = ("_runs", "_starts", "_length")
+
+    def __init__(self, runs = (), starts = None):
+        # starts may be given when already known for these runs.
+        self._runs = tuple(runs)
+        if starts is None:
+            self._runs = tuple(run for run in self._runs if run[1] > 0)
+            starts = _runStarts(self._runs)
+        self._starts = starts       # Index of the first field of each run
+        self._length = starts[-1] + self._runs[-1][1] if self._runs else 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for fld, count in self._runs:
+            for i in range(count):
+                yield fld
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(self._length)))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("FieldSweep index out of range")
+        return self._runs[bisect.bisect_right(self._starts, index) - 1][0]
+
+    def __repr__(self):
+        return "FieldSweep(%s fields in %s runs)" % (self._length, len(self._runs))
+
+    def runs(self):
+        return self._runs
+
+    def distinct(self):
+        # Each field object once, in order of first appearance.
+        seen = set()
+        out = []
+        for fld, count in self._runs:
+            if id(fld) not in seen:
+                seen.add(id(fld))
+                out.append(fld)
+        return out
+
+
+class FieldQueue:
+
+    def __init__(self, fields = None, observer = None):
+        self._lock = threading.Condition(threading.Lock())
+        self._runs = []            # (field, count) runs of the same field object
+        self._starts = None        # Cached index of the first field of each run
+        self._sweep = None         # Cached FieldSweep of the runs, kept across cursor moves
+        self._length = 0
+        self._cursor = 0
+        self._version = 0          # Bumped on every change to fields or cursor
+        self._snapshot = None      # Cached (version, cursor, fields) tuple
+        self.observer = observer
+        if fields:
+            self._setFields(fields)
+
+    def __len__(self):
+        with self._lock:
+            return self._length
+
+    def _changed(self, op = None, *args):
+        # Must be called with the lock held.
+        self._version += 1
+        self._snapshot = None
+        if op and self.observer:
+            self.observer(op, args)
+        self._lock.notify_all()
+
+    # --- Runs (lock held) ---
+
+    def _setFields(self, fields):
+        self._runs = [run for run in fieldRuns(fields) if run[1] > 0]
+        self._length = sum(count for fld, count in self._runs)
+        self._reshaped()
+
+    def _reshaped(self):
+        self._starts = None
+        self._sweep = None
+
+    def _locate(self, index):
+        # (run index, offset into the run) of a field index below the length.
+        if self._starts is None:
+            self._starts = _runStarts(self._runs)
+        r = bisect.bisect_right(self._starts, index) - 1
+        return r, index - self._starts[r]
+
+    def _fieldAt(self, index):
+        if index >= self._length:
+            return None
+        return self._runs[self._locate(index)[0]][0]
+
+    def _append(self, fld, count):
+        if self._runs and self._runs[-1][0] is fld:
+            self._runs[-1] = (fld, self._runs[-1][1] + count)
+        else:
+            self._runs.append((fld, count))
+
+    def _insert(self, index, fld):
+        if index >= self._length:
+            self._append(fld, 1)
+        else:
+            r, offset = self._locate(index)
+            run = self._runs[r]
+            if run[0] is fld:
+                self._runs[r] = (fld, run[1] + 1)
+            elif offset == 0 and r > 0 and self._runs[r - 1][0] is fld:
+                self._runs[r - 1] = (fld, self._runs[r - 1][1] + 1)
+            elif offset == 0:
+                self._runs.insert(r, (fld, 1))
+            else:
+                self._runs[r:r + 1] = [(run[0], offset), (fld, 1), (run[0], run[1] - offset)]
+        self._length += 1
+        self._reshaped()
+
+    def _remove(self, index):
+        r, offset = self._locate(index)
+        fld, count = self._runs[r]
+        if count > 1:
+            self._runs[r] = (fld, count - 1)
+        else:
+            del self._runs[r]
+            if 0 < r < len(self._runs) and self._runs[r - 1][0] is self._runs[r][0]:
+                self._runs[r - 1] = (self._runs[r][0], self._runs[r - 1][1] + self._runs[r][1])
+                del self._runs[r]
+        self._length -= 1
+        self._reshaped()
+        return fld
+
+    # --- Producers ---
+
+    def append(self, fld):
+        self.extend(FieldSweep(((fld, 1),)))
+
+    def extend(self, flds):
+        # flds may be any iterable; a FieldSweep is added without expanding it.
+        # The observer is passed the added fields as a FieldSweep.
+        if not isinstance(flds, FieldSweep):
+            flds = FieldSweep(fieldRuns(flds))
+        with self._lock:
+            for fld, count in flds.runs():
+                self._append(fld, count)
+            self._length += len(flds)
+            self._reshaped()
+            self._changed("extend", flds)
+
+    def insertAtCursor(self, fld):
+        # The new field becomes the current one, the old current follows it.
+        with self._lock:
+            self._insert(self._cursor, fld)
+            self._changed("insert", self._cursor, fld)
+
+    def removeAtCursor(self):
+        with self._lock:
+            if self._cursor >= self._length:
+                return None
+            fld = self._remove(self._cursor)
+            self._changed("remove", self._cursor)
+            return fld
+
+    def clear(self):
+        with self._lock:
+            self._setFields(())
+            self._cursor = 0
+            self._changed("clear")
+
+    def load(self, fields, cursor):
+        # Replace the contents without notifying the observer (used when
+        # restoring a session that the observer itself recorded).
+        with self._lock:
+            self._setFields(fields)
+            self._cursor = min(max(cursor, 0), self._length)
+            self._changed()
+
+    # --- Cursor ---
+
+    @property
+    def cursor(self):
+        with self._lock:
+            return self._cursor
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def current(self):
+        # Field under the cursor, or None once the end has been reached.
+        with self._lock:
+            return self._fieldAt(self._cursor)
+
+    def position(self):
+        # (cursor, length, field) read atomically for logging.
+        with self._lock:
+            return self._cursor, self._length, self._fieldAt(self._cursor)
+
+    def advance(self, step = 1):
+        # Move the cursor, clamped to [0, len]. Returns the new position.
+        with self._lock:
+            self._cursor = min(max(self._cursor + step, 0), self._length)
+            self._changed("cursor", self._cursor)
+            return self._cursor
+
+    def seek(self, index):
+        with self._lock:
+            self._cursor = min(max(index, 0), self._length)
+            self._changed("cursor", self._cursor)
+            return self._cursor
+
+    def atEnd(self):
+        with self._lock:
+            return self._cursor >= self._length
+
+    def resetIfDone(self):
+        # Atomically empty the queue if the cursor has passed the last field,
+        # so a field appended at the same moment is never dropped.
+        with self._lock:
+            if self._cursor < self._length:
+                return False
+            self._setFields(())
+            self._cursor = 0
+            self._changed("clear")
+            return True
+
+    def waitForChange(self, version, timeout = None):
+        # Block until the queue differs from the given version. Returns the current version.
+        with self._lock:
+            if self._version == version:
+                self._lock.wait(timeout)
+            return self._version
+
+    # --- Snapshots ---
+
+    def snapshot(self):
+        # Returns (version, cursor, fields) where fields is an immutable FieldSweep.
+        # Repeated calls between changes return the same cached object.
+        with self._lock:
+            if self._snapshot is None:
+                if self._sweep is None:
+                    if self._starts is None:
+                        self._starts = _runStarts(self._runs)
+                    self._sweep = FieldSweep(self._runs, self._starts)
+                self._snapshot = (self._version, self._cursor, self._sweep)
+            return self._snapshot
+
+
+def stressTest(producers = 4, consumers = 2, perProducer = 5000):
+    # Concurrent producers append while consumers advance, insert and remove at
+    # the cursor and take snapshots. Every snapshot must be internally consistent.
+    fq = FieldQueue()
+    errors = []
+    removed = []
+    done = threading.Event()
+
+    def produce(pid):
+        for i in range(perProducer):
+            fq.append({'name': "P%s-%s" % (pid, i)})
+
+    def consume():
+        n = 0
+        while not done.is_set() or not fq.atEnd():
+            version, cursor, fields = fq.snapshot()
+            if cursor > len(fields):
+                errors.append("Cursor %s beyond snapshot of %s" % (cursor, len(fields)))
+            if n % 97 == 0:
+                fq.insertAtCursor({'name': "Inserted"})
+                fld = fq.removeAtCursor()
+                if fld is None or fld['name'] != "Inserted":
+                    removed.append(fld)
+            fq.advance()
+            n += 1
+
+    threads = [threading.Thread(target = produce, args = (p,)) for p in range(producers)]
+    threads += [threading.Thread(target = consume) for _ in range(consumers)]
+    for t in threads:
+        t.start()
+    for t in threads[:producers]:
+        t.join()
+    done.set()
+    for t in threads[producers:]:
+        t.join()
+
+    version, cursor, fields = fq.snapshot()
+    names = [f['name'] for f in fields] + [f['name'] for f in removed if f is not None]
+    produced = [n for n in names if n != "Inserted"]
+    if len(produced) != producers * perProducer or len(set(produced)) != len(produced):
+        errors.append("Expected %s produced fields, found %s" % (producers * perProducer, len(produced)))
+    if cursor != len(fields):
+        errors.append("Consumers stopped at %s of %s" % (cursor, len(fields)))
+    return errors
+
+
+if __name__ == "__main__":
+    import time
+    start = time.time()
+    errors = stressTest()
+    print("Stress test %s in %.2fs" % ("PASSED" if not errors else "FAILED", time.time() - start))
+    for e in errors:
+        print("  %s" % e)
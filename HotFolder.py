@@ -0,0 +1,232 @@
+"""
+#
+#  HotFolder - Watched-folder ingestion of TPS plan exports
+#
+#  HotFolderWatcher polls the configured export folders for new RTPLANs and
+#  hands them to an IngestPipeline. The pipeline converts them with DCM2EFS
+#  on a small pool of worker threads, validates the EFS output and places
+#  the result on a "ready to deliver" list, so queueing a plan at the linac
+#  needs no conversion at all.
+#
+#  The pending queue is bounded: when it is full the watcher simply leaves
+#  files for its next poll. Plans are deduplicated by file (path, mtime,
+#  size) and by SOPInstanceUID.
+#
+"""
+
+import os
+import queue
+import logging
+import threading
+import collections
+import DCM2EFS as dcm2efs
+import iCOMTags
+from PlanIndex import isDicom, readPlan
+from SequenceLibrary import compileBeam, parseEFS
+from iCOMTags import TAG_MU
+
+# A converted plan waiting to be delivered. fields are BeamPlans ready for the FieldQueue.
+ReadyPlan = collections.namedtuple("ReadyPlan",
+    ["uid", "source", "patient_id", "plan_label", "techniques", "fields"])
+
+
+def validateEFS(records):
+    # Returns an error string, or None if the EFS looks deliverable.
+    if not records:
+        return "empty file"
+    if not any(tag == TAG_MU for tag, cp, val in records):
+        return "no MU tag"
+    if not any(cp > 0 for tag, cp, val in records):
+        return "no control points"
+    return iCOMTags.checkRecords(records)      # Types, ranges, text values and header/control point scope
+
+
+class IngestPipeline:
+
+    def __init__(self, outputDir, workers = 2, maxPending = 16, efsCache = None, onReady = None, tolerances = None):
+        self.outputDir = outputDir
+        self.efsCache = efsCache
+        self.tolerances = tolerances    # VMAT control point downsampling, None to convert verbatim
+        self.onReady = onReady          # Called with each ReadyPlan from a worker thread
+        self._pending = queue.Queue(maxPending)
+        self._lock = threading.Lock()
+        self._seenFiles = set()         # (path, mtime, size) already accepted
+        self._converting = set()        # SOPInstanceUIDs on a worker right now
+        self._converted = {}            # SOPInstanceUID -> ReadyPlan, kept after delivery
+        self._ready = []
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target = self._work, name = "Ingest-%s" % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, path, callback = None, block = False):
+        # Accept a DICOM file for conversion. Returns False if the watcher
+        # already accepted it or the pending queue is full (non-blocking submit).
+        # Submissions with a callback (from the GUI) are always accepted and
+        # reuse an earlier conversion of the same plan.
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        key = (os.path.abspath(path), st.st_mtime, st.st_size)
+        with self._lock:
+            if key in self._seenFiles and callback is None:
+                return False
+            self._seenFiles.add(key)
+        try:
+            self._pending.put((path, callback), block)
+        except queue.Full:
+            with self._lock:
+                self._seenFiles.discard(key)
+            return False
+        return True
+
+    def forget(self, folders, present):
+        # Drop the (path, mtime, size) entries of files in folders that are
+        # no longer there as they were. present maps each path found in
+        # folders to its (mtime, size).
+        folders = set(os.path.abspath(f) for f in folders)
+        with self._lock:
+            self._seenFiles = set(key for key in self._seenFiles
+                                  if os.path.dirname(key[0]) not in folders or present.get(key[0]) == key[1:])
+
+    def pendingCount(self):
+        return self._pending.qsize()
+
+    def ready(self):
+        with self._lock:
+            return tuple(self._ready)
+
+    def take(self, uid):
+        # Remove a plan from the ready list once it has been queued for delivery.
+        with self._lock:
+            for idx, plan in enumerate(self._ready):
+                if plan.uid == uid:
+                    return self._ready.pop(idx)
+        return None
+
+    def stop(self):
+        for t in self._workers:
+            self._pending.put(None)
+
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            path, callback = item
+            try:
+                plan = self.ingest(path)
+            except Exception as e:
+                logging.info("ERROR: Unable to ingest %s - %s" % (path, e))
+                plan = None
+            if plan is not None:
+                # A failing callback must not take the worker down with it
+                try:
+                    if callback:
+                        callback(plan)
+                    elif self.onReady:
+                        self.onReady(plan)
+                except Exception as e:
+                    logging.info("ERROR: Unable to queue %s - %s" % (path, e))
+
+    def ingest(self, path):
+        # Convert and validate one plan. Runs on a worker thread.
+        if not isDicom(path):
+            return None
+        info = readPlan(path)
+        if info is None:
+            return None
+        meta, beams = info
+        uid = meta['uid']
+        with self._lock:
+            if uid in self._converted:
+                return self._converted[uid]
+            if uid in self._converting:
+                logging.info("Skipping duplicate plan %s (%s)" % (meta['plan_label'], os.path.basename(path)))
+                return None
+            self._converting.add(uid)
+        try:
+            plan = self._convert(path, meta)
+        finally:
+            with self._lock:
+                self._converting.discard(uid)
+        if plan is not None:
+            with self._lock:
+                self._converted[uid] = plan
+                self._ready.append(plan)
+            logging.info("Plan ready: %s %s (%s fields)" % (plan.patient_id, plan.plan_label, len(plan.fields)))
+        return plan
+
+    def _convert(self, path, meta):
+        uid = meta['uid']
+        outDir = os.path.join(self.outputDir, uid)
+        if not os.path.isdir(outDir):
+            os.makedirs(outDir)
+        reports = []
+        efsFiles = dcm2efs.convert_dcm2efs(path, outDir, self.tolerances, reports)
+        for r in reports:
+            logging.info("Downsampled %s: %s -> %s control points (max error MLC %.2f mm, gantry %.2f deg, meterset %.2f%%)"
+                         % (r.beam, r.cp_before, r.cp_after, r.max_error['mlc'], r.max_error['gantry'], r.max_error['meterset']))
+        if not efsFiles:
+            logging.info("ERROR: Conversion failed for %s" % path)
+            return None
+        fields = []
+        for efsFile in efsFiles:
+            records = self.efsCache.get(efsFile) if self.efsCache else parseEFS(efsFile)
+            error = validateEFS(records)
+            if error:
+                logging.info("ERROR: %s failed validation - %s" % (os.path.basename(efsFile), error))
+                return None
+            name = "%s - %s" % (meta['plan_label'], os.path.splitext(os.path.basename(efsFile))[0])
+            fields.append(compileBeam({'name': name, 'filename': efsFile}, self.efsCache))
+        return ReadyPlan(uid = uid, source = path, patient_id = meta['patient_id'],
+                         plan_label = meta['plan_label'], techniques = meta['techniques'],
+                         fields = tuple(fields))
+
+
+class HotFolderWatcher(threading.Thread):
+    # Polls folders and submits files whose size has been stable for one
+    # interval, so half-written TPS exports are never picked up.
+
+    def __init__(self, folders, pipeline, interval = 5):
+        super(HotFolderWatcher, self).__init__()
+        self.daemon = True
+        self.folders = folders
+        self.pipeline = pipeline
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._sizes = {}                # path -> (mtime, size) at the previous poll
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            self._stop_event.wait(self.interval)
+
+    def poll(self):
+        sizes = {}
+        listed = []
+        for folder in self.folders:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue                    # Share down - keep what was seen there
+            listed.append(folder)
+            for name in names:
+                path = os.path.abspath(os.path.join(folder, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if not os.path.isfile(path):
+                    continue
+                sizes[path] = (st.st_mtime, st.st_size)
+                if self._sizes.get(path) == sizes[path]:
+                    self.pipeline.submit(path)      # Full queue - retried next poll
+        self._sizes = sizes
+        self.pipeline.forget(listed, sizes)
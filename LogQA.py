@@ -0,0 +1,369 @@
+"""
+#
+#  LogQA - Delivered vs planned trajectory comparison for each field
+#
+#  While the beam is on, VxThread reads the gantry, jaw and leaf positions
+#  and the MU delivered so far from every VX message into a
+#  DeliveryRecorder. When the field terminates, compare() lines the
+#  samples up with the planned control points of the field's EFS records
+#  by cumulative MU: every axis's planned position is interpolated at each
+#  sample's MU, and the deviations are summarised per leaf, jaw and gantry
+#  as RMS and maximum.
+#
+#  NumPy is used if it is installed, which makes comparing a full VMAT arc
+#  a matter of milliseconds. Without it the same results are worked out in
+#  pure Python, which is slower but still well within the end of a field
+#  for the VX message rates a linac sends.
+#
+#  Run directly to benchmark compare().
+#
+"""
+
+import math
+import array
+import bisect
+import threading
+import collections
+import iCOMTags
+from iCOMTags import TAG_MU, TAG_GANTRY, TAG_METERSET
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TAG_DELIVERED_MU = TAG_MU       # VX messages report the MU delivered so far in the MU tag
+
+GANTRY_TAGS = (TAG_GANTRY,)
+JAW_TAGS = (0x50010009, 0x5001000a, 0x5001000b, 0x5001000c)
+LEAF_TAGS = (tuple(iCOMTags.leafTag(1, leaf) for leaf in range(1, iCOMTags.LEAVES + 1)) +
+             tuple(iCOMTags.leafTag(2, leaf) for leaf in range(1, iCOMTags.LEAVES + 1)))
+AXIS_TAGS = GANTRY_TAGS + JAW_TAGS + LEAF_TAGS
+SAMPLE_TAGS = (TAG_DELIVERED_MU,) + AXIS_TAGS      # Read from every VX message while the beam is on
+
+# Axis groups the deviations are summarised over, with their unit
+GROUPS = (('gantry', GANTRY_TAGS, "deg"), ('jaws', JAW_TAGS, "cm"), ('leaves', LEAF_TAGS, "cm"))
+
+# Largest deviation allowed per group
+DEFAULT_TOLERANCES = {'gantry': 1.0, 'jaws': 0.2, 'leaves': 0.2}
+
+BEAM_STATES = range(4, 13)      # SEGMENT START .. TERMINATE CHECKING
+FIELD_TERMINATED = 13
+
+# Planned axis positions per control point. mu is the cumulative planned MU,
+# positions has one row per control point and one column per tag, with
+# tags the linac carries forward filled in and the gantry unwrapped.
+Trajectory = collections.namedtuple("Trajectory", ["mu", "tags", "positions"])
+
+AxisDeviation = collections.namedtuple("AxisDeviation", ["tag", "name", "rms", "max", "samples"])
+# worst is the name of the axis with the largest deviation in the group
+GroupDeviation = collections.namedtuple("GroupDeviation", ["rms", "max", "worst", "unit"])
+# samples compared, MU delivered at the last one, deviations per axis and per group name
+Comparison = collections.namedtuple("Comparison", ["samples", "mu", "axes", "groups"])
+
+NAN = float('nan')
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return NAN
+
+
+def plannedTrajectory(records, tags = AXIS_TAGS):
+    # Trajectory of an EFS field's (tag, cp, value) records, or None if it
+    # has no MU or no control points with a meterset.
+    total = NAN
+    cps = {}
+    for tag, cp, val in records:
+        if cp == 0:
+            if tag == TAG_MU:
+                total = _number(val)
+        else:
+            cps.setdefault(cp, {})[tag] = val
+    if not total > 0 or not cps:
+        return None
+    seen = set()
+    for values in cps.values():
+        seen.update(values)
+    present = tuple(tag for tag in tags if tag in seen)
+    mu = []
+    rows = []
+    current = {}
+    for cp in sorted(cps):
+        current.update(cps[cp])                 # Tags left out are carried forward
+        meterset = _number(current.get(TAG_METERSET))
+        if meterset != meterset:
+            continue
+        mu.append(total * meterset / 100.0)
+        rows.append([_number(current.get(tag)) for tag in present])
+    if not rows:
+        return None
+    if TAG_GANTRY in present:
+        # Continuous through +-180, so an arc interpolates the short way
+        col = present.index(TAG_GANTRY)
+        offset = 0.0
+        prev = None
+        for row in rows:
+            if row[col] != row[col]:
+                continue
+            angle = row[col] + offset
+            if prev is not None:
+                if angle - prev > 180.0:
+                    offset -= 360.0
+                    angle -= 360.0
+                elif angle - prev < -180.0:
+                    offset += 360.0
+                    angle += 360.0
+            row[col] = prev = angle
+    return Trajectory(tuple(mu), present, rows)
+
+
+class DeliveryRecorder:
+    # Samples of the field being delivered. FxThread calls startField() with
+    # each field it sends, and VxThread calls add() with the values of tags
+    # read from each VX message; at FIELD TERMINATED the field and its
+    # samples are set aside for take(). Samples are kept flat in an array of
+    # doubles, one row of len(tags) per message, which NumPy uses without
+    # copying.
+
+    def __init__(self, tags = SAMPLE_TAGS, maxSamples = 100000):
+        self.tags = tuple(tags)
+        self.maxSamples = maxSamples
+        self._lock = threading.Lock()
+        self._field = None
+        self._current = array.array('d')
+        self._finished = None
+
+    def startField(self, field):
+        # Samples from now on belong to field, whatever it is to the caller.
+        with self._lock:
+            self._field = field
+            self._current = array.array('d')
+
+    def add(self, state, values):
+        if state in BEAM_STATES:
+            if values is not None and len(self._current) < self.maxSamples * len(self.tags):
+                row = [_number(v) for v in values]
+                with self._lock:
+                    self._current.extend(row)
+        elif state == FIELD_TERMINATED and self._current:
+            with self._lock:
+                self._finished = (self._field, self._current)
+                self._current = array.array('d')
+
+    def take(self):
+        # (field, samples) of the last terminated field, each only once, or None.
+        with self._lock:
+            finished, self._finished = self._finished, None
+        return finished
+
+    def clear(self):
+        with self._lock:
+            self._field = None
+            self._finished = None
+            self._current = array.array('d')
+
+
+def _bracket(mu, m):
+    # (lo, hi, fraction) to interpolate the control points mu at m.
+    n = len(mu)
+    if n == 1:
+        return 0, 0, 0.0
+    hi = min(max(bisect.bisect_right(mu, m), 1), n - 1)
+    lo = hi - 1
+    span = mu[hi] - mu[lo]
+    frac = (m - mu[lo]) / span if span > 0 else 1.0
+    return lo, hi, min(max(frac, 0.0), 1.0)
+
+
+def plannedAt(trajectory, m):
+    # Planned position of every axis at cumulative MU m.
+    lo, hi, frac = _bracket(trajectory.mu, m)
+    a, b = trajectory.positions[lo], trajectory.positions[hi]
+    return [pa + frac * (pb - pa) for pa, pb in zip(a, b)]
+
+
+def _rows(samples, width):
+    # Sample rows of a recorder's flat array, or of a list of rows.
+    if isinstance(samples, array.array):
+        return (samples[i:i + width] for i in range(0, len(samples), width))
+    return samples
+
+
+def _deviationsNumpy(trajectory, samples, width, muCol, planCols, sampleCols, gantry):
+    # Sum of squares, max and count per axis, for every sample at once.
+    if isinstance(samples, array.array):
+        s = numpy.frombuffer(samples, dtype = float).reshape(-1, width)
+    else:
+        s = numpy.array(samples, dtype = float)
+    mu = s[:, muCol]
+    if numpy.isnan(mu).any():
+        s = s[~numpy.isnan(mu)]
+        mu = s[:, muCol]
+    if not len(mu):
+        return None
+    p = numpy.array(trajectory.positions, dtype = float)[:, planCols]
+    pm = numpy.array(trajectory.mu, dtype = float)
+    n = len(pm)
+    if n == 1:
+        planned = numpy.repeat(p, len(mu), axis = 0)
+    else:
+        hi = numpy.clip(numpy.searchsorted(pm, mu, 'right'), 1, n - 1)
+        lo = hi - 1
+        span = pm[hi] - pm[lo]
+        frac = numpy.where(span > 0, (mu - pm[lo]) / numpy.where(span > 0, span, 1.0), 1.0)
+        frac = numpy.clip(frac, 0.0, 1.0)
+        planned = p[lo] + frac[:, None] * (p[hi] - p[lo])
+    with numpy.errstate(invalid = 'ignore'):
+        dev = s[:, sampleCols] - planned
+        if gantry is not None:
+            dev[:, gantry] = (dev[:, gantry] + 180.0) % 360.0 - 180.0
+        valid = ~numpy.isnan(dev)
+        dev = numpy.where(valid, dev, 0.0)
+    return ((dev * dev).sum(axis = 0).tolist(), numpy.abs(dev).max(axis = 0).tolist(),
+            valid.sum(axis = 0).tolist(), len(mu), float(mu[-1]))
+
+
+def _deviationsPython(trajectory, samples, width, muCol, planCols, sampleCols, gantry):
+    k = len(planCols)
+    sums = [0.0] * k
+    maxs = [0.0] * k
+    counts = [0] * k
+    compared = 0
+    last = None
+    axes = list(zip(range(k), planCols, sampleCols))
+    for row in _rows(samples, width):
+        m = row[muCol]
+        if m != m:
+            continue
+        compared += 1
+        last = m
+        lo, hi, frac = _bracket(trajectory.mu, m)
+        a, b = trajectory.positions[lo], trajectory.positions[hi]
+        for j, pc, sc in axes:
+            d = row[sc] - (a[pc] + frac * (b[pc] - a[pc]))
+            if d != d:
+                continue
+            if j == gantry:
+                d = (d + 180.0) % 360.0 - 180.0
+            sums[j] += d * d
+            counts[j] += 1
+            if abs(d) > maxs[j]:
+                maxs[j] = abs(d)
+    if not compared:
+        return None
+    return sums, maxs, counts, compared, last
+
+
+def compare(trajectory, samples, sampleTags = SAMPLE_TAGS, vectorized = None):
+    # Comparison of recorded samples (a DeliveryRecorder's array, or rows of
+    # floats in sampleTags order) against a planned Trajectory, or None if
+    # nothing could be compared.
+    # vectorized = None uses NumPy if it is installed.
+    if trajectory is None or not samples:
+        return None
+    if vectorized is None:
+        vectorized = numpy is not None
+    sampleCol = dict((tag, i) for i, tag in enumerate(sampleTags))
+    if TAG_DELIVERED_MU not in sampleCol:
+        raise ValueError("Samples have no delivered MU")
+    axes = [tag for tag in trajectory.tags if tag in sampleCol]
+    planCols = [trajectory.tags.index(tag) for tag in axes]
+    sampleCols = [sampleCol[tag] for tag in axes]
+    gantry = axes.index(TAG_GANTRY) if TAG_GANTRY in axes else None
+    calc = _deviationsNumpy if vectorized else _deviationsPython
+    result = calc(trajectory, samples, len(sampleTags), sampleCol[TAG_DELIVERED_MU], planCols, sampleCols, gantry)
+    if result is None:
+        return None
+    sums, maxs, counts, compared, lastMU = result
+    deviations = tuple(AxisDeviation(tag, iCOMTags.tagName(tag), math.sqrt(sums[j] / counts[j]) if counts[j] else NAN,
+                                     maxs[j], counts[j])
+                       for j, tag in enumerate(axes))
+    groups = {}
+    for name, tags, unit in GROUPS:
+        members = [(j, tag) for j, tag in enumerate(axes) if tag in tags and counts[j]]
+        if not members:
+            continue
+        total = sum(counts[j] for j, tag in members)
+        worst = max(members, key = lambda member: maxs[member[0]])
+        groups[name] = GroupDeviation(math.sqrt(sum(sums[j] for j, tag in members) / total),
+                                      maxs[worst[0]], iCOMTags.tagName(worst[1]), unit)
+    return Comparison(compared, lastMU, deviations, groups)
+
+
+def failures(comparison, tolerances = DEFAULT_TOLERANCES):
+    # Groups whose largest deviation is over tolerance, as text.
+    out = []
+    for name, tags, unit in GROUPS:
+        group = comparison.groups.get(name)
+        limit = tolerances.get(name)
+        if group is not None and limit is not None and group.max > limit:
+            out.append("%s %.2f %s > %s %s (%s)" % (name, group.max, unit, limit, unit, group.worst))
+    return out
+
+
+def summary(comparison):
+    parts = ["%s samples to %.1f MU" % (comparison.samples, comparison.mu)]
+    for name, tags, unit in GROUPS:
+        group = comparison.groups.get(name)
+        if group is not None:
+            parts.append("%s max %.2f %s (%s), rms %.2f" % (name, group.max, unit, group.worst, group.rms))
+    return ", ".join(parts)
+
+
+def syntheticArc(controlPoints = 361, mu = 500.0):
+    # EFS records of a full VMAT arc with sliding leaves, for benchmarking.
+    records = [(TAG_MU, 0, str(mu))]
+    for cp in range(1, controlPoints + 1):
+        f = (cp - 1) / (controlPoints - 1.0)
+        angle = -179.9 + f * 359.8
+        records.append((TAG_GANTRY, cp, "%.1f" % angle))
+        for tag, val in zip(JAW_TAGS, (5.0, 5.0, 10.0, 10.0)):
+            records.append((tag, cp, str(val)))
+        for leaf in range(1, iCOMTags.LEAVES + 1):
+            records.append((iCOMTags.leafTag(1, leaf), cp, "%.2f" % (2 + math.sin(f * 6 + leaf / 10.0))))
+            records.append((iCOMTags.leafTag(2, leaf), cp, "%.2f" % (2 + math.sin(f * 5 + leaf / 7.0))))
+        records.append((TAG_METERSET, cp, "%.3f" % (100 * f)))
+    return records
+
+
+def syntheticSamples(trajectory, count = 5000, noise = 0.02, seed = 1):
+    # Recorder samples of a delivery that follows the plan to within noise.
+    import random
+    rng = random.Random(seed)
+    total = trajectory.mu[-1]
+    col = dict((tag, i) for i, tag in enumerate(trajectory.tags))
+    recorder = DeliveryRecorder()
+    for i in range(count):
+        m = total * i / (count - 1.0)
+        planned = plannedAt(trajectory, m)
+        row = [m]
+        for tag in AXIS_TAGS:
+            row.append(planned[col[tag]] + rng.gauss(0, noise) if tag in col else NAN)
+        recorder.add(BEAM_STATES[0], row)
+    recorder.add(FIELD_TERMINATED, None)
+    return recorder.take()[1]
+
+
+def benchmark(controlPoints = 361, count = 5000, repeats = 5):
+    # Best time in ms of plannedTrajectory + compare, per implementation.
+    import time
+    records = syntheticArc(controlPoints)
+    samples = syntheticSamples(plannedTrajectory(records), count)
+    results = []
+    for vectorized in ([True, False] if numpy is not None else [False]):
+        best = None
+        for i in range(repeats):
+            start = time.perf_counter()
+            result = compare(plannedTrajectory(records), samples, vectorized = vectorized)
+            elapsed = (time.perf_counter() - start) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        results.append(("numpy" if vectorized else "python", best, result))
+    return results
+
+
+if __name__ == "__main__":
+    for label, ms, result in benchmark():
+        print("%-6s %7.1f ms  %s" % (label, ms, summary(result)))
@@ -0,0 +1,273 @@
+"""
+#
+#  PlanIndex - Persistent SQLite index of RTPLAN folders for File Mode
+#
+#  A background PlanIndexer walks the configured DICOM folders, reads only
+#  plan-level metadata from each RTPLAN and stores it in a local SQLite
+#  database. Files are re-read only when their mtime or size changes, and
+#  plans are keyed by SOPInstanceUID so copies of the same plan are stored
+#  once. Finding a plan is then a query rather than a directory crawl.
+#
+#  The database lives in the user's local app data by default, as PyiCom
+#  itself is often run from a network share. WAL mode, which lets the GUI
+#  read while the indexer writes, does not work on network filesystems, so
+#  a database configured on one falls back to the default rollback journal.
+#
+"""
+
+import os
+import time
+import ctypes
+import sqlite3
+import tempfile
+import logging
+import threading
+import pydicom
+import DCM2EFS as dcm2efs
+
+DEFAULT_DB_PATH = os.path.join(os.environ.get('LOCALAPPDATA', tempfile.gettempdir()), "PyiCom", "planindex.db")
+DRIVE_REMOTE = 4                # GetDriveTypeW result for a mapped network drive
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,
+    mtime       REAL,
+    size        INTEGER,
+    uid         TEXT            -- NULL for files that are not RTPLANs
+);
+CREATE TABLE IF NOT EXISTS plans (
+    uid         TEXT PRIMARY KEY,
+    path        TEXT,
+    patient_id  TEXT,
+    patient_name TEXT,
+    plan_label  TEXT,
+    plan_name   TEXT,
+    machine     TEXT,
+    beam_count  INTEGER,
+    total_mu    REAL,
+    energies    TEXT,
+    techniques  TEXT,
+    cp_count    INTEGER,
+    indexed     REAL
+);
+CREATE TABLE IF NOT EXISTS beams (
+    uid         TEXT,
+    beam_number INTEGER,
+    name        TEXT,
+    energy      REAL,
+    mu          REAL,
+    technique   TEXT,
+    cp_count    INTEGER,
+    PRIMARY KEY (uid, beam_number)
+);
+CREATE INDEX IF NOT EXISTS plans_patient ON plans (patient_id);
+CREATE INDEX IF NOT EXISTS files_uid ON files (uid);
+"""
+
+
+def isLocalPath(path):
+    # False for UNC paths and mapped network drives on Windows. Other
+    # platforms are assumed local.
+    path = os.path.abspath(path)
+    if os.name != "nt":
+        return True
+    if path.startswith("\\\\"):
+        return False
+    drive = os.path.splitdrive(path)[0]
+    if not drive:
+        return True
+    return ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") != DRIVE_REMOTE
+
+
+def connect(dbPath):
+    folder = os.path.dirname(os.path.abspath(dbPath))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    con = sqlite3.connect(dbPath, timeout = 10)
+    if isLocalPath(dbPath):
+        con.execute("PRAGMA journal_mode=WAL")      # GUI reads while the indexer writes
+    else:
+        con.execute("PRAGMA journal_mode=DELETE")   # WAL needs shared memory, which network shares lack
+    con.executescript(SCHEMA)
+    return con
+
+
+def isDicom(path):
+    # Cheap check for the DICM preamble before handing the file to pydicom.
+    try:
+        with open(path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b"DICM"
+    except (IOError, OSError):
+        return False
+
+
+def readPlan(path):
+    # Returns (plan row dict, [beam row dicts]) or None if the file is not an RTPLAN.
+    ds = pydicom.dcmread(path, stop_before_pixels = True)
+    if getattr(ds, 'Modality', None) != "RTPLAN" or 'BeamSequence' not in ds:
+        return None
+    meterset = {}
+    if 'FractionGroupSequence' in ds:
+        for ref in ds.FractionGroupSequence[0].ReferencedBeamSequence:
+            if 'BeamMeterset' in ref:
+                meterset[int(ref.ReferencedBeamNumber)] = float(ref.BeamMeterset)
+    beams = []
+    for beam in ds.BeamSequence:
+        cps = beam.ControlPointSequence
+        beams.append({
+            'beam_number': int(beam.BeamNumber),
+            'name': str(getattr(beam, 'BeamName', "")),
+            'energy': float(cps[0].NominalBeamEnergy) if 'NominalBeamEnergy' in cps[0] else None,
+            'mu': meterset.get(int(beam.BeamNumber)),
+            'technique': dcm2efs.getFieldTech(beam),
+            'cp_count': len(cps),
+            'machine': str(getattr(beam, 'TreatmentMachineName', "")),
+        })
+    plan = {
+        'uid': str(ds.SOPInstanceUID),
+        'path': path,
+        'patient_id': str(getattr(ds, 'PatientID', "")),
+        'patient_name': str(getattr(ds, 'PatientName', "")),
+        'plan_label': str(getattr(ds, 'RTPlanLabel', "")),
+        'plan_name': str(getattr(ds, 'RTPlanName', "")),
+        'machine': ",".join(sorted(set(b['machine'] for b in beams if b['machine']))),
+        'beam_count': len(beams),
+        'total_mu': sum(b['mu'] or 0 for b in beams),
+        'energies': ",".join("%g" % e for e in sorted(set(b['energy'] for b in beams if b['energy'] is not None))),
+        'techniques': ",".join(sorted(set(b['technique'] for b in beams))),
+        'cp_count': sum(b['cp_count'] for b in beams),
+        'indexed': time.time(),
+    }
+    return plan, beams
+
+
+class PlanIndex:
+    # Query side of the index. Each thread should use its own PlanIndex.
+
+    def __init__(self, dbPath = DEFAULT_DB_PATH):
+        self.dbPath = dbPath
+        self.con = connect(dbPath)
+
+    def close(self):
+        self.con.close()
+
+    def search(self, text = "", technique = None, limit = 200):
+        # Plans whose patient ID, patient name or plan label/name contains text.
+        sql = "SELECT uid, path, patient_id, patient_name, plan_label, plan_name, machine, beam_count, total_mu, energies, techniques, cp_count FROM plans"
+        where, args = [], []
+        if text:
+            like = "%" + text + "%"
+            where.append("(patient_id LIKE ? OR patient_name LIKE ? OR plan_label LIKE ? OR plan_name LIKE ?)")
+            args.extend([like] * 4)
+        if technique:
+            where.append("techniques LIKE ?")
+            args.append("%" + technique + "%")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY indexed DESC LIMIT ?"
+        args.append(limit)
+        cols = ['uid', 'path', 'patient_id', 'patient_name', 'plan_label', 'plan_name', 'machine',
+                'beam_count', 'total_mu', 'energies', 'techniques', 'cp_count']
+        return [dict(zip(cols, row)) for row in self.con.execute(sql, args)]
+
+    def beams(self, uid):
+        cols = ['beam_number', 'name', 'energy', 'mu', 'technique', 'cp_count']
+        rows = self.con.execute("SELECT %s FROM beams WHERE uid = ? ORDER BY beam_number" % ", ".join(cols), (uid,))
+        return [dict(zip(cols, row)) for row in rows]
+
+    def count(self):
+        return self.con.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+
+
+class PlanIndexer(threading.Thread):
+    # Background scanner. Runs a pass over the folders every interval seconds
+    # and calls onUpdate(changedCount) after any pass that changed the index.
+
+    def __init__(self, folders, dbPath = DEFAULT_DB_PATH, interval = 60, onUpdate = None):
+        super(PlanIndexer, self).__init__()
+        self.daemon = True
+        self.folders = folders
+        self.dbPath = dbPath
+        self.interval = interval
+        self.onUpdate = onUpdate
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        con = connect(self.dbPath)
+        try:
+            while not self._stop_event.is_set():
+                changed = self.scan(con)
+                if changed and self.onUpdate:
+                    self.onUpdate(changed)
+                self._stop_event.wait(self.interval)
+        finally:
+            con.close()
+
+    def scan(self, con):
+        # One incremental pass. Returns the number of plans added, updated or removed.
+        known = dict((row[0], (row[1], row[2])) for row in con.execute("SELECT path, mtime, size FROM files"))
+        seen = set()
+        changed = 0
+        for folder in self.folders:
+            for root, dirs, files in os.walk(folder):
+                if self._stop_event.is_set():
+                    return changed
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    if known.get(path) == (st.st_mtime, st.st_size):
+                        continue
+                    changed += self.indexFile(con, path, st)
+        for path in set(known) - seen:
+            changed += self.removeFile(con, path)
+        con.commit()
+        return changed
+
+    def indexFile(self, con, path, st):
+        result = None
+        if isDicom(path):
+            try:
+                result = readPlan(path)
+            except Exception as e:
+                logging.info("ERROR: Unable to index %s - %s" % (path, e))
+        uid = result[0]['uid'] if result else None
+        old = con.execute("SELECT uid FROM files WHERE path = ?", (path,)).fetchone()
+        con.execute("INSERT OR REPLACE INTO files (path, mtime, size, uid) VALUES (?, ?, ?, ?)",
+                    (path, st.st_mtime, st.st_size, uid))
+        if old and old[0] and old[0] != uid:
+            self._dropPlanIfOrphaned(con, old[0])
+        if not result:
+            return 1 if old and old[0] else 0
+        plan, beams = result
+        cols = sorted(plan)
+        con.execute("INSERT OR REPLACE INTO plans (%s) VALUES (%s)" % (", ".join(cols), ", ".join("?" * len(cols))),
+                    [plan[c] for c in cols])
+        con.execute("DELETE FROM beams WHERE uid = ?", (uid,))
+        con.executemany("INSERT INTO beams (uid, beam_number, name, energy, mu, technique, cp_count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(uid, b['beam_number'], b['name'], b['energy'], b['mu'], b['technique'], b['cp_count']) for b in beams])
+        return 1
+
+    def removeFile(self, con, path):
+        row = con.execute("SELECT uid FROM files WHERE path = ?", (path,)).fetchone()
+        con.execute("DELETE FROM files WHERE path = ?", (path,))
+        if row and row[0]:
+            return self._dropPlanIfOrphaned(con, row[0])
+        return 0
+
+    def _dropPlanIfOrphaned(self, con, uid):
+        # A plan stays indexed while any file still holds its SOPInstanceUID.
+        other = con.execute("SELECT path FROM files WHERE uid = ? LIMIT 1", (uid,)).fetchone()
+        if other:
+            con.execute("UPDATE plans SET path = ? WHERE uid = ?", (other[0], uid))
+            return 0
+        con.execute("DELETE FROM plans WHERE uid = ?", (uid,))
+        con.execute("DELETE FROM beams WHERE uid = ?", (uid,))
+        return 1
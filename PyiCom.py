@@ -12,9 +12,10 @@
 
 import threading
 import logging
+import logging.handlers
+import collections
 import datetime
 import time
-import ctypes
 import os, sys
 import shutil
 import toml
@@ -23,7 +24,22 @@ from tkinter import ttk
 from tkinter import filedialog
 import tkinter.scrolledtext as ScrolledText
 import socket
+import queue
 import DCM2EFS as dcm2efs
+import iCOMBridge
+import iCOMTags
+from FieldQueue import FieldQueue, FieldSweep, fieldRuns
+from AssetCache import AssetCache
+from SessionJournal import SessionJournal
+from SequenceLibrary import SequenceLibrary, compileBeam, parseEFS
+from BeamVariants import BeamVariants, makeVariant
+from PlanIndex import PlanIndex, PlanIndexer, DEFAULT_DB_PATH as PLAN_INDEX_DB_PATH
+from HotFolder import IngestPipeline, HotFolderWatcher
+from ControlServer import ControlServer, RequestError
+import EventBus
+import LogQA
+import DeliveryOptimizer
+import SessionEstimator
 
 # --- iCOM Constants and Definitions ---
 
@@ -44,51 +60,7 @@ states = ("UNKNOWN/INVALID",        #  0
           "FIELD TERMINATED",       # 13
           "MOVE ONLY")              # 14
 
-# Map of iCOM transmission tags to human-readable names
-iCOM_Tags = {
-    "50010001": 'MUs',
-    "70010001": 'LINAC',
-    "70010002": 'Patient ID',
-    "70010003": 'Patient Name',
-    "70010004": 'Plan Name',
-    "70010005": 'Tx Name',
-    "70010007": 'Beam Name',
-    "70010006": 'Beam ID',
-    "70020005": 'Field Complexity',
-    "70020006": 'Leaf Width',
-    "50010002": 'Radiation Type',
-    "50010003": 'Energy',
-    "50010004": 'Wedge',
-    "50010007": 'Gantry Angle',
-    "5001000f": 'Accessory',
-    "50010019": 'Gantry Direction',
-    "50010008": 'Collimator Angle',
-    "500100bb": 'Collimator Direction',
-    "50010009": 'X1',
-    "5001000a": 'X2',
-    "5001000b": 'Y1',
-    "5001000c": 'Y2',
-    "70020004": 'Beam Meterset'
-    # Add more cases as needed
-}
-
-# Error codes returned from tag processing
-iCOM_TagErrors = {
-    "0" : 'OK',
-    "1": 'Not Supported',
-    "2": 'Under Specified',
-    "3": 'Over Specified',
-    "4": 'Outside Range',
-    "5": 'Inconsistency',
-    "6": 'Mismatch Text',
-    "7": 'Protocol Error',
-    "8": 'Not Ready',
-    "9": 'Wrong Machine',
-    "10": 'Checksum Error',
-    "11": 'Version Error',
-    "12": 'Not Licensed',
-    "-3": 'Invalid Message'
-}
+# Tag names, types and tag error codes are in the iCOMTags registry
 
 # Error codes from connection-level issues
 ICOM_RESULT_OK                  = 1;
@@ -116,29 +88,81 @@ EXTERNAL_SYSTEM_VERIFY_MODE     = 9;
 SERVICE_MODE                    = 10;
 UNKNOWN_MODE                    = -1;
 
+# Navigation commands posted from the GUI to the FX delivery thread
+CMD_NEXT                        = "next"
+CMD_PREV                        = "prev"
+CMD_REPEAT                      = "repeat"
+CMD_RESTART                     = "restart"
+
+# Logging pipeline - records are queued and written by a background listener
+LOG_FILE                        = "PyiCom.log"
+LOG_FORMAT                      = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_MAX_BYTES                   = 5 * 1024 * 1024   # Rotate PyiCom.log at 5 MB...
+LOG_BACKUPS                     = 5                 # ...keeping PyiCom.log.1 - .5
+LOG_QUEUE_SIZE                  = 10000             # Records beyond this are dropped, never blocking the caller
+LOG_GUI_LINES                   = 1000              # Lines kept in the log window
+LOG_GUI_INTERVAL_MS             = 100               # How often the log window is updated
+
+# Session journal. PYICOM_JOURNAL points it elsewhere, e.g. for Benchmarks.py
+JOURNAL_FILE                    = os.environ.get("PYICOM_JOURNAL", "session.journal")
+# Journal events recorded when waitForState reaches these states
+JOURNAL_STATE_EVENTS = {3: "confirmed", 5: "irradiated", 13: "terminated"}
+
+# Delivery progress of the current field, used to reconcile after a reconnect
+FIELD_PENDING                   = 0     # Not yet sent
+FIELD_SENT                      = 1     # Sent, beam not yet on
+FIELD_IRRADIATING               = 2     # Beam has started, not yet terminated
+FIELD_DELIVERED                 = 3     # FIELD TERMINATED reached
+
+# Reconnection with bounded exponential backoff (seconds)
+RECONNECT_ATTEMPTS              = 8
+RECONNECT_BASE_DELAY            = 1.0
+RECONNECT_MAX_DELAY             = 30.0
+HEALTH_CHECK_INTERVAL           = 1.0
+VX_SILENCE_LIMIT                = 2.0   # Seconds without a VX message before VX no longer counts as healthy
+
+# Console playlist
+PLAYLIST_LINES                  = 40    # Fields printed around the cursor
+PLAYLIST_BEFORE                 = 5     # ...of which before it
+
 ####
 #### Settings & Globals
 ####
 
-def getLongSeqName(seq):
-    return config['sequences'][seq]['name']
+# Local copies of config, sequence, EFS and icon files, so reads don't go over
+# the network share and keep working through brief outages
+assetCache = AssetCache()
+appConfig = toml.load(assetCache.localPath("config.txt"))
+conSettings = toml.load(assetCache.localPath("connections.txt"))  # Load saved LINAC connection data
 
-conSettings = toml.load("connections.txt")  # Load saved LINAC connection data
-config = toml.load("config.txt")            # Load sequence configuration
+# Compiled sequences from config.txt and sequences/*.toml, indexed by key, name and type.
+# Reloaded from the GUI whenever one of the files changes on disk.
+seqLibrary = SequenceLibrary("config.txt", "sequences", assets = assetCache)
+LIBRARY_POLL_MS = 2000
+ALL_FILTER = "All"      # Filter menu entry that disables the filter
 
-# Build initial sequence lists
-origSequences = list(config['sequences'])
-sequences = origSequences
-sequences.sort(key = getLongSeqName)
-sequencesNice = [getLongSeqName(x) for x in sequences]
+# Background RTPLAN index for File Mode
+planIndexSettings = appConfig.get('planindex', {})
+planIndexer = None
 
-# Categorize sequences by their 'type' field
-sequence_types = {}
-for key, val in config["sequences"].items():
-    seq_type = val.get("type", "Other")
-    if seq_type not in sequence_types:
-        sequence_types[seq_type] = []
-    sequence_types[seq_type].append(key)
+# Background DICOM conversion, fed by the hot folder watcher and File Mode
+hotFolderSettings = appConfig.get('hotfolder', {})
+dcm2efsSettings = appConfig.get('dcm2efs', {})
+ingestPipeline = IngestPipeline(hotFolderSettings.get('output', "converted"),
+                                workers = hotFolderSettings.get('workers', 2),
+                                maxPending = hotFolderSettings.get('maxpending', 16),
+                                efsCache = seqLibrary.efsCache,
+                                tolerances = dcm2efs.loadTolerances(dcm2efsSettings))
+hotFolderWatcher = None
+
+# Local control API for QA database / electrometer software, off unless enabled
+controlSettings = appConfig.get('control', {})
+controlServer = None
+
+# Delivered vs planned comparison of each field, from the VX messages
+logQASettings = appConfig.get('logqa', {})
+logQATolerances = dict((name, logQASettings.get(name, limit)) for name, limit in LogQA.DEFAULT_TOLERANCES.items())
+deliveryRecorder = LogQA.DeliveryRecorder() if logQASettings.get('enabled', False) else None
 
 # Setup connection defaults based on hostname
 hostname    = socket.gethostname()
@@ -152,94 +176,72 @@ except:
 
 # Global vars used throughout the app
 statesQueue = []  # Queue of state changes received from the LINAC
-statusvar = None  # Global status message displayed in GUI
-fldQueue = []     # Field execution queue
+class StatusText:
+    # Status line until the GUI replaces it with a Tk StringVar, e.g. when
+    # the FX/VX threads are driven headless by Benchmarks.py
+    def __init__(self):
+        self.text = ""
+    def set(self, text):
+        self.text = text
+    def get(self):
+        return self.text
+
+statusvar = StatusText()  # Global status message displayed in GUI
+sessionJournal = SessionJournal(JOURNAL_FILE)     # Crash-safe record of fldQueue and field progress
+eventBus = EventBus.EventBus()    # Delivery and state events for plugins and the control API
+
+def queueChanged(op, args):
+    # fldQueue observer, called under the queue lock
+    sessionJournal.queueChanged(op, args)
+    if op in ("extend", "insert"):
+        eventBus.publish(EventBus.FIELD_QUEUED, fields = len(args[-1]) if op == "extend" else 1)
+    elif op == "clear":
+        eventBus.publish(EventBus.QUEUE_CLEARED)
+
+fldQueue = FieldQueue(observer = queueChanged)  # Field execution queue, cursor is the current field
 fxThread = None   # FX thread for delivery control
 vxThread = None   # VX thread for monitoring
 guiObj = None
 
-# Load the DLL containing iCOM functions
+# Load the DLL containing iCOM functions - in-process on 32-bit Python, otherwise
+# through a 32-bit sidecar process (see iCOMBridge and the [icom] section of config.txt)
 dirname = os.path.dirname(sys.argv[0])
-os.system('cls' if os.name == 'nt' else 'clear')
-iCOM = ctypes.WinDLL(dirname + "iCOMClient.dll")
+iCOMSettings = appConfig.get('icom', {})
+iCOM = iCOMBridge.openBackend(iCOMSettings, dirname)
+elideTags = iCOMSettings.get('elide', False)    # Leave out control point tags the linac carries forward
 
 # Map machine IDs to LINAC site names
 linacMap = {
     "6480": "PO9"
 }
 
-####
-####  Ctypes Function Definitions
-####
-# Define Python bindings for all iCOM DLL calls
-# (iCOMConnect, iCOMSendMessage, iCOMDisconnect, etc.)
-# ...
-
-py_iCOMFXConnect = iCOM.iCOMFXConnect
-py_iCOMFXConnect.restype = ctypes.c_long
-py_iCOMFXConnect.argtypes = [ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
-
-py_iCOMVXConnect = iCOM.iCOMVXConnect
-py_iCOMVXConnect.restype = ctypes.c_long
-py_iCOMVXConnect.argtypes = [ctypes.c_char_p, ctypes.c_ulong]
-
-py_iComGetConnectionState = iCOM.iCOMGetConnectionState
-py_iComGetConnectionState.restype = ctypes.c_long
-py_iComGetConnectionState.argtypes = [ctypes.c_long]
-
-py_iCOMDisconnect = iCOM.iCOMDisconnect
-py_iCOMDisconnect.restype = ctypes.c_long
-py_iCOMDisconnect.argtypes = [ctypes.c_long]
-
-py_iCOMBeginMessage = iCOM.iCOMBeginMessage
-py_iCOMBeginMessage.restype = ctypes.c_long
-py_iCOMBeginMessage.argtypes = [ctypes.c_long]
-
-py_iCOMWaitForMessage = iCOM.iCOMWaitForMessage
-py_iCOMWaitForMessage.restype = ctypes.c_long
-py_iCOMWaitForMessage.argtypes = [ctypes.c_long, ctypes.c_ulong]
-
-py_iCOMDeleteMessage = iCOM.iCOMDeleteMessage
-py_iCOMDeleteMessage.restype = ctypes.c_long
-py_iCOMDeleteMessage.argtypes = [ctypes.c_long]
-
-py_iCOMSendMessage = iCOM.iCOMSendMessage
-py_iCOMSendMessage.restype = ctypes.c_long
-py_iCOMSendMessage.argtypes = [ctypes.c_long]
-
-py_iCOMGetErrorCode = iCOM.iCOMGetErrorCode
-py_iCOMGetErrorCode.restype = ctypes.c_short
-py_iCOMGetErrorCode.argtypes = [ctypes.c_long]
-
-py_iCOMGetErrorTag = iCOM.iCOMGetErrorTag
-py_iCOMGetErrorTag.restype = ctypes.c_long
-py_iCOMGetErrorTag.argtypes = [ctypes.c_long, ctypes.POINTER(ctypes.c_ulong)]
-
-py_iCOMGetState = iCOM.iCOMGetState
-py_iCOMGetState.restype = ctypes.c_short
-py_iCOMGetState.argtypes = [ctypes.c_long]
-
-#ICOMResult	    __stdcall iCOMGetTagValue       (ICOMMsgHandle messageHandle, ICOM_TAG tag, const char part, char* value);
-py_iCOMGetTagValue = iCOM.iCOMGetTagValue
-py_iCOMGetTagValue.restype = ctypes.c_long
-py_iCOMGetTagValue.argtypes = [ctypes.c_long, ctypes.c_ulong, ctypes.c_char, ctypes.c_char_p]
-
-py_iCOMInsertTagVal = iCOM.iCOMInsertTagVal
-py_iCOMInsertTagVal.restype = ctypes.c_long
-py_iCOMInsertTagVal.argtypes = [ctypes.c_long, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_ushort]
-
-py_iCOMSendCancel = iCOM.iCOMSendCancel
-py_iCOMSendCancel.restype = ctypes.c_long
-py_iCOMSendCancel.argtypes = [ctypes.c_long]
-
-py_iCOMSendConfirmEx = iCOM.iCOMSendConfirmEx
-py_iCOMSendConfirmEx.restype = ctypes.c_long
-py_iCOMSendConfirmEx.argtypes = [ctypes.c_long, ctypes.c_int]
+# Personalised tag records per beam and linac, built when the FX link connects
+beamVariants = BeamVariants(linacMap, elide = elideTags)
 
 
 def cls():
     os.system('cls' if os.name=='nt' else 'clear')
 
+def stateName(state):
+    return states[state] if state is not None and 0 <= state < len(states) else None
+
+def reconnectWithBackoff(name, connect, stopEvent):
+    # Calls connect() until it returns a handle > 0, doubling the delay between
+    # attempts. Returns the handle, or None if attempts ran out or stop was requested.
+    delay = RECONNECT_BASE_DELAY
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+        logging.info(ts + "%s reconnecting (attempt %s/%s)..." % (name, attempt, RECONNECT_ATTEMPTS))
+        handle = connect()
+        if handle > 0:
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "%s Connection Re-established. Code %s" % (name, handle))
+            return handle
+        if stopEvent.wait(delay):
+            return None
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    return None
+
 
 ####
 #### Classes
@@ -260,91 +262,226 @@ class FxThread(threading.Thread):
         self._stop_event = threading.Event()
         self.fxHandle = None
         self.connected = False
-        self.fldIndex = 0
         self.playing = False
         self.lastState = None
+        self.fieldProgress = FIELD_PENDING  # How far the current field got
+        self.vxDropsAtSend = None           # vxThread.linkDrops when the current field was sent
+        self.linkLost = False               # Set when a health check fails
+        self.lastHealthCheck = 0
+        self.lastPrinted = None             # (queue version, playing) of the last printed playlist
+        self.showPlaylist = True            # Print the playlist to the console
+        self.cmdQueue = queue.Queue()       # Navigation commands from the GUI
+        self.cmdEvent = threading.Event()   # Set while a command is pending, wakes waitForState
     
     def startPlaying(self):
         self.playing = True
     
     def stopPlaying(self):
         self.playing = False
+    
+    def postCommand(self, cmd):
+        # Called from the Tk thread - never blocks, the FX thread applies it.
+        self.cmdQueue.put(cmd)
+        self.cmdEvent.set()
+    
+    def commandPending(self):
+        return self.cmdEvent.is_set()
+    
+    def applyCommands(self):
+        # Drain pending navigation commands on the FX thread so the queue
+        # cursor only moves here. Returns True if the cursor was changed.
+        self.cmdEvent.clear()
+        applied = False
+        while True:
+            try:
+                cmd = self.cmdQueue.get_nowait()
+            except queue.Empty:
+                break
+            if not applied and self.connected:
+                self.cancelBeam()
+                self.cancelBeam()
+            if cmd == CMD_NEXT:
+                fldQueue.advance(1)
+            elif cmd == CMD_PREV:
+                fldQueue.advance(-1)
+            elif cmd == CMD_RESTART:
+                fldQueue.seek(0)
+            # CMD_REPEAT leaves the index where it is
+            applied = True
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "Command '%s' applied - Field %s/%s" % (cmd, fldQueue.cursor+1, len(fldQueue)))
+            statusvar.set("Command '%s' applied" % cmd)
+        return applied
         
     
     def printPlaylist(self):
+        if not self.showPlaylist:
+            return
+        version, cursor, fields = fldQueue.snapshot()
+        if self.lastPrinted == (version, self.playing):
+            return                          # Nothing changed since the last print
+        self.lastPrinted = (version, self.playing)
         cls()
         if self.playing:
             print("Playing\n\n")
         else:
             print("Waiting\n\n")
         
-        for idx, fld in enumerate(fldQueue):
-            if idx == self.fldIndex:
-                print(">\t%s" % fld['name'])
+        # Only the fields around the cursor - a sweep can queue thousands
+        start = max(0, cursor - PLAYLIST_BEFORE)
+        end = min(len(fields), start + PLAYLIST_LINES)
+        if start:
+            print("\t ... %s delivered" % start)
+        for idx in range(start, end):
+            if idx == cursor:
+                print(">\t%s" % fields[idx].name)
             else:
-                print("\t %s" % fld['name'])
+                print("\t %s" % fields[idx].name)
+        if end < len(fields):
+            print("\t ... %s more" % (len(fields) - end))
     
     def run(self):
         global statusvar
         statusvar.set("Connecting...")
         ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
         logging.info(ts + "FX connecting to Linac %s on %s..." % (self.linacName, self.ip))
-        self.fxHandle = py_iCOMFXConnect(self.ip.encode('utf-8'), 1000, self.linacName.encode('utf-8'))
-        global fldQueue
+        self.fxHandle = iCOM.fxConnect(self.ip, 1000, self.linacName)
         global guiObj
         if self.fxHandle > 0:
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "FX Connection Established. Code %s" % self.fxHandle)
             self.connected = True
             statusvar.set("Connected")
-            guiObj.playButton.config(state = tk.NORMAL)
+            if guiObj is not None:
+                guiObj.playButton.config(state = tk.NORMAL)
+            eventBus.publish(EventBus.CONNECTED, link = "FX", linac = self.linacName, handle = self.fxHandle)
         else:
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "Unable to Establish FX Connection. Code %s" % self.fxHandle)
             self.connected = False
             self.fxHandle = None
             statusvar.set("Connection Failed")
-            guiObj.playButton.config(state = tk.NORMAL)
+            if guiObj is not None:
+                guiObj.playButton.config(state = tk.NORMAL)
             return
+        start = time.time()
+        built = beamVariants.prepare(fldQueue.snapshot()[2].distinct(), self.linacName)
+        if built:
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "Prepared %s fields for %s in %.0f ms" % (built, self.linacName, (time.time() - start) * 1000))
         while self.connected:
             self.printPlaylist()
-            if not self.playing:
+            if self.commandPending():
+                self.applyCommands()
+            elif not self.playing:
                 statusvar.set("Connected - Waiting for Fields")
-                time.sleep(0.5)
+                self.cmdEvent.wait(0.5)
+                if not self.linkHealthy() and not self.recover(None, None):
+                    break
             else:
-                if self.fldIndex >= len(fldQueue):    # Reached the end of the Queue, reset.
-                    fldQueue = []
-                    self.fldIndex = 0
+                fldIndex, fldCount, fld = fldQueue.position()
+                if fld is None:                         # Reached the end of the Queue, reset.
+                    if not fldQueue.resetIfDone():
+                        continue
+                    eventBus.publish(EventBus.SEQUENCE_DONE, fields = fldCount)
+                    self.cmdEvent.wait(0.5)
                 else: 
-                    fld = fldQueue[self.fldIndex]
                     if self.connected:
-                        mu = None
-                        try: 
-                            mu = fld['mu']
-                        except:
-                            pass
-                        dr = None
-                        try: 
-                            dr = fld['dr']
-                        except:
-                            pass
-                        ptid = None
-                        try: 
-                            ptid = fld['ptid']
-                        except:
-                            pass
-                        ptname = None
-                        try: 
-                            ptname = fld['ptname']
-                        except:
-                            pass
                         ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
-                        logging.info(ts + "Field %s/%s - %s" % (self.fldIndex+1, len(fldQueue), fld['name']))
-                        beam = Beam(self.fxHandle, fld['filename'], mu, dr, ptid, ptname)
+                        logging.info(ts + "Field %s/%s - %s" % (fldIndex+1, fldCount, fld.name))
+                        eventBus.publish(EventBus.FIELD_STARTED, index = fldIndex, count = fldCount, name = fld.name)
+                        beam = Beam(self.fxHandle, fld.filename, fld.mu, fld.dr, fld.ptid, fld.ptname,
+                                    variant = beamVariants.get(fld, self.linacName))
+                        if deliveryRecorder is not None:
+                            deliveryRecorder.startField(fld)
                         self.sendBeam(beam)
                     else:
                         break
-                    self.fldIndex = self.fldIndex + 1
+                    if self.linkLost:
+                        if not self.recover(fldIndex, fld):
+                            break
+                    elif self.fieldProgress == FIELD_PENDING and not self.playing:
+                        pass                            # Send failed - stay on the field so Play retries it
+                    elif not self.applyCommands():
+                        fldQueue.advance()
+    
+    def connect(self):
+        return iCOM.fxConnect(self.ip, 1000, self.linacName)
+    
+    def linkHealthy(self):
+        # Rate limited connection check, run while idle and while waiting for states.
+        now = time.time()
+        if now - self.lastHealthCheck < HEALTH_CHECK_INTERVAL:
+            return True
+        self.lastHealthCheck = now
+        connectionState = iCOM.connectionState(self.fxHandle)
+        if connectionState <= 0:
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "ERROR: Connection lost. Code %s" % connectionState)
+            self.linkLost = True
+            return False
+        return True
+    
+    def noteState(self, state):
+        # Track the current field's progress from a VX state.
+        if state == 13:
+            self.fieldProgress = FIELD_DELIVERED
+        elif 4 <= state <= 12 and self.fieldProgress == FIELD_SENT:
+            self.fieldProgress = FIELD_IRRADIATING
+    
+    def vxHealthyThroughout(self):
+        # True if VX has reported every state since the current field was sent:
+        # no VX link drop since then, and messages still arriving.
+        vx = vxThread
+        return (vx is not None and vx.connected and self.vxDropsAtSend is not None
+                and vx.linkDrops == self.vxDropsAtSend and time.time() - vx.lastMessage < VX_SILENCE_LIMIT)
+    
+    def recover(self, fldIndex, fld):
+        # Reconnect and reconcile the field that was in progress (None while
+        # idle), so that a delivered field is never sent again and a partial
+        # one is never silently repeated. Returns False if the link could not
+        # be restored.
+        global statesQueue
+        statusvar.set("Connection lost - Reconnecting...")
+        vxHealthy = self.vxHealthyThroughout()      # Judged at the drop, before the reconnect wait
+        for state in list(statesQueue):
+            self.noteState(state)                   # States VX reported that were not yet processed
+        iCOM.disconnect(self.fxHandle)
+        handle = reconnectWithBackoff("FX", self.connect, self._stop_event)
+        if handle is None:
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            if fld is not None:
+                logging.info(ts + "ERROR: Unable to reconnect. Field %s/%s - %s not confirmed." % (fldIndex+1, len(fldQueue), fld.name))
+            else:
+                logging.info(ts + "ERROR: Unable to reconnect.")
+            self.connected = False
+            self.fxHandle = None
+            statusvar.set("Connection Lost")
+            eventBus.publish(EventBus.DISCONNECTED, link = "FX", linac = self.linacName)
+            return False
+        self.fxHandle = handle
+        eventBus.publish(EventBus.CONNECTED, link = "FX", linac = self.linacName, handle = handle)
+        self.linkLost = False
+        self.lastState = None
+        del statesQueue[:]
+        ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+        if fld is None:
+            return True                             # Idle - nothing to reconcile
+        if self.fieldProgress == FIELD_DELIVERED:
+            logging.info(ts + "Field %s - %s was delivered before the link dropped, moving on." % (fldIndex+1, fld.name))
+            fldQueue.advance()
+        elif self.fieldProgress == FIELD_IRRADIATING:
+            # Partially delivered - a human has to decide whether to repeat it
+            logging.info(ts + "WARNING: Field %s - %s was interrupted during irradiation. Check the delivered MU, then Play to repeat it or Next to skip." % (fldIndex+1, fld.name))
+            self.stopPlaying()
+        elif self.fieldProgress == FIELD_SENT and not vxHealthy:
+            # VX may have missed the beam starting - treat it as possibly irradiated
+            logging.info(ts + "WARNING: Field %s - %s was sent, and the VX link was not healthy throughout, so it may have been irradiated. Check the delivered MU, then Play to repeat it or Next to skip." % (fldIndex+1, fld.name))
+            self.stopPlaying()
+        else:
+            logging.info(ts + "Field %s - %s was not irradiated, resending." % (fldIndex+1, fld.name))
+        self.applyCommands()
+        return True
     
     def waitForState(self, targetState):
         global statesQueue
@@ -352,35 +489,59 @@ class FxThread(threading.Thread):
         ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
         #logging.info(ts + "Waiting for State: %s (%s)" % (targetState, states[targetState]))
         statusvar.set("Waiting for: %s" % (states[targetState]))
-        while (self.connected) and (self.lastState != targetState):
-            #print("DEBUG - WFS: %s (%s) - Playing: %s - Fld %s/%s" % (targetState, statesQueue, self.playing, self.fldIndex, len(fldQueue)))
+        while (self.connected) and (self.lastState != targetState) and not self.commandPending() and not self.linkLost:
+            #print("DEBUG - WFS: %s (%s) - Playing: %s - Fld %s/%s" % (targetState, statesQueue, self.playing, fldQueue.cursor, len(fldQueue)))
             if (len(statesQueue) > 0):
                 self.lastState = statesQueue[0]
                 statesQueue.pop(0)
+                self.noteState(self.lastState)
                 if self.playing:
                     if (targetState == 2) and (self.lastState == 2):
-                        iResult = py_iCOMSendConfirmEx(self.fxHandle, 1);
+                        iResult = iCOM.sendConfirm(self.fxHandle, 1);
                 else:
                     statusvar.set("Waiting for: %s - Currently: %s" % (states[targetState], states[self.lastState]))
             else:
                 if (self.playing):
-                    time.sleep(0.5)
+                    if not self.linkHealthy():
+                        break
+                    self.cmdEvent.wait(0.5)     # Returns at once if a command is posted
                 else:
                     break
+        if self.lastState == targetState:
+            # Timestamps of reached states feed the SessionEstimator overheads
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "State: %s" % states[targetState])
+            if targetState in JOURNAL_STATE_EVENTS:
+                sessionJournal.fieldEvent(fldQueue.cursor, JOURNAL_STATE_EVENTS[targetState])
+            if targetState == 13:
+                fldIndex, fldCount, fld = fldQueue.position()
+                eventBus.publish(EventBus.FIELD_TERMINATED, index = fldIndex, name = fld.name if fld else None)
     
     def cancelBeam(self):
-        py_iCOMSendCancel(self.fxHandle);
+        iCOM.sendCancel(self.fxHandle);
     
     def sendBeam(self, beam):
         if self.connected:
-            connectionState = py_iComGetConnectionState(self.fxHandle)
+            self.fieldProgress = FIELD_PENDING
+            connectionState = iCOM.connectionState(self.fxHandle)
             if connectionState > 0:
                 global statesQueue
-                py_iCOMSendCancel(self.fxHandle);
+                iCOM.sendCancel(self.fxHandle);
                 self.waitForState(1);                                # PREPARATORY
-                beam.send()                
+                if self.commandPending() or self.linkLost:           # Navigated away before sending
+                    return
+                self.vxDropsAtSend = vxThread.linkDrops if vxThread is not None else None
+                if not beam.send():
+                    # Nothing reached the linac - stop rather than wait for states that never come
+                    fldIndex, fldCount, fld = fldQueue.position()
+                    ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+                    logging.info(ts + "ERROR: Field %s/%s - %s could not be sent. Code %s" % (fldIndex+1, fldCount, fld.name, beam.response))
+                    self.stopPlaying()
+                    return
+                self.fieldProgress = FIELD_SENT
+                sessionJournal.fieldEvent(fldQueue.cursor, "sent")
                 for state in [2, 3, 5, 13]:
-                    if self.playing and self.connected:
+                    if self.playing and self.connected and not self.commandPending() and not self.linkLost:
                         self.waitForState(state);
                     else:
                         #print("breaking out of Send Beam WFS loop")
@@ -388,17 +549,19 @@ class FxThread(threading.Thread):
             else:
                 ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
                 logging.info(ts + "ERROR: Connection lost. Code %s" % connectionState)
-                self.connected = False
+                self.linkLost = True
     
     def stop(self):
+        self._stop_event.set()
         if self.connected:
             global statusvar
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "Closing FX Connection.")
-            py_iCOMDisconnect(self.fxHandle);
+            iCOM.disconnect(self.fxHandle);
             statusvar.set("Disconnected")
             self.fxHandle = None
             self.connected = False
+            eventBus.publish(EventBus.DISCONNECTED, link = "FX", linac = self.linacName)
 
 class VxThread(threading.Thread):
     
@@ -410,16 +573,23 @@ class VxThread(threading.Thread):
         self.connected = False
         self.lastState = None
         self.currentState = None
+        self.lastHealthCheck = 0
+        self.linkDrops = 0              # Times the link was found lost, so FX can tell if VX missed states
+        self.lastMessage = 0            # Time the last VX message arrived
+    
+    def connect(self):
+        return iCOM.vxConnect(self.ip, 10000)
     
     def run(self):
         global statesQueue
         ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
         logging.info(ts + "VX connecting to %s..." % self.ip)
-        self.vxHandle = py_iCOMVXConnect(self.ip.encode('utf-8'), 10000)
+        self.vxHandle = self.connect()
         if self.vxHandle > 0:
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "VX Connection Established. Code %s" % self.vxHandle)
             self.connected = True
+            eventBus.publish(EventBus.CONNECTED, link = "VX", linac = None, handle = self.vxHandle)
         else:
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "Unable to Establish VX Connection. Code %s" % self.vxHandle)
@@ -427,46 +597,88 @@ class VxThread(threading.Thread):
             self.vxHandle = None
             return
         while self.connected:
-            vxMsg = py_iCOMWaitForMessage(self.vxHandle, 10);
+            if deliveryRecorder is not None:
+                # Wait, read the state - and the sample tags while the beam is on - and delete in one call
+                vxMsg, state, values = iCOM.pollSample(self.vxHandle, 10, deliveryRecorder.tags, LogQA.BEAM_STATES)
+                if vxMsg > 0:
+                    deliveryRecorder.add(state, values)     # Before FX can see FIELD TERMINATED
+            else:
+                vxMsg, state = iCOM.pollState(self.vxHandle, 10)     # Wait, read and delete in one call
             if vxMsg > 0:   
                 # Message Received, process it
-                self.currentState = py_iCOMGetState(vxMsg)
+                self.lastMessage = time.time()
+                self.currentState = state
                 if self.currentState != INVALID_MESSAGE_HANDLE:
                     #print("Lat: %s\tLng: %s\tHgt: %s\t" % (self.getVal(vxMsg, int("50010012",16)), self.getVal(vxMsg, int("50010013",16)), self.getVal(vxMsg, int("50010010",16))))
                     if self.currentState != self.lastState:
                         ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
                         #logging.info(ts + "New VX State: %s (%s)" % (self.currentState, states[self.currentState]))
                         statesQueue.append(self.currentState)
+                        eventBus.publish(EventBus.STATE_CHANGED, state = self.currentState,
+                                         name = stateName(self.currentState), previous = self.lastState)
                 self.lastState = self.currentState
-            py_iCOMDeleteMessage(vxMsg)
+            if vxMsg <= 0 and self.connected and not self.linkHealthy():
+                self.recover()
+    
+    def linkHealthy(self):
+        now = time.time()
+        if now - self.lastHealthCheck < HEALTH_CHECK_INTERVAL:
+            return True
+        self.lastHealthCheck = now
+        connectionState = iCOM.connectionState(self.vxHandle)
+        if connectionState <= 0:
+            ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+            logging.info(ts + "ERROR: VX Connection lost. Code %s" % connectionState)
+            self.linkDrops += 1
+            return False
+        return True
+    
+    def recover(self):
+        iCOM.disconnect(self.vxHandle)
+        handle = reconnectWithBackoff("VX", self.connect, self._stop_event)
+        if handle is None:
+            self.connected = False
+            self.vxHandle = None
+            eventBus.publish(EventBus.DISCONNECTED, link = "VX", linac = None)
+            return
+        self.vxHandle = handle
+        eventBus.publish(EventBus.CONNECTED, link = "VX", linac = None, handle = handle)
+        self.lastState = None           # The next message re-reports the current state
     
     def getVal(self, vxMsg, tag):
-        val = ctypes.create_string_buffer(py_iCOMGetTagValue(vxMsg, tag, "R".encode(), None)) 
-        py_iCOMGetTagValue(vxMsg, tag, "R".encode(), val)
-        return val.value.decode("utf-8")
+        return iCOM.tagValue(vxMsg, tag)
     
     def getState(self):
         return self.currentState
     
     def stop(self):
+        self._stop_event.set()
         if self.connected:
             ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
             logging.info(ts + "Closing VX Connection.")
-            py_iCOMDisconnect(self.vxHandle);
+            iCOM.disconnect(self.vxHandle);
             self.vxHandle = None
             self.connected = False
+            eventBus.publish(EventBus.DISCONNECTED, link = "VX", linac = None)
 
 class Beam:
-    def __init__(self, fxCon, filename = None, ovrMU = None, ovrDR = None, ovrPtID = None, ovrPtName = None):
-        self.fxMsg = py_iCOMBeginMessage(fxCon);
+    def __init__(self, fxCon, filename = None, ovrMU = None, ovrDR = None, ovrPtID = None, ovrPtName = None, tags = None, variant = None):
+        self.fxCon = fxCon
+        self.filename = filename
+        self.tagCount = 0
+        self.fxMsg = iCOM.beginMessage(fxCon);
+        self.fullRecords = None     # Every tag, kept when the message is sent with tags elided
+        self.response = None        # Result of the last send
         #if self.fxMsg > 0:
             #print("FX Message Created. Code %s" % self.fxMsg)
         #else:
             #print("ERROR: Unable to create FX message. Code: %s" % self.fxMsg)
         
-        if filename:
+        if variant is not None:
+            self.loadVariant(variant)
+        elif filename:
             if filename.split(".")[-1].lower() == "efs":
-                self.loadEFS(filename, ovrMU, ovrDR, ovrPtID, ovrPtName)
+                self.loadEFS(filename, ovrMU, ovrDR, ovrPtID, ovrPtName, tags)
             elif filename.split(".")[-1].lower() == "dcm":
                 efs = dcm2efs.convert_dcm2efs(filename)
                 #print(efs)
@@ -475,80 +687,203 @@ class Beam:
             else:
                 logging.info("ERROR: Unknown File Type Supplied.")
     
-    def loadEFS(self, filename, ovrMU = None, ovrDR = None, ovrPtID = None, ovrPtName = None):
-        file = open(filename)
-        for line in file.readlines():
-            tag = int(line.split(" ", 1)[0].split("-")[0].split(",")[0] + line.split(" ", 1)[0].split("-")[0].split(",")[1].zfill(4), 16)
-            cp =  line.split(" ", 1)[0].split("-")[1]
-            
-            if tag == int("70010001",16):         # Machine Name Tag
-                val = linacName
-            elif ovrPtName != None and tag == int("70010003",16): # Patient Name Tag
-                if str(ovrPtName == "1QASNC"):
-                    val = str(ovrPtName + linacMap[linacName])
-                else: 
-                    val = str(ovrPtName)
-            elif ovrPtID != None and tag == int("70010002",16): # Patient ID Tag
-                if str(ovrPtID == "1QASNC"):
-                    val = str(ovrPtID + linacMap[linacName])
-                else: 
-                    val = str(ovrPtID)
-            elif ovrDR != None and tag == int("50010006",16): # Dose Rate Tag
-                val = str(ovrDR)
-            elif ovrMU != None and tag == int("50010001",16): # Beam Monitor Units Tag
-                val = str(ovrMU)
-            else:
-                val = line.split(" ", 1)[1].replace("\n", "")
-            
-            insertResult = py_iCOMInsertTagVal(self.fxMsg, tag, val.encode(), int(cp));
-            #if insertResult != ICOM_RESULT_OK:
-                #print("T: %s\tC: %s\tV: %s\tR: %s" % (hex(tag), cp, val.encode('utf-8'), insertResult))
-        file.close()
+    def loadEFS(self, filename, ovrMU = None, ovrDR = None, ovrPtID = None, ovrPtName = None, tags = None):
+        # One-off fields only - queued fields arrive as cached BeamVariants.
+        # tags are the pre-parsed (tag, cp, value) records from the sequence library
+        if tags is None:
+            tags = parseEFS(filename)
+        linac = fxThread.linacName if fxThread is not None else linacName      # The linac connected to, as for queued fields
+        self.loadVariant(makeVariant(tags, linac, linacMap.get(linac, ""),
+                                     ovrMU, ovrDR, ovrPtID, ovrPtName, elideTags))
+    
+    def loadVariant(self, variant):
+        records = variant.records
+        if variant.elided is not None:
+            self.fullRecords = records
+            records = variant.elided
+        # Every tag of the message in one call - one round trip through the sidecar
+        failed = iCOM.insertTags(self.fxMsg, records)
+        self.tagCount = len(records)
+        #for tag, cp, insertResult in failed:
+            #print("T: %s\tC: %s\tR: %s" % (hex(tag), cp, insertResult))
     
     def send(self):
-        response = py_iCOMSendMessage(self.fxMsg);
+        # Send, read any error reply and delete it in one call. Returns False
+        # if the message never reached the linac (negative response code).
+        response, errorCode, errorTag = iCOM.sendField(self.fxMsg)
+        self.response = response
+        eventBus.publish(EventBus.MESSAGE_SENT, filename = self.filename, tags = self.tagCount,
+                         response = response, errorCode = errorCode)
         if response > 0:
             #logging.info("Reply from Linac after sending field: %s" % response)
-            errorCode = py_iCOMGetErrorCode(response)
-            et = ctypes.c_ulong()
-            errorTagInst = ctypes.POINTER(ctypes.c_ulong)
-            errorTagPoint = errorTagInst()
-            iRes = py_iCOMGetErrorTag(response, ctypes.byref(et))
-            if (errorCode > 0) and (iRes == ICOM_RESULT_OK ):
-                logging.info("Recieved Error Code %s from Tag %s" % (errorCode, hex(et.value)))
-                try:
-                    logging.info("%s - %s" % (iCOM_Tags[str(hex(et.value))[2:]], iCOM_TagErrors[str(errorCode)]))
-                except:
-                    pass
-            
+            if (errorCode > 0) and (errorTag is not None):
+                logging.info("Recieved Error Code %s from Tag %s" % (errorCode, hex(errorTag)))
+                tagName, error = iCOMTags.decodeError(errorTag, errorCode)
+                if tagName and error:
+                    logging.info("%s - %s" % (tagName, error))
+                eventBus.publish(EventBus.TAG_ERROR, tag = errorTag, code = errorCode, tagName = tagName, error = error)
+            if (errorCode > 0) and (self.fullRecords is not None):
+                # Fall back to sending every tag in case the linac did not carry one forward
+                logging.info("Resending the field with every control point tag.")
+                self.fxMsg = iCOM.beginMessage(self.fxCon)
+                iCOM.insertTags(self.fxMsg, self.fullRecords)
+                self.tagCount = len(self.fullRecords)
+                self.fullRecords = None
+                return self.send()
+        elif response < 0:
+            return False
         else:
             logging.info("Beam Sent Successfully.")
-        py_iCOMDeleteMessage(response)
+        return True
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the logging thread - if the listener falls behind, records are counted and dropped.
+    def __init__(self, q):
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 class TextHandler(logging.Handler):
-    def __init__(self, text):
+    # Lines are collected here by the log listener and written to the widget
+    # in one batch per timer tick from the Tk thread. The widget is capped at
+    # LOG_GUI_LINES lines.
+    def __init__(self, text, maxLines = LOG_GUI_LINES):
         logging.Handler.__init__(self)
         self.text = text
+        self.maxLines = maxLines
+        self.pending = collections.deque(maxlen = maxLines)     # Older lines would be trimmed anyway
 
     def emit(self, record):
-        msg = self.format(record)
-        def append():
+        self.pending.append(self.format(record))
+
+    def flushToWidget(self):
+        lines = []
+        while self.pending:
+            lines.append(self.pending.popleft())
+        if lines:
             self.text.configure(state='normal')
-            self.text.insert(tk.END, msg + '\n')
+            self.text.insert(tk.END, "\n".join(lines) + '\n')
+            excess = int(self.text.index('end-1c').split('.')[0]) - 1 - self.maxLines
+            if excess > 0:
+                self.text.delete('1.0', '%s.0' % (excess + 1))
             self.text.configure(state='disabled')
             # Autoscroll to the bottom
             self.text.yview(tk.END)
-        # This is necessary because we can't modify the Text from other threads
-        self.text.after(0, append)
+        self.text.after(LOG_GUI_INTERVAL_MS, self.flushToWidget)
+
+logListener = None
+
+def setupLogging(text):
+    # Callers only enqueue records; a QueueListener thread writes them to the
+    # rotating log file and the GUI buffer.
+    global logListener
+    fileHandler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes = LOG_MAX_BYTES, backupCount = LOG_BACKUPS)
+    fileHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    textHandler = TextHandler(text)
+    logQueue = queue.Queue(LOG_QUEUE_SIZE)
+    logListener = logging.handlers.QueueListener(logQueue, fileHandler, textHandler)
+    logListener.start()
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(BoundedQueueHandler(logQueue))
+    textHandler.flushToWidget()
+
+class VirtualList(tk.Frame):
+    # Listbox that only ever holds the visible rows. The full item list lives
+    # in Python and the scrollbar is driven by hand, so setting thousands of
+    # items costs nothing more than the rows on screen.
+
+    def __init__(self, parent, rows = 8, width = 40, command = None, autoSelect = True, *args, **kwargs):
+        tk.Frame.__init__(self, parent, *args, **kwargs)
+        self.rows = rows
+        self.command = command          # Called with the selected item
+        self.autoSelect = autoSelect    # Select the first item whenever the items change
+        self.items = []
+        self.labels = []
+        self.top = 0
+        self.selected = None            # Index into items
+        self.listbox = tk.Listbox(self, height=rows, width=width, activestyle="none", exportselection=False)
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.listbox.pack(side=tk.LEFT, fill="both", expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.listbox.bind("<<ListboxSelect>>", self.onSelect)
+        self.listbox.bind("<MouseWheel>", self.onWheel)
+        self.listbox.bind("<Button-4>", lambda e: self.scrollTo(self.top - 1))
+        self.listbox.bind("<Button-5>", lambda e: self.scrollTo(self.top + 1))
+        for key, step in (("<Up>", -1), ("<Down>", 1), ("<Prior>", -rows), ("<Next>", rows)):
+            self.listbox.bind(key, lambda e, step=step: self.moveSelection(step))
+
+    def setItems(self, items, labels):
+        self.items = items
+        self.labels = labels
+        self.top = 0
+        self.selected = 0 if items and self.autoSelect else None
+        self.render()
+        if self.command and self.autoSelect:
+            self.command(self.items[0] if items else None)
+
+    def render(self):
+        self.listbox.delete(0, tk.END)
+        for label in self.labels[self.top:self.top + self.rows]:
+            self.listbox.insert(tk.END, label)
+        if self.selected is not None and self.top <= self.selected < self.top + self.rows:
+            self.listbox.selection_set(self.selected - self.top)
+        n = float(max(len(self.items), 1))
+        self.scrollbar.set(self.top / n, min((self.top + self.rows) / n, 1.0))
+
+    def scrollTo(self, top):
+        top = max(0, min(top, len(self.items) - self.rows))
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def yview(self, action, value, unit = None):
+        if action == tk.MOVETO:
+            self.scrollTo(int(float(value) * len(self.items)))
+        elif action == tk.SCROLL:
+            step = self.rows if unit == tk.PAGES else 1
+            self.scrollTo(self.top + int(value) * step)
+
+    def onWheel(self, event):
+        self.scrollTo(self.top - int(event.delta / 120) * 3)
+
+    def onSelect(self, event):
+        rows = self.listbox.curselection()
+        if rows:
+            self.selected = self.top + int(rows[0])
+            if self.command:
+                self.command(self.items[self.selected])
+
+    def moveSelection(self, step):
+        if not self.items:
+            return "break"
+        self.selected = max(0, min((self.selected or 0) + step, len(self.items) - 1))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + self.rows:
+            self.top = self.selected - self.rows + 1
+        self.render()
+        if self.command:
+            self.command(self.items[self.selected])
+        return "break"
 
 class GUI(tk.Frame):
     
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.root = parent
-        self.root.iconbitmap("linac.ico")
+        self.root.iconbitmap(assetCache.localPath("linac.ico"))
         self.selectedFile = None
+        self.planIndex = PlanIndex(planIndexSettings.get('database') or PLAN_INDEX_DB_PATH)
         self.build_gui()
+        self.root.after(LIBRARY_POLL_MS, self.pollLibrary)
+        self.startPlanIndexer()
+        self.startHotFolder()
         
     def build_gui(self):                    
         self.root.title('PyiCom')
@@ -593,27 +928,46 @@ class GUI(tk.Frame):
         self.sequenceGroup = tk.LabelFrame(self.sequenceFrame, text="Sequence Selection", padx=10, pady=10)
         self.sequenceGroup.pack(fill="x", expand=True)
 
-        tk.Label(self.sequenceGroup, text="Sequence Type").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        self.sequenceTypes = sorted(sequence_types.keys())
-        self.selectedType = tk.StringVar()
-        self.typeSelect = tk.OptionMenu(self.sequenceGroup, self.selectedType, *self.sequenceTypes, command=self.updateSequenceDropdown)
-        self.typeSelect.config(width=32)
-        self.typeSelect.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+        tk.Label(self.sequenceGroup, text="Search").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        self.searchText = tk.StringVar()
+        self.searchEntry = tk.Entry(self.sequenceGroup, textvariable=self.searchText)
+        self.searchEntry.grid(row=0, column=1, columnspan=5, padx=5, pady=5, sticky="ew")
+        self.searchText.trace("w", lambda *args: self.updateSequenceDropdown())
+
+        # Type / Energy / Linac filters, each with an "All" entry
+        self.selectedType = tk.StringVar(value=ALL_FILTER)
+        self.selectedEnergy = tk.StringVar(value=ALL_FILTER)
+        self.selectedLinac = tk.StringVar(value=ALL_FILTER)
+        self.filterMenus = {}
+        for col, (label, var) in enumerate((("Type", self.selectedType), ("Energy", self.selectedEnergy), ("Linac", self.selectedLinac))):
+            tk.Label(self.sequenceGroup, text=label).grid(row=1, column=col*2, padx=5, pady=5, sticky="w")
+            menu = tk.OptionMenu(self.sequenceGroup, var, ALL_FILTER, command=self.updateSequenceDropdown)
+            menu.config(width=10)
+            menu.grid(row=1, column=col*2+1, padx=5, pady=5, sticky="ew")
+            self.filterMenus[label] = (menu, var)
+        self.updateFilterMenus()
 
-        tk.Label(self.sequenceGroup, text="Sequence").grid(row=1, column=0, padx=5, pady=5, sticky="w")
         self.selectedSeq = tk.StringVar()
-        self.seqSelect = tk.OptionMenu(self.sequenceGroup, self.selectedSeq, "")
-        self.seqSelect.config(width=32)
-        self.seqSelect.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+        self.seqList = VirtualList(self.sequenceGroup, rows=8, command=self.selectSequence)
+        self.seqList.grid(row=2, column=0, columnspan=6, padx=5, pady=5, sticky="nsew")
+        self.updateSequenceDropdown()
+
+        self.optimiseOrder = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.sequenceGroup, text="Optimise delivery order within groups", variable=self.optimiseOrder).grid(
+            row=3, column=0, columnspan=4, padx=5, sticky="w"
+        )
+        tk.Button(self.sequenceGroup, text="Estimate Time", command=self.estimateSequence).grid(
+            row=3, column=4, columnspan=2, padx=5, sticky="e"
+        )
 
         # --- Playback Controls ---
         iconPath = "icons/"
-        self.playIcon = tk.PhotoImage(file=iconPath + "play.png")
-        self.stopIcon = tk.PhotoImage(file=iconPath + "stop.png")
-        self.nextIcon = tk.PhotoImage(file=iconPath + "next.png")
-        self.prevIcon = tk.PhotoImage(file=iconPath + "prev.png")
-        self.restartIcon = tk.PhotoImage(file=iconPath + "skipprev.png")
-        self.resendIcon = tk.PhotoImage(file=iconPath + "replay.png")
+        self.playIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "play.png"))
+        self.stopIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "stop.png"))
+        self.nextIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "next.png"))
+        self.prevIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "prev.png"))
+        self.restartIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "skipprev.png"))
+        self.resendIcon = tk.PhotoImage(file=assetCache.localPath(iconPath + "replay.png"))
 
         controlFrame = tk.Frame(self.sequenceFrame)
         controlFrame.pack(pady=10)
@@ -644,6 +998,22 @@ class GUI(tk.Frame):
         self.selected_file_label = tk.Label(self.fileFrame, text="Selected File:")
         self.selected_file_label.pack()
         tk.Button(self.fileFrame, image=self.playIcon, command=self.startFile, width=50).pack()
+
+        self.planGroup = tk.LabelFrame(self.fileFrame, text="Indexed Plans", padx=10, pady=5)
+        self.planGroup.pack(fill="x", expand=True, pady=5)
+        self.planSearchText = tk.StringVar()
+        tk.Entry(self.planGroup, textvariable=self.planSearchText).pack(fill="x")
+        self.planSearchText.trace("w", lambda *args: self.updatePlanList())
+        self.planList = VirtualList(self.planGroup, rows=6, command=self.selectPlan, autoSelect=False)
+        self.planList.pack(fill="both", expand=True, pady=5)
+        self.updatePlanList()
+
+        self.readyGroup = tk.LabelFrame(self.fileFrame, text="Ready to Deliver", padx=10, pady=5)
+        self.readyGroup.pack(fill="x", expand=True, pady=5)
+        self.readyList = VirtualList(self.readyGroup, rows=4, command=self.selectReadyPlan, autoSelect=False)
+        self.readyList.pack(fill="both", expand=True, pady=5)
+        tk.Button(self.readyGroup, text="Queue Plan", command=self.queueReadyPlan).pack()
+        self.selectedReady = None
         
         # --- Bottom Frame / Log ---
         self.btm_frame = tk.Frame(self.root, padx=5, pady=5)
@@ -658,35 +1028,54 @@ class GUI(tk.Frame):
         self.sbar = tk.Label(self.root, textvariable=statusvar, relief=tk.SUNKEN, anchor="w")
         self.sbar.grid(row=3, column=0, columnspan=4, sticky="we")
 
-        text_handler = TextHandler(st)
-        logging.basicConfig(filename='PyiCom.log',
-            level=logging.INFO, 
-            format='%(asctime)s - %(levelname)s - %(message)s')        
-        logger = logging.getLogger()        
-        logger.addHandler(text_handler)
+        setupLogging(st)
         
     def toggleSequenceControls(self, enable=True):
         for btn in self.seqButtons:
             btn.config(state=tk.NORMAL if enable else tk.DISABLED)
     
-    def updateSequenceDropdown(self, selected_type):
-        # Get filtered sequence keys and names
-        filtered_keys = sequence_types[selected_type]
-        filtered_names = [(getLongSeqName(k), k) for k in filtered_keys]
-        
-        # Sort by the nice display name
-        filtered_names.sort(key=lambda x: x[0])
-        
-        menu = self.seqSelect["menu"]
-        menu.delete(0, "end")
-        
-        if filtered_names:
-            for nice_name, key in filtered_names:
-                menu.add_command(label=nice_name, command=lambda value=nice_name: self.selectedSeq.set(value))
-            self.selectedSeq.set(filtered_names[0][0])  # Set the first nice name
-        else:
-            self.selectedSeq.set("")
+    def updateFilterMenus(self):
+        index = seqLibrary.index()
+        for label, values in (("Type", index.types()), ("Energy", index.energies()), ("Linac", index.linacs())):
+            menu, var = self.filterMenus[label]
+            options = menu["menu"]
+            options.delete(0, "end")
+            for value in [ALL_FILTER] + values:
+                options.add_command(label=value, command=tk._setit(var, value, self.updateSequenceDropdown))
+            if var.get() not in values:
+                var.set(ALL_FILTER)
 
+    def updateSequenceDropdown(self, *args):
+        # Search the index with the current text and filters, results are ranked by the index
+        def filterValue(var):
+            return None if var.get() == ALL_FILTER else var.get()
+        plans = seqLibrary.index().search(self.searchText.get(),
+                                          seqType = filterValue(self.selectedType),
+                                          energy = filterValue(self.selectedEnergy),
+                                          linac = filterValue(self.selectedLinac))
+        self.seqList.setItems(plans, ["%s  (%s)" % (plan.name, plan.type) for plan in plans])
+
+    def selectSequence(self, plan):
+        self.selectedSeq.set(plan.name if plan else "")
+        if plan:
+            assetCache.prefetch(set(beam.filename for beam in plan.beams))
+
+    def pollLibrary(self):
+        # Pick up edits to config.txt, sequences/*.toml or their EFS files without restarting
+        if seqLibrary.reloadIfChanged():
+            logging.info("Sequence library reloaded.")
+            current = self.selectedSeq.get()
+            self.updateFilterMenus()
+            self.updateSequenceDropdown()
+            plans = self.seqList.items
+            for idx, plan in enumerate(plans):
+                if plan.name == current:
+                    self.seqList.selected = idx
+                    self.seqList.scrollTo(idx)
+                    self.seqList.render()
+                    self.selectSequence(plan)
+                    break
+        self.root.after(LIBRARY_POLL_MS, self.pollLibrary)
     
     def startConnection(self):
         # Update the connection configs.
@@ -710,67 +1099,49 @@ class GUI(tk.Frame):
         self.toggleSequenceControls(False)
     
     def startSequence(self):
-        global fldQueue
-        selected_name = self.selectedSeq.get()
-        seq_key = next((k for k, v in config['sequences'].items() if v['name'] == selected_name), None)
+        seq = seqLibrary.findByName(self.selectedSeq.get())
         
-        if not seq_key:
+        if not seq:
             logging.info("No valid sequence selected.")
             return
         
-        seq = config['sequences'][seq_key]
-        for fld in seq['beams']:
-            for _ in range(fld['repeats']):
-                fldQueue.append(fld)
+        fields = seq.fields
+        if self.optimiseOrder.get():
+            fields, before, after = DeliveryOptimizer.optimise(fields)
+            logging.info("Delivery order optimised - est. transition time %.0fs -> %.0fs" % (before, after))
+        fldQueue.extend(fields)
         fxThread.startPlaying()
     
+    def estimateSequence(self):
+        # Dry run - no connection needed. Overheads are re-measured from the log each time.
+        seq = seqLibrary.findByName(self.selectedSeq.get())
+        if not seq:
+            logging.info("No valid sequence selected.")
+            return
+        fields = seq.fields
+        if self.optimiseOrder.get():
+            fields = DeliveryOptimizer.optimise(fields)[0]
+        estimator = SessionEstimator.SessionEstimator(SessionEstimator.loadOverheads(LOG_FILE))
+        logging.info(SessionEstimator.report(seq, estimator.estimate(fields)))
+    
     def stopSequence(self):
-        global fldQueue
-        fldQueue = []
-        fxThread.fldIndex = 0
         fxThread.stopPlaying()
+        fldQueue.clear()
         
     def skipBeam(self):
-        current = fxThread.fldIndex
-        fxThread.playing = False
-        time.sleep(1)
-        fxThread.cancelBeam()
-        fxThread.cancelBeam()
-        time.sleep(1)
-        fxThread.fldIndex = current + 1
+        fxThread.postCommand(CMD_NEXT)
         fxThread.startPlaying()
     
     def prevBeam(self):
-        current = fxThread.fldIndex
-        fxThread.playing = False
-        time.sleep(1)
-        fxThread.cancelBeam()
-        fxThread.cancelBeam()
-        time.sleep(1)
-        if (fxThread.fldIndex > 1):
-            fxThread.fldIndex = current - 1
-        elif (fxThread.fldIndex == 1):
-            fxThread.fldIndex = 0
+        fxThread.postCommand(CMD_PREV)
         fxThread.startPlaying()
     
     def repeatBeam(self):
-        current = fxThread.fldIndex
-        fxThread.playing = False
-        time.sleep(1)
-        fxThread.cancelBeam()
-        fxThread.cancelBeam()
-        time.sleep(1)
-        fxThread.fldIndex = current
+        fxThread.postCommand(CMD_REPEAT)
         fxThread.startPlaying()
         
     def restartSeq(self):
-        current = fxThread.fldIndex
-        fxThread.playing = False
-        time.sleep(1)
-        fxThread.cancelBeam()
-        fxThread.cancelBeam()
-        time.sleep(1)
-        fxThread.fldIndex = 0
+        fxThread.postCommand(CMD_RESTART)
         fxThread.startPlaying()
     
     def openFileDialog(self):
@@ -780,30 +1151,285 @@ class GUI(tk.Frame):
         else:
             self.selected_file_label.config(text="Multiple Files Selected")
     
+    def startPlanIndexer(self):
+        global planIndexer
+        folders = planIndexSettings.get('folders', [])
+        if folders:
+            planIndexer = PlanIndexer(folders,
+                                      dbPath = planIndexSettings.get('database') or PLAN_INDEX_DB_PATH,
+                                      interval = planIndexSettings.get('interval', 60),
+                                      onUpdate = lambda n: self.root.after(0, self.updatePlanList))
+            planIndexer.start()
+    
+    def updatePlanList(self):
+        plans = self.planIndex.search(self.planSearchText.get())
+        labels = ["%s - %s (%s beams, %s, %.0f MU)" % (p['patient_id'], p['plan_label'], p['beam_count'], p['techniques'], p['total_mu'] or 0)
+                  for p in plans]
+        self.planList.setItems(plans, labels)
+    
+    def selectPlan(self, plan):
+        if plan:
+            self.selectedFile = (plan['path'],)
+            self.selected_file_label.config(text="Selected File: %s" % os.path.basename(plan['path']))
+    
+    def startHotFolder(self):
+        global hotFolderWatcher
+        ingestPipeline.onReady = lambda plan: self.root.after(0, self.updateReadyList)
+        folders = hotFolderSettings.get('folders', [])
+        if folders:
+            hotFolderWatcher = HotFolderWatcher(folders, ingestPipeline, interval = hotFolderSettings.get('interval', 5))
+            hotFolderWatcher.start()
+    
+    def updateReadyList(self):
+        plans = ingestPipeline.ready()
+        labels = ["%s - %s (%s fields, %s)" % (p.patient_id, p.plan_label, len(p.fields), p.techniques) for p in plans]
+        self.readyList.setItems(plans, labels)
+        self.selectedReady = None
+    
+    def selectReadyPlan(self, plan):
+        self.selectedReady = plan
+    
+    def queueReadyPlan(self):
+        if self.selectedReady and ingestPipeline.take(self.selectedReady.uid):
+            fldQueue.extend(self.selectedReady.fields)
+            if fxThread is not None and fxThread.connected:
+                fxThread.startPlaying()
+        self.updateReadyList()
+    
+    def queueConvertedPlan(self, plan):
+        # Called from an ingest worker once a File Mode DICOM plan is converted
+        ingestPipeline.take(plan.uid)
+        fldQueue.extend(plan.fields)
+        if fxThread is not None and fxThread.connected:
+            fxThread.startPlaying()
+        self.root.after(0, self.updateReadyList)
+    
     def startFile(self): 
-        # DCM2EFS conversion needs to happen here before its added to the field queue.
-        global fldQueue
+        # DICOM plans are converted by the ingest pipeline and queued when ready,
+        # so the Tk thread never waits on DCM2EFS.
         if self.selectedFile:
             for fn in self.selectedFile:
                 if fn.split(".")[-1].lower() == "dcm":
-                    efsList = dcm2efs.convert_dcm2efs(fn)
-                    for efsFile in efsList:
-                        fld = {'name': "File Field", 'filename': efsFile}
-                        fldQueue.append(fld)
+                    if ingestPipeline.submit(fn, callback = self.queueConvertedPlan):
+                        logging.info("Converting %s..." % os.path.basename(fn))
+                    else:
+                        logging.info("ERROR: Conversion queue full, try again shortly.")
                 elif fn.split(".")[-1].lower() == "efs":
-                    fld = {'name': "File Field", 'filename': fn}
+                    fld = compileBeam({'name': "File Field", 'filename': fn}, seqLibrary.efsCache)
                     fldQueue.append(fld)
-            fxThread.startPlaying()
+            if fxThread is not None and fxThread.connected:
+                fxThread.startPlaying()
             
+def restoreSession():
+    # Rebuild fldQueue and its cursor from the journal after a crash.
+    if not sessionJournal.pending():
+        return
+    fieldRunList, progressRuns, cursor = sessionJournal.state()
+    # One BeamPlan per run, repeated as the run says, so a sweep is never expanded
+    fields = FieldSweep([(compileBeam(fld, seqLibrary.efsCache), count) for fld, count in fieldRunList])
+    progress = FieldSweep(progressRuns)
+    fldQueue.load(fields, cursor)
+    logging.info("Restored previous session: %s fields, resuming at field %s/%s - %s"
+                 % (len(fields), cursor+1, len(fields), fields[cursor].name))
+    if progress[cursor] == "terminated":
+        logging.info("Field %s was delivered before the session ended, moving on." % (cursor+1))
+        fldQueue.advance()
+    elif progress[cursor] == "irradiated":
+        logging.info("WARNING: Field %s - %s was interrupted during irradiation. Check the delivered MU before repeating it."
+                     % (cursor+1, fields[cursor].name))
+
+class RemoteControl:
+    # Answers the control API (see ControlServer). Runs on the server's request
+    # threads, so it only touches fldQueue and the FX thread's play flag and
+    # command queue, which are safe to use from any thread - never Tk widgets.
+
+    COMMANDS = ("play", "pause", "stop", CMD_NEXT, CMD_PREV, CMD_REPEAT, CMD_RESTART)
+
+    def status(self):
+        fldIndex, fldCount, fld = fldQueue.position()
+        state = vxThread.getState() if vxThread is not None else None
+        return {'connected': bool(fxThread is not None and fxThread.connected),
+                'playing': bool(fxThread is not None and fxThread.playing),
+                'linac': fxThread.linacName if fxThread is not None else linacName,
+                'state': state,
+                'stateName': stateName(state),
+                'cursor': fldIndex,
+                'length': fldCount,
+                'field': fld.name if fld else None}
+
+    def queue(self):
+        # The queue as (field, count) runs, each with the [event, count] runs
+        # of its fields' progress, so a long sweep is never expanded.
+        version, cursor, fields = fldQueue.snapshot()
+        progress = sessionJournal.state()[1]
+        if sum(count for event, count in progress) != len(fields):     # Changed between the two reads
+            progress = [[None, len(fields)]]
+        runs = []
+        start = 0
+        p = 0
+        for fld, count in fields.runs():
+            fldProgress = []
+            left = count
+            while left:
+                event, n = progress[p]
+                taken = min(n, left)
+                fldProgress.append([event, taken])
+                left -= taken
+                if taken == n:
+                    p += 1
+                else:
+                    progress[p][1] -= taken
+            runs.append({'index': start, 'count': count, 'name': fld.name, 'filename': fld.filename,
+                         'mu': fld.mu, 'dr': fld.dr, 'progress': fldProgress})
+            start += count
+        return {'version': version,
+                'cursor': cursor,
+                'length': len(fields),
+                'runs': runs}
+
+    def sequences(self):
+        return {'sequences': [{'key': plan.key, 'name': plan.name, 'type': plan.type, 'fields': len(plan.fields)}
+                              for plan in seqLibrary.all()]}
+
+    def submit(self, request):
+        # Everything is resolved (and DICOM converted, on this thread) before
+        # anything is queued, so an invalid entry rejects the whole batch.
+        fields = []             # (field, count) runs
+        errors = []
+        converted = []
+        for name in request.get('sequences', []):
+            seq = seqLibrary.get(name) or seqLibrary.findByName(name)
+            if seq is None:
+                errors.append("Unknown sequence '%s'" % name)
+                continue
+            seqFields = seq.fields
+            if request.get('optimise'):
+                seqFields = DeliveryOptimizer.optimise(seqFields)[0]
+            fields.extend(fieldRuns(seqFields))
+        for fn in request.get('files', []):
+            ext = fn.split(".")[-1].lower()
+            if not os.path.isfile(fn):
+                errors.append("File not found: %s" % fn)
+            elif ext == "efs":
+                fields.append((compileBeam({'name': os.path.basename(fn), 'filename': fn}, seqLibrary.efsCache), 1))
+            elif ext == "dcm":
+                plan = ingestPipeline.ingest(fn)
+                if plan is None:
+                    errors.append("Unable to convert %s" % fn)
+                else:
+                    converted.append(plan.uid)
+                    fields.extend(fieldRuns(plan.fields))
+            else:
+                errors.append("Unknown file type: %s" % fn)
+        for fld in request.get('fields', []):
+            # Single fields with overrides, as in a sequence's beams list
+            if not isinstance(fld, dict) or 'filename' not in fld:
+                errors.append("Field without a filename: %s" % (fld,))
+            elif not os.path.isfile(fld['filename']):
+                errors.append("File not found: %s" % fld['filename'])
+            else:
+                beam = compileBeam(fld, seqLibrary.efsCache)
+                fields.append((beam, beam.repeats))
+        if errors:
+            raise RequestError("; ".join(errors))
+        fields = FieldSweep(fields)
+        if not fields:
+            raise RequestError("Nothing to queue")
+        for uid in converted:
+            ingestPipeline.take(uid)
+        if request.get('clear'):
+            if fxThread is not None:
+                fxThread.stopPlaying()
+            fldQueue.clear()
+        fldQueue.extend(fields)
+        ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+        logging.info(ts + "Control API queued %s fields." % len(fields))
+        if request.get('play', True) and fxThread is not None and fxThread.connected:
+            fxThread.startPlaying()
+        return dict(self.status(), queued = len(fields))
+
+    def command(self, cmd):
+        if cmd not in self.COMMANDS:
+            raise RequestError("Unknown command '%s', expected one of %s" % (cmd, ", ".join(self.COMMANDS)))
+        if cmd == "stop":
+            if fxThread is not None:
+                fxThread.stopPlaying()
+            fldQueue.clear()
+        elif fxThread is None or not fxThread.connected:
+            raise RequestError("Not connected to a linac", 409)
+        elif cmd == "play":
+            fxThread.startPlaying()
+        elif cmd == "pause":
+            fxThread.stopPlaying()
+        else:
+            fxThread.postCommand(cmd)
+            fxThread.startPlaying()
+        ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+        logging.info(ts + "Control API command '%s'." % cmd)
+        return self.status()
+
+def startControlServer():
+    global controlServer
+    if not controlSettings.get('enabled', False):
+        return
+    try:
+        controlServer = ControlServer(RemoteControl(), eventBus,
+                                      port = controlSettings.get('port', 8765),
+                                      token = controlSettings.get('token'))
+    except (IOError, OSError, ValueError) as e:
+        logging.info("ERROR: Unable to start the control API - %s" % e)
+        return
+    controlServer.start()
+    logging.info("Control API listening on 127.0.0.1:%s" % controlServer.port)
+
+def analyseField(event):
+    # Compares a terminated field with its plan. Runs on its own event bus
+    # thread, so the FX/VX threads carry on with the next field meanwhile.
+    taken = deliveryRecorder.take()
+    if taken is None or taken[0] is None:
+        return
+    fld, samples = taken                    # The field sent, even if the queue has been cleared since
+    index = event.data.get('index')
+    variant = beamVariants.get(fld, fxThread.linacName if fxThread is not None else linacName)
+    if variant is None:
+        return                              # Not an EFS field
+    start = time.time()
+    result = LogQA.compare(LogQA.plannedTrajectory(variant.records), samples, deliveryRecorder.tags)
+    ts = datetime.datetime.now().strftime("%H:%M:%S") + " - "
+    if result is None:
+        logging.info(ts + "Log QA %s - no samples to compare" % fld.name)
+        return
+    failed = LogQA.failures(result, logQATolerances)
+    logging.info(ts + "Log QA %s - %s - %s (%.0f ms)" % (fld.name, "FAILED: " + "; ".join(failed) if failed else "PASSED",
+                                                      LogQA.summary(result), (time.time() - start) * 1000))
+    eventBus.publish(EventBus.FIELD_ANALYSED, index = index, name = fld.name, samples = result.samples,
+                     passed = not failed, failures = failed,
+                     deviations = dict((name, {'rms': g.rms, 'max': g.max, 'worst': g.worst, 'unit': g.unit})
+                                       for name, g in result.groups.items()))
+
+def startLogQA():
+    if deliveryRecorder is not None:
+        eventBus.subscribe(analyseField, types = [EventBus.FIELD_TERMINATED], name = "logqa")
+
 def main():
+    cls()
     root = tk.Tk()
     global guiObj
     guiObj = GUI(root)    
     logging.info("\nPyiCom - Linac QA Field Sequencer")
     logging.info("---------------------------------")
     logging.info("A.Blackmore - R.Farias - 2024\n")
+    restoreSession()
+    startControlServer()
+    startLogQA()
     global statusvar
     statusvar.set("Ready")
     root.mainloop()
+    if controlServer is not None:
+        controlServer.stop()
+    iCOM.close()                # Stops the sidecar, if there is one
+    eventBus.close()
+    logListener.stop()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""
+#
+#  SequenceLibrary - Compiled sequence definitions for PyiCom
+#
+#  Sequences from config.txt (and any *.toml files in a sequence directory)
+#  are compiled once into immutable plans. Overrides are resolved, EFS files
+#  are parsed into tag records, and plans are indexed by key, display name
+#  and type. reloadIfChanged() recompiles only the sources whose mtime moved.
+#
+#  A sequence can also be parametric: a [sequences.<key>.sweep] table
+#  crosses a list of EFS files with a list of MU or dose rate values, with
+#  optional reference bookends, e.g. for MU linearity. Each file is compiled
+#  once and every point shares its tags. Fields are a lazily expanded
+#  FieldSweep, so repeats cost nothing until they are delivered.
+#
+#  SequenceIndex provides the prefix/fuzzy search and type/energy/linac
+#  filters used by the sequence browser.
+#
+"""
+
+import os
+import re
+import glob
+import bisect
+import logging
+import threading
+import collections
+import toml
+import iCOMTags
+from FieldQueue import FieldSweep
+from iCOMTags import TAG_MACHINE, TAG_ENERGY, CARRY_FORWARD_TAGS
+
+# One field of a sequence. Overrides are None when not given in the config.
+# group/pinned control reordering by DeliveryOptimizer.
+BeamPlan = collections.namedtuple("BeamPlan",
+    ["name", "filename", "repeats", "mu", "dr", "ptid", "ptname", "tags", "group", "pinned"])
+
+# A compiled sequence. beams are its distinct BeamPlans and fields is the
+# delivery order, a FieldSweep of beams with their repeats.
+SequencePlan = collections.namedtuple("SequencePlan",
+    ["key", "name", "type", "linac", "source", "beams", "fields"])
+
+def parseEFS(filename):
+    # Returns a tuple of (tag, cp, value) records, tag as an int.
+    records = []
+    tagOf = iCOMTags.tagOf
+    with open(filename) as file:
+        for line in file:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            address, val = line.split(" ", 1)
+            tagPart, cp = address.split("-")
+            records.append((tagOf(tagPart), int(cp), val))
+    return tuple(records)
+
+
+def elideRecords(records, carryForward = CARRY_FORWARD_TAGS):
+    # Leaves out control point records of carry-forward tags whose value is
+    # the same at the previous control point. Control point 1 is always whole.
+    last = {}                   # tag -> (cp, value) last seen, sent or not
+    out = []
+    for tag, cp, val in records:
+        if cp > 1 and tag in carryForward and last.get(tag) == (cp - 1, val):
+            last[tag] = (cp, val)
+            continue
+        last[tag] = (cp, val)
+        out.append((tag, cp, val))
+    return tuple(out)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class EFSCache:
+    # Parsed EFS records keyed by path, refreshed when the file's mtime changes.
+    # With an AssetCache, files are read from its local copies instead.
+
+    def __init__(self, assets = None):
+        self.assets = assets
+        self._lock = threading.Lock()
+        self._entries = {}      # path -> (mtime or asset signature, records)
+
+    def version(self, filename):
+        # mtime, or the asset signature - changes whenever the content may have
+        return self.assets.signature(filename) if self.assets else _mtime(filename)
+
+    def get(self, filename):
+        if self.assets:
+            local, mtime = self.assets.fetch(filename)
+        else:
+            local, mtime = filename, _mtime(filename)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+        if mtime is None:
+            logging.info("ERROR: Sequence file not found: %s" % filename)
+            return None
+        records = parseEFS(local)
+        with self._lock:
+            self._entries[filename] = (mtime, records)
+        return records
+
+    def stale(self):
+        # Paths whose file changed on disk since they were parsed. They are
+        # dropped from the cache so the next get() parses them again.
+        with self._lock:
+            paths = [path for path, (mtime, records) in self._entries.items() if self.version(path) != mtime]
+            for path in paths:
+                del self._entries[path]
+        return paths
+
+
+def compileBeam(fld, efsCache = None):
+    # Build a BeamPlan from a config beam entry (or a File Mode dict).
+    filename = fld['filename']
+    tags = None
+    if efsCache is not None and filename.split(".")[-1].lower() == "efs":
+        tags = efsCache.get(filename)
+    return BeamPlan(name = fld.get('name', os.path.basename(filename)),
+                    filename = filename,
+                    repeats = int(fld.get('repeats', 1)),
+                    mu = fld.get('mu'),
+                    dr = fld.get('dr'),
+                    ptid = fld.get('ptid'),
+                    ptname = fld.get('ptname'),
+                    tags = tags,
+                    group = fld.get('group'),
+                    pinned = bool(fld.get('pin', fld.get('pinned', False))))
+
+
+# Sweep parameters: BeamPlan field overridden and how a point is named
+SWEEP_PARAMS = (('mu', "%s %sMU"), ('dr', "%s %s DR"))
+
+
+def _perValue(setting, values, what):
+    # A setting given once for all values, or as a list with one per value.
+    if isinstance(setting, list):
+        if len(setting) != len(values):
+            raise ValueError("%s lists %s values for %s points" % (what, len(setting), len(values)))
+        return setting
+    return [setting] * len(values)
+
+
+def sweepRuns(sweep, efsCache = None):
+    # Generates the (BeamPlan, count) runs of a sweep table. Per file: the
+    # reference bookend, every parameter point, then the bookend again.
+    params = [(attr, fmt, sweep[attr]) for attr, fmt in SWEEP_PARAMS if attr in sweep]
+    if len(params) != 1:
+        raise ValueError("a sweep needs exactly one of %s" % ", ".join(attr for attr, fmt in SWEEP_PARAMS))
+    attr, fmt, values = params[0]
+    repeats = _perValue(sweep.get('repeats', 1), values, "repeats")
+    reference = sweep.get('reference', 0)
+    if not isinstance(reference, dict):
+        reference = {'repeats': reference}
+    refRepeats = int(reference.get('repeats', 0))
+    refName = reference.get('name', "Reference")
+    for entry in sweep['files']:
+        if not isinstance(entry, dict):
+            entry = {'filename': entry}
+        label = entry.get('name') or os.path.basename(entry['filename']).split()[0]
+        # Compiled once per file - the reference and every point share its tags
+        base = compileBeam(dict(entry, name = label), efsCache)
+        ref = base._replace(name = "%s %s" % (label, refName), repeats = refRepeats, pinned = True)
+        if refRepeats:
+            yield ref, refRepeats
+        for value, count in zip(values, repeats):
+            point = base._replace(**{'name': fmt % (label, value), 'repeats': int(count),
+                                     'group': sweep.get('group', base.group), attr: value})
+            yield point, int(count)
+        if refRepeats:
+            yield ref, refRepeats
+
+
+def compileSequence(key, seq, source, efsCache = None):
+    if 'sweep' in seq:
+        fields = FieldSweep(sweepRuns(seq['sweep'], efsCache))
+        beams = tuple(fields.distinct())
+    else:
+        beams = tuple(compileBeam(fld, efsCache) for fld in seq.get('beams', []))
+        fields = FieldSweep((beam, beam.repeats) for beam in beams)
+    return SequencePlan(key = key,
+                        name = seq.get('name', key),
+                        type = seq.get('type', "Other"),
+                        linac = seq.get('linac'),
+                        source = source,
+                        beams = beams,
+                        fields = fields)
+
+
+class SequenceLibrary:
+
+    def __init__(self, configFile = "config.txt", seqDir = None, assets = None):
+        self.configFile = configFile
+        self.seqDir = seqDir
+        self.assets = assets            # Optional AssetCache for sources on a network share
+        self.efsCache = EFSCache(assets)
+        self._lock = threading.Lock()
+        self._sources = {}      # source path -> (mtime, {key: SequencePlan})
+        self._index(self._scan(force = True))
+
+    # --- Loading ---
+
+    def _sourceFiles(self):
+        files = [self.configFile]
+        if self.seqDir and os.path.isdir(self.seqDir):
+            files.extend(sorted(glob.glob(os.path.join(self.seqDir, "*.toml"))))
+        elif self.seqDir and self.assets:
+            # Share unreachable - keep the sources we already have, served from the cache
+            files.extend(sorted(path for path in self._sources if path != self.configFile))
+        return files
+
+    def _compileSource(self, path):
+        plans = {}
+        try:
+            data = toml.load(self.assets.localPath(path) if self.assets else path)
+        except Exception as e:
+            logging.info("ERROR: Unable to load sequences from %s - %s" % (path, e))
+            return None
+        for key, seq in data.get('sequences', {}).items():
+            try:
+                plans[key] = compileSequence(key, seq, path, self.efsCache)
+            except (KeyError, TypeError, ValueError) as e:
+                logging.info("ERROR: Invalid sequence '%s' in %s - %s" % (key, path, e))
+        return plans
+
+    def _scan(self, force = False):
+        # Recompile new or modified sources, drop removed ones. Returns True if anything changed.
+        changed = False
+        present = self._sourceFiles()
+        for path in present:
+            mtime = self.efsCache.version(path)
+            known = self._sources.get(path)
+            if force or known is None or known[0] != mtime:
+                plans = self._compileSource(path)
+                if plans is None:
+                    continue            # Keep serving the last good version
+                self._sources[path] = (mtime, plans)
+                changed = True
+        for path in list(self._sources):
+            if path not in present:
+                del self._sources[path]
+                changed = True
+        # Sources whose EFS files were edited need rebinding to the new tags
+        stale = set(self.efsCache.stale())
+        if stale:
+            for path, (mtime, plans) in list(self._sources.items()):
+                if any(b.filename in stale for p in plans.values() for b in p.beams):
+                    self._sources[path] = (mtime, self._compileSource(path) or plans)
+                    changed = True
+        return changed
+
+    def _index(self, changed):
+        if not changed:
+            return False
+        byKey = {}
+        for path in self._sourceFiles():
+            if path in self._sources:
+                byKey.update(self._sources[path][1])
+        byName = {}
+        byType = {}
+        for plan in byKey.values():
+            byName[plan.name] = plan
+            byType.setdefault(plan.type, []).append(plan)
+        for plans in byType.values():
+            plans.sort(key = lambda p: p.name)
+        search = SequenceIndex(byKey.values())
+        with self._lock:
+            self._byKey = byKey
+            self._byName = byName
+            self._byType = dict((t, tuple(p)) for t, p in byType.items())
+            self._search = search
+        return True
+
+    def reloadIfChanged(self):
+        # Cheap enough to call from a GUI timer: only stats files unless something moved.
+        return self._index(self._scan())
+
+    # --- Lookup ---
+
+    def get(self, key):
+        with self._lock:
+            return self._byKey.get(key)
+
+    def findByName(self, name):
+        with self._lock:
+            return self._byName.get(name)
+
+    def types(self):
+        with self._lock:
+            return sorted(self._byType.keys())
+
+    def ofType(self, seqType):
+        # Plans of the given type, sorted by display name.
+        with self._lock:
+            return self._byType.get(seqType, ())
+
+    def all(self):
+        with self._lock:
+            return sorted(self._byKey.values(), key = lambda p: p.name)
+
+    def index(self):
+        # The SequenceIndex for the current compile, replaced on every reload.
+        with self._lock:
+            return self._search
+
+
+def _normEnergy(val):
+    return " ".join(val.upper().split())
+
+
+def _tagValues(tags, wanted, memo):
+    # Values of one tag in a record tuple. Records are shared between every
+    # plan using the same file, so the scan is memoised on the tuple itself.
+    key = (id(tags), wanted)
+    if key not in memo:
+        memo[key] = (tags, set(val for tag, cp, val in tags or () if tag == wanted))
+    return memo[key][1]
+
+
+def planEnergies(plan, memo = None):
+    # Energies named by the EFS files of a plan, e.g. "6 MV", "6 MV FFF", "9 MEV".
+    memo = {} if memo is None else memo
+    energies = set()
+    for beam in plan.beams:
+        energies.update(_normEnergy(v) for v in _tagValues(beam.tags, TAG_ENERGY, memo))
+    return energies
+
+
+def planLinacs(plan, memo = None):
+    # The 'linac' key of the sequence if given, otherwise the machine tags of its files.
+    if plan.linac:
+        return set([str(plan.linac)])
+    memo = {} if memo is None else memo
+    linacs = set()
+    for beam in plan.beams:
+        linacs.update(v.strip() for v in _tagValues(beam.tags, TAG_MACHINE, memo))
+    return linacs
+
+
+class SequenceIndex:
+    # Immutable search index over a set of SequencePlans.
+    #
+    # Prefix queries use a sorted word list and bisect, fuzzy queries fall back
+    # to an in-order subsequence match. Filters are precomputed id sets, and
+    # the result of the previous query is reused when the new query extends it
+    # (as it does on every keystroke).
+
+    def __init__(self, plans):
+        self.plans = sorted(plans, key = lambda p: p.name.lower())
+        self._text = [("%s %s" % (p.name, p.key)).lower() for p in self.plans]
+        self._words = []            # sorted (word, id)
+        self._planWords = []        # words of each plan, by id
+        self._byType = {}
+        self._byEnergy = {}
+        self._byLinac = {}
+        memo = {}
+        for i, plan in enumerate(self.plans):
+            planWords = tuple(w for w in set(re.split(r"[\s_\-/]+", self._text[i])) if w)
+            self._planWords.append(planWords)
+            for word in planWords:
+                self._words.append((word, i))
+            self._byType.setdefault(plan.type, set()).add(i)
+            for energy in planEnergies(plan, memo):
+                self._byEnergy.setdefault(energy, set()).add(i)
+            for linac in planLinacs(plan, memo):
+                self._byLinac.setdefault(linac, set()).add(i)
+        self._words.sort()
+        self._wordKeys = [w for w, i in self._words]
+        self._last = (None, None)   # (query, ranked ids) of the previous search
+
+    def types(self):
+        return sorted(self._byType)
+
+    def energies(self):
+        return sorted(self._byEnergy, key = lambda e: (float(re.match(r"[\d.]*", e).group() or 0), e))
+
+    def linacs(self):
+        return sorted(self._byLinac)
+
+    def _prefixIds(self, prefix):
+        ids = set()
+        pos = bisect.bisect_left(self._wordKeys, prefix)
+        while pos < len(self._words) and self._wordKeys[pos].startswith(prefix):
+            ids.add(self._words[pos][1])
+            pos += 1
+        return ids
+
+    def _rank(self, query):
+        # Ranked ids for a query: whole-name prefix, then word prefix, then fuzzy.
+        lastQuery, lastIds = self._last
+        if lastQuery is not None and query.startswith(lastQuery):
+            candidates = lastIds        # Extending the query can only narrow the result
+        else:
+            candidates = range(len(self.plans))
+        terms = query.split()
+        if len(candidates) * len(terms) < 500:
+            # Few candidates left - checking their own words beats walking the word list
+            wordHits = set(i for i in candidates
+                           if all(any(w.startswith(t) for w in self._planWords[i]) for t in terms))
+        else:
+            wordHits = None
+            for term in terms:
+                hits = self._prefixIds(term)
+                wordHits = hits if wordHits is None else wordHits & hits
+        fuzzy = re.compile(".*?".join(re.escape(c) for c in query.replace(" ", "")))
+        starts, words, fuzzies = [], [], []
+        for i in candidates:
+            text = self._text[i]
+            if text.startswith(query):
+                starts.append(i)
+            elif i in wordHits:
+                words.append(i)
+            elif fuzzy.search(text):
+                fuzzies.append(i)
+        ranked = starts + words + fuzzies
+        self._last = (query, ranked)
+        return ranked
+
+    def search(self, query = "", seqType = None, energy = None, linac = None, limit = None):
+        query = " ".join(query.lower().split())
+        ids = self._rank(query) if query else range(len(self.plans))
+        allowed = None
+        for index, val in ((self._byType, seqType), (self._byEnergy, energy and _normEnergy(energy)), (self._byLinac, linac)):
+            if val:
+                sub = index.get(val, set())
+                allowed = sub if allowed is None else allowed & sub
+        results = []
+        for i in ids:
+            if allowed is None or i in allowed:
+                results.append(self.plans[i])
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
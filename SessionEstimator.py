@@ -0,0 +1,201 @@
+"""
+#
+#  SessionEstimator - Dry-run time estimate for a sequence
+#
+#  Walks a sequence without connecting to the linac and estimates the time
+#  for each field as
+#
+#      transition (mode-up, wedge/accessory, gantry/collimator travel)
+#    + state overhead (field sent -> beam on, beam off -> next field)
+#    + beam-on time (MU / dose rate)
+#
+#  MU and dose rate come from the mu/dr overrides or the EFS tags. The
+#  state overheads are measured from the "Field" and "State:" lines of past
+#  PyiCom.log sessions, including rotated backups, where available. Per-field
+#  inputs are cached, so a candidate sequence costs only a little arithmetic
+#  per field to estimate.
+#
+#  Run directly for a dry run: python SessionEstimator.py [sequence ...]
+#
+"""
+
+import re
+import os
+import glob
+import datetime
+import collections
+from DeliveryOptimizer import COSTS, fieldSetup, transitionCost
+from iCOMTags import TAG_MU, TAG_DOSE_RATE
+
+DEFAULT_DOSE_RATE = 400.0       # MU/min when neither the EFS nor an override gives one
+
+# Seconds. 'prepare' is field sent -> SEGMENT IRRADIATE, 'finish' is
+# FIELD TERMINATED -> next field sent.
+DEFAULT_OVERHEADS = {'prepare': 15.0, 'finish': 5.0, 'samples': 0}
+
+FieldEstimate = collections.namedtuple("FieldEstimate",
+    ["name", "mu", "doseRate", "transition", "overhead", "beamOn", "total"])
+SessionEstimate = collections.namedtuple("SessionEstimate", ["fields", "total"])
+
+_LOG_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d+) - \w+ - (?:\d\d:\d\d:\d\d - )?(.*)$")
+_FIELD_MSG = re.compile(r"^Field (\d+)/(\d+) - (.*)$")
+
+
+def _median(vals):
+    vals = sorted(vals)
+    if not vals:
+        return None
+    mid = len(vals) // 2
+    return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2.0
+
+
+def loadOverheads(logFile = "PyiCom.log"):
+    # Median state overheads from past sessions. 'prepare' is taken from
+    # repeats of the same field, which have no setup change, so it does not
+    # double count the modelled transition time.
+    prepRepeat, prepAll, finish = [], [], []
+    for path in [logFile] + glob.glob(logFile + ".*"):
+        if os.path.isfile(path):
+            _scanLog(path, prepRepeat, prepAll, finish)
+    overheads = dict(DEFAULT_OVERHEADS)
+    prepare = _median(prepRepeat) if prepRepeat else _median(prepAll)
+    if prepare is not None:
+        overheads['prepare'] = prepare
+    if finish:
+        overheads['finish'] = _median(finish)
+    overheads['samples'] = len(prepAll)
+    return overheads
+
+
+def _scanLog(path, prepRepeat, prepAll, finish):
+    lastField = None            # (time, name)
+    prevName = None
+    terminated = None
+    with open(path) as f:
+        for line in f:
+            m = _LOG_LINE.match(line.rstrip("\n"))
+            if not m:
+                continue
+            t = datetime.datetime.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")
+            t += datetime.timedelta(milliseconds = int(m.group(2)))
+            msg = m.group(3)
+            fm = _FIELD_MSG.match(msg)
+            if fm:
+                if terminated is not None:
+                    finish.append((t - terminated).total_seconds())
+                prevName = lastField[1] if lastField else None
+                lastField = (t, fm.group(3))
+                terminated = None
+            elif msg == "State: SEGMENT IRRADIATE" and lastField:
+                dt = (t - lastField[0]).total_seconds()
+                prepAll.append(dt)
+                if lastField[1] == prevName:
+                    prepRepeat.append(dt)
+            elif msg == "State: FIELD TERMINATED":
+                terminated = t
+
+
+def _number(val):
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return None
+
+
+class SessionEstimator:
+
+    def __init__(self, overheads = None, costs = COSTS, defaultDoseRate = DEFAULT_DOSE_RATE):
+        self.overheads = overheads if overheads is not None else dict(DEFAULT_OVERHEADS)
+        self.costs = costs
+        self.defaultDoseRate = defaultDoseRate
+        self._info = {}         # id(BeamPlan) -> (BeamPlan, setup, mu, doseRate)
+
+    def fieldInfo(self, fld):
+        # (setup, mu, doseRate) for a BeamPlan, worked out once per plan object.
+        entry = self._info.get(id(fld))
+        if entry is None or entry[0] is not fld:
+            mu = _number(fld.mu)
+            dr = _number(fld.dr)
+            for tag, cp, val in fld.tags or ():
+                if mu is None and tag == TAG_MU:
+                    mu = _number(val)
+                elif dr is None and tag == TAG_DOSE_RATE:
+                    dr = _number(val)
+            entry = (fld, fieldSetup(fld), mu or 0.0, dr or self.defaultDoseRate)
+            self._info[id(fld)] = entry
+        return entry[1:]
+
+    def estimate(self, fields):
+        # Full per-field breakdown.
+        overhead = self.overheads['prepare'] + self.overheads['finish']
+        rows = []
+        total = 0.0
+        prev = None
+        for fld in fields:
+            setup, mu, dr = self.fieldInfo(fld)
+            transition = transitionCost(prev, setup, self.costs)
+            beamOn = mu / dr * 60.0
+            t = transition + overhead + beamOn
+            rows.append(FieldEstimate(fld.name, mu, dr, transition, overhead, beamOn, t))
+            total += t
+            prev = setup
+        return SessionEstimate(tuple(rows), total)
+
+    def total(self, fields):
+        # Session total only - the fast path for ranking many candidate sequences.
+        overhead = self.overheads['prepare'] + self.overheads['finish']
+        total = 0.0
+        prev = None
+        for fld in fields:
+            setup, mu, dr = self.fieldInfo(fld)
+            if setup is not prev:
+                total += transitionCost(prev, setup, self.costs)
+            total += overhead + mu / dr * 60.0
+            prev = setup
+        return total
+
+
+def formatDuration(seconds):
+    m, s = divmod(int(round(seconds)), 60)
+    h, m = divmod(m, 60)
+    return "%d:%02d:%02d" % (h, m, s) if h else "%d:%02d" % (m, s)
+
+
+def report(plan, estimate):
+    lines = ["%s (%s fields) - %s" % (plan.name, len(estimate.fields), formatDuration(estimate.total))]
+    for idx, f in enumerate(estimate.fields):
+        lines.append("  %3d  %-28s %7.1f MU @ %4.0f  move %5.1fs  beam %5.1fs  total %s"
+                     % (idx + 1, f.name[:28], f.mu, f.doseRate, f.transition, f.beamOn, formatDuration(f.total)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import argparse
+    from SequenceLibrary import SequenceLibrary
+
+    parser = argparse.ArgumentParser(description = "Estimate sequence delivery time without connecting.")
+    parser.add_argument("sequences", nargs = "*", help = "Sequence keys or names (default: all)")
+    parser.add_argument("--log", default = "PyiCom.log", help = "Session log to measure overheads from")
+    parser.add_argument("--config", default = "config.txt")
+    args = parser.parse_args()
+
+    library = SequenceLibrary(args.config, "sequences")
+    overheads = loadOverheads(args.log)
+    print("Overheads: prepare %.1fs, finish %.1fs (%s logged fields)\n"
+          % (overheads['prepare'], overheads['finish'], overheads['samples']))
+    estimator = SessionEstimator(overheads)
+    plans = [library.get(s) or library.findByName(s) for s in args.sequences] or library.all()
+    for plan in plans:
+        if plan is None:
+            sys.exit("Unknown sequence")
+        print(report(plan, estimator.estimate(plan.fields)) + "\n")
+
+    start = time.time()
+    runs = 0
+    while time.time() - start < 0.5:
+        for plan in plans:
+            estimator.total(plan.fields)
+            runs += 1
+    print("%.0f sequence estimates per second" % (runs / (time.time() - start)))
@@ -0,0 +1,447 @@
+"""
+#
+#  SessionJournal - Crash-safe record of the field queue and delivery progress
+#
+#  Every change to the FieldQueue and every delivery milestone of a field
+#  (sent, confirmed, irradiated, terminated) is appended to a JSON-lines
+#  journal. Writes are fsync'ed in batches; 'irradiated' and 'terminated'
+#  are always synced at once since they decide whether a beam may be sent
+#  again. Once the journal holds CHECKPOINT_EVERY records it is compacted,
+#  so a restart only ever replays a bounded tail whatever the session
+#  length.
+#
+#  Compaction never runs on the FieldQueue observer: the journal is synced,
+#  closed and renamed aside (.old) - Windows will not rename an open file -
+#  and a new one started, and a background thread writes the
+#  state as of the rename to the checkpoint file and then deletes the old
+#  journal. Every record carries a sequence number and the checkpoint the
+#  last one it covers, so records already in the checkpoint are skipped on
+#  load - a crash at any point of a compaction restores the queue exactly.
+#  A failed compaction is logged and the journal simply keeps growing; it
+#  never raises into the FieldQueue.
+#
+#  Queued fields are written and held as (field, count) runs, and progress
+#  as (event, count) runs, so a sweep that repeats each field many times
+#  costs one entry per distinct field, on disk and in memory.
+#
+#  Run directly to check recovery from a crash at each step of a compaction.
+#
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from FieldQueue import fieldRuns
+
+CHECKPOINT_EVERY = 200          # Journal records before compacting into a checkpoint
+SYNC_EVERY = 20                 # Records per fsync batch
+SYNC_INTERVAL = 0.5             # Max seconds a record waits for its fsync
+
+# Field progress events, in order
+EVENTS = ("queued", "sent", "confirmed", "irradiated", "terminated")
+DURABLE_EVENTS = ("irradiated", "terminated")
+
+# Fields of a BeamPlan kept in the journal. Tags are re-read from the EFS on restore.
+PLAN_KEYS = ("name", "filename", "repeats", "mu", "dr", "ptid", "ptname", "group", "pinned")
+
+
+def planToDict(fld):
+    return dict((k, getattr(fld, k, None)) for k in PLAN_KEYS)
+
+
+def _valueRuns(values):
+    # (value, count) runs of equal values, e.g. a long tail of "queued".
+    runs = []
+    for val in values:
+        if runs and runs[-1][0] == val:
+            runs[-1][1] += 1
+        else:
+            runs.append([val, 1])
+    return runs
+
+
+# [value, count] run lists, edited in place. Equal neighbours are merged, so
+# a list stays one run per stretch of equal values.
+
+def _copyRuns(runs):
+    return [[val, count] for val, count in runs]
+
+
+def _locate(runs, index):
+    # (run index, offset into the run) of a value index.
+    for r, (val, count) in enumerate(runs):
+        if index < count:
+            return r, index
+        index -= count
+    raise IndexError("run index out of range")
+
+
+def _merge(runs, lo, hi):
+    # Merge equal neighbours among runs[lo:hi].
+    i = max(lo, 1)
+    while i < min(hi, len(runs)):
+        if runs[i][0] == runs[i - 1][0]:
+            runs[i - 1][1] += runs[i][1]
+            del runs[i]
+            hi -= 1
+        else:
+            i += 1
+
+
+def _extendRuns(runs, added):
+    start = len(runs)
+    runs.extend([val, count] for val, count in added if count > 0)
+    _merge(runs, start, len(runs))
+
+
+def _insertAt(runs, index, value):
+    if index >= sum(count for val, count in runs):
+        runs.append([value, 1])
+        _merge(runs, len(runs) - 1, len(runs))
+        return
+    r, offset = _locate(runs, index)
+    val, count = runs[r]
+    runs[r:r + 1] = ([[val, offset]] if offset else []) + [[value, 1], [val, count - offset]]
+    _merge(runs, r, r + 3)
+
+
+def _removeAt(runs, index):
+    r, offset = _locate(runs, index)
+    runs[r][1] -= 1
+    if not runs[r][1]:
+        del runs[r]
+        _merge(runs, r, r + 1)
+
+
+def _setAt(runs, index, value):
+    r, offset = _locate(runs, index)
+    val, count = runs[r]
+    if val == value:
+        return
+    split = ([[val, offset]] if offset else []) + [[value, 1]]
+    if count - offset - 1:
+        split.append([val, count - offset - 1])
+    runs[r:r + 1] = split
+    _merge(runs, r, r + len(split) + 1)
+
+
+def _fsyncWrite(path, data):
+    # Atomic replace: write a temp file, fsync it, then rename over the target.
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SessionJournal:
+
+    def __init__(self, path = "session.journal"):
+        self.path = path
+        self.checkpointPath = path + ".checkpoint"
+        self.oldPath = path + ".old"            # Journal being compacted
+        self._lock = threading.RLock()
+        self.fields = []            # [field dict, count] runs, dicts as in PLAN_KEYS
+        self.progress = []          # [last event, count] runs, one event per field
+        self.length = 0             # Fields in the runs
+        self.cursor = 0
+        self._seq = 0               # Sequence number of the last record
+        self._records = 0           # Records in the journal since it was started
+        self._unsynced = 0
+        self._lastSync = time.time()
+        self._compacting = False
+        self._compactError = None   # Why the last compaction failed, if it did
+        self._idle = threading.Event()      # Set while no compaction is in progress
+        self._idle.set()
+        self._load()
+        self._file = open(self.path, 'a')
+        self._pending = queue.Queue()
+        self._compactor = threading.Thread(target = self._compactLoop, name = "Journal-Compactor")
+        self._compactor.daemon = True
+        self._compactor.start()
+        if os.path.exists(self.oldPath):
+            self.checkpoint()       # Finish the compaction a crash interrupted
+
+    # --- Recovery ---
+
+    def _load(self):
+        covered = 0                 # Last record in the checkpoint
+        if os.path.exists(self.checkpointPath):
+            with open(self.checkpointPath) as f:
+                state = json.load(f)
+            self.fields = _copyRuns(state['runs']) if 'runs' in state else _valueRuns(state['fields'])
+            self.progress = _copyRuns(state['progressRuns']) if 'progressRuns' in state else _valueRuns(state['progress'])
+            self.length = sum(count for fld, count in self.fields)
+            self.cursor = state['cursor']
+            covered = self._seq = state.get('seq', 0)
+        for path in (self.oldPath, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break           # Torn final write from a crash - ignore the rest
+                    if path == self.path:
+                        self._records += 1
+                    seq = rec.get('s')
+                    if seq is not None:
+                        if seq <= covered:
+                            continue    # Already in the checkpoint
+                        self._seq = max(self._seq, seq)
+                    self._apply(rec)
+
+    def _apply(self, rec):
+        op = rec['op']
+        if op == "extend":
+            runs = rec['runs'] if 'runs' in rec else _valueRuns(rec['fields'])
+            added = sum(count for fld, count in runs)
+            _extendRuns(self.fields, runs)
+            _extendRuns(self.progress, [("queued", added)])
+            self.length += added
+        elif op == "insert":
+            _insertAt(self.fields, rec['index'], rec['field'])
+            _insertAt(self.progress, rec['index'], "queued")
+            self.length += 1
+        elif op == "remove":
+            if rec['index'] < self.length:
+                _removeAt(self.fields, rec['index'])
+                _removeAt(self.progress, rec['index'])
+                self.length -= 1
+        elif op == "clear":
+            self.fields, self.progress, self.cursor, self.length = [], [], 0, 0
+        elif op == "cursor":
+            self.cursor = rec['index']
+        elif op == "event":
+            if rec['index'] < self.length:
+                _setAt(self.progress, rec['index'], rec['event'])
+
+    def pending(self):
+        # True if the journal holds a session with undelivered fields.
+        with self._lock:
+            return self.cursor < self.length
+
+    def state(self):
+        # (field runs, progress runs, cursor) copies for restoring the FieldQueue.
+        with self._lock:
+            return _copyRuns(self.fields), _copyRuns(self.progress), self.cursor
+
+    # --- Recording ---
+
+    def _append(self, rec, durable = False):
+        with self._lock:
+            self._seq += 1
+            rec['s'] = self._seq
+            self._apply(rec)
+            self._file.write(json.dumps(rec, separators = (',', ':')) + "\n")
+            self._records += 1
+            self._unsynced += 1
+            if durable or self._unsynced >= SYNC_EVERY or time.time() - self._lastSync >= SYNC_INTERVAL:
+                self.sync()
+            if not self._compacting and (self._records >= CHECKPOINT_EVERY or (rec['op'] == "clear" and self._records > 1)):
+                try:
+                    self._pending.put(self._rotate())
+                except Exception as e:
+                    # Keep journalling into the current file and retry after another CHECKPOINT_EVERY records
+                    logging.info("ERROR: Unable to rotate the session journal - %s" % e)
+                    self._records = 0
+                    self._compacting = False
+                    self._idle.set()
+                    if self._file.closed:
+                        self._file = open(self.path, 'a')
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+            self._lastSync = time.time()
+
+    # --- Compaction ---
+
+    def _rotate(self):
+        # Close the journal, rename it aside and start a new one. Returns the
+        # state it leaves behind, for the checkpoint. One fsync, no serialising.
+        with self._lock:
+            self._compacting = True
+            self._idle.clear()
+            self.sync()
+            self._file.close()      # An open file cannot be renamed on Windows
+            os.replace(self.path, self.oldPath)
+            self._file = open(self.path, 'a')
+            self._records = 0
+            return _copyRuns(self.fields), _copyRuns(self.progress), self.cursor, self._seq
+
+    def _writeCheckpoint(self, snapshot):
+        fields, progress, cursor, seq = snapshot
+        _fsyncWrite(self.checkpointPath, json.dumps({'runs': fields,
+                                                     'progressRuns': progress,
+                                                     'cursor': cursor, 'seq': seq}))
+
+    def _compact(self, snapshot):
+        self._writeCheckpoint(snapshot)
+        os.remove(self.oldPath)
+        with self._lock:
+            self._compacting = False
+            self._idle.set()
+
+    def _compactLoop(self):
+        while True:
+            snapshot = self._pending.get()
+            if snapshot is None:
+                return
+            try:
+                self._compact(snapshot)
+            except Exception as e:
+                # The old journal stays, and no further compaction overwrites it
+                logging.info("ERROR: Unable to compact the session journal - %s" % e)
+                self._compactError = e
+                self._idle.set()
+
+    def checkpoint(self):
+        # Compact now, on the calling thread.
+        while True:
+            self._idle.wait()
+            with self._lock:
+                if self._compactError is not None:
+                    raise self._compactError
+                if self._compacting:
+                    continue            # Another compaction started meanwhile
+                if os.path.exists(self.oldPath):
+                    # Left by a crash. Its records are loaded, so the current state covers them.
+                    self._compacting = True
+                    self._idle.clear()
+                    snapshot = _copyRuns(self.fields), _copyRuns(self.progress), self.cursor, self._seq
+                else:
+                    snapshot = self._rotate()
+            self._compact(snapshot)
+            return
+
+    def queueChanged(self, op, args):
+        # FieldQueue observer - called under the queue lock, so records are in queue order.
+        if op == "extend":
+            self._append({'op': op, 'runs': [(planToDict(f), n) for f, n in fieldRuns(args[0])]})
+        elif op == "insert":
+            self._append({'op': op, 'index': args[0], 'field': planToDict(args[1])})
+        elif op == "remove":
+            self._append({'op': op, 'index': args[0]})
+        elif op == "clear":
+            self._append({'op': op})
+        elif op == "cursor":
+            self._append({'op': op, 'index': args[0]})
+
+    def fieldEvent(self, index, event):
+        self._append({'op': "event", 'index': index, 'event': event, 't': round(time.time(), 3)},
+                     durable = event in DURABLE_EVENTS)
+
+    def close(self):
+        self._pending.put(None)
+        self._compactor.join()
+        with self._lock:
+            self.sync()
+            self._file.close()
+
+
+def crashTest():
+    # Journals a session, stops at each step of a compaction as a crash would,
+    # and checks a new SessionJournal restores exactly the state it had.
+    import shutil
+    import tempfile
+    import collections
+    Plan = collections.namedtuple("Plan", PLAN_KEYS)
+    fields = [Plan("Field %s" % i, "f%s.efs" % i, 1, 100, 600, None, None, None, False) for i in range(3)]
+    steps = collections.OrderedDict([
+        ("journal renamed",             lambda j: j._rotate()),
+        ("checkpoint written",          lambda j: j._writeCheckpoint(j._rotate())),
+        ("checkpoint, journal kept",    lambda j: j._writeCheckpoint((_copyRuns(j.fields), _copyRuns(j.progress), j.cursor, j._seq))),
+        ("compacted",                   lambda j: j.checkpoint()),
+    ])
+    errors = []
+    for name, step in steps.items():
+        workDir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(workDir, "session.journal")
+            j = SessionJournal(path)
+            j.queueChanged("extend", (fields,))
+            j.queueChanged("cursor", (1,))
+            j.fieldEvent(0, "terminated")
+            step(j)
+            j.queueChanged("extend", ([fields[0]],))    # After the crash point, in the new journal
+            j.fieldEvent(1, "sent")
+            j.sync()
+            expected = j.state()
+            # Crash: j is abandoned without close()
+            for attempt in ("restart", "second restart"):
+                restored = SessionJournal(path)
+                if restored.state() != expected:
+                    errors.append("%s, %s: restored %s fields at %s, expected %s at %s" % (
+                        name, attempt, restored.length, restored.cursor, j.length, expected[2]))
+                if os.path.exists(restored.oldPath):
+                    errors.append("%s, %s: old journal left after restart" % (name, attempt))
+                restored.close()
+        finally:
+            shutil.rmtree(workDir, ignore_errors = True)
+
+    # Background compaction while fields keep being journalled
+    workDir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workDir, "session.journal")
+        j = SessionJournal(path)
+        for i in range(CHECKPOINT_EVERY * 5 + 7):
+            j.queueChanged("extend", ([fields[i % 3]],))
+            j.fieldEvent(i, "terminated")
+        j.close()
+        if not os.path.exists(j.checkpointPath):
+            errors.append("No checkpoint written after %s records" % (CHECKPOINT_EVERY * 10))
+        restored = SessionJournal(path)
+        if restored.state() != j.state():
+            errors.append("Background compaction: restored %s fields, expected %s" % (restored.length, j.length))
+        restored.close()
+    finally:
+        shutil.rmtree(workDir, ignore_errors = True)
+
+    # Run edits against the same edits on plain lists
+    import random
+    rand = random.Random(1)
+    j = SessionJournal.__new__(SessionJournal)
+    j.fields, j.progress, j.cursor, j.length = [], [], 0, 0
+    flat, flatProgress = [], []
+    dicts = [planToDict(f) for f in fields]
+    for i in range(2000):
+        op = rand.choice(("extend", "insert", "remove", "event", "event"))
+        index = rand.randrange(len(flat) + 1)
+        if op == "extend":
+            fld, count = rand.choice(dicts), rand.randint(1, 5)
+            j._apply({'op': op, 'runs': [(fld, count)]})
+            flat += [fld] * count
+            flatProgress += ["queued"] * count
+        elif op == "insert":
+            fld = rand.choice(dicts)
+            j._apply({'op': op, 'index': index, 'field': fld})
+            flat.insert(index, fld)
+            flatProgress.insert(index, "queued")
+        elif index < len(flat):
+            if op == "remove":
+                j._apply({'op': op, 'index': index})
+                del flat[index], flatProgress[index]
+            else:
+                event = rand.choice(EVENTS)
+                j._apply({'op': op, 'index': index, 'event': event})
+                flatProgress[index] = event
+        if j.fields != _valueRuns(flat) or j.progress != _valueRuns(flatProgress) or j.length != len(flat):
+            errors.append("Run edits: %s at %s gave different runs from the same edit on a list" % (op, index))
+            break
+    return errors
+
+
+if __name__ == "__main__":
+    errors = crashTest()
+    print("Crash recovery test %s" % ("PASSED" if not errors else "FAILED"))
+    for e in errors:
+        print("  %s" % e)
@@ -0,0 +1,696 @@
+"""
+#
+#  iCOMBridge - iCOMClient.dll in-process, or out-of-process through a sidecar
+#
+#  iCOMClient.dll is 32-bit, so only a 32-bit Python can load it. DLLBackend
+#  wraps it with ctypes for that case. SidecarClient instead starts a 32-bit
+#  Python (python_3.4 by default) running this module as a small server that
+#  owns the DLL, and forwards calls to it over a loopback socket, so the app
+#  itself can run on any Python. Each calling thread gets its own connection,
+#  so the VX poll never holds up the FX thread.
+#
+#  The calls that take several DLL calls per field are batched into a single
+#  round trip: insertTags (every tag of a message), sendField (send, decode
+#  the error reply, delete it), pollState (wait, read the state, delete) and
+#  pollSample (pollState plus the values of a list of tags while the linac
+#  is in given states, for LogQA).
+#
+#  StubBackend stands in for the DLL and a linac, so the bridge can be run
+#  and benchmarked on any platform:
+#
+#      python iCOMBridge.py serve --dll iCOMClient.dll     (or --stub)
+#      python iCOMBridge.py bench [--fields 200] [--efs field.efs]
+#
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import ctypes
+import struct
+import socket
+import logging
+import binascii
+import threading
+import subprocess
+import socketserver
+
+ICOM_RESULT_OK                  = 1
+INVALID_CONNECTION_HANDLE       = -2
+INVALID_MESSAGE_HANDLE          = -3
+NOT_CONNECTED                   = -6
+CONNECTION_FAILED               = -12
+
+STUB_TAG_MU         = 0x50010001    # Field MU, and the MU delivered so far in VX messages
+STUB_TAG_DOSE_RATE  = 0x50010006
+STUB_TAG_GANTRY     = 0x50010007
+STUB_TAG_METERSET   = 0x70020004    # Cumulative meterset % of each control point
+
+TOKEN_ENV = "PYICOM_BRIDGE_TOKEN"   # Shared secret the sidecar expects as the first frame
+_FRAME = struct.Struct(">I")        # Length prefix of each JSON frame
+
+# Backend methods callable through the sidecar, with the value a SidecarClient
+# returns when the sidecar cannot be reached. The failure values look like a
+# dropped link to the FX/VX threads, so their usual reconnect logic recovers.
+REMOTE_METHODS = {
+    'fxConnect':        CONNECTION_FAILED,
+    'vxConnect':        CONNECTION_FAILED,
+    'connectionState':  NOT_CONNECTED,
+    'disconnect':       NOT_CONNECTED,
+    'beginMessage':     INVALID_CONNECTION_HANDLE,
+    'waitForMessage':   NOT_CONNECTED,
+    'deleteMessage':    INVALID_MESSAGE_HANDLE,
+    'sendMessage':      NOT_CONNECTED,
+    'errorCode':        0,
+    'errorTag':         (INVALID_MESSAGE_HANDLE, 0),
+    'messageState':     INVALID_MESSAGE_HANDLE,
+    'tagValue':         "",
+    'insertTag':        INVALID_MESSAGE_HANDLE,
+    'sendCancel':       NOT_CONNECTED,
+    'sendConfirm':      NOT_CONNECTED,
+    'insertTags':       None,
+    'sendField':        (NOT_CONNECTED, 0, None),
+    'pollState':        (NOT_CONNECTED, None),
+    'pollSample':       (NOT_CONNECTED, None, None),
+}
+
+
+class BridgeError(RuntimeError):
+    pass
+
+
+class Backend:
+    # Batched operations built from the single calls. In-process they are
+    # plain loops; through the sidecar each one is a single round trip.
+
+    def insertTags(self, msg, records):
+        # records are (tag, cp, value). Returns the (tag, cp, result) of any that failed.
+        failed = []
+        for tag, cp, val in records:
+            result = self.insertTag(msg, tag, val, cp)
+            if result != ICOM_RESULT_OK:
+                failed.append((tag, cp, result))
+        return failed
+
+    def sendField(self, msg):
+        # Returns (response, errorCode, errorTag). errorTag is None unless the
+        # linac replied with an error that names a tag.
+        response = self.sendMessage(msg)
+        errorCode, errorTag = 0, None
+        if response > 0:
+            errorCode = self.errorCode(response)
+            result, tag = self.errorTag(response)
+            if errorCode > 0 and result == ICOM_RESULT_OK:
+                errorTag = tag
+        self.deleteMessage(response)
+        return response, errorCode, errorTag
+
+    def pollState(self, handle, timeout):
+        # Returns (message handle, linac state). The state is None if no message arrived.
+        msg = self.waitForMessage(handle, timeout)
+        state = self.messageState(msg) if msg > 0 else None
+        self.deleteMessage(msg)
+        return msg, state
+
+    def pollSample(self, handle, timeout, tags, states = None):
+        # pollState that also reads tags from the message, but only in one of
+        # states (None for any). Returns (message handle, linac state, values);
+        # values is None if no message arrived or the state is not in states.
+        msg = self.waitForMessage(handle, timeout)
+        state, values = None, None
+        if msg > 0:
+            state = self.messageState(msg)
+            if states is None or state in states:
+                values = [self.tagValue(msg, tag) for tag in tags]
+        self.deleteMessage(msg)
+        return msg, state, values
+
+    def close(self):
+        pass
+
+
+class DLLBackend(Backend):
+    # iCOMClient.dll loaded with ctypes. Needs 32-bit Python on Windows.
+
+    def __init__(self, path):
+        dll = ctypes.WinDLL(path)
+        def bind(name, restype, argtypes):
+            func = getattr(dll, name)
+            func.restype = restype
+            func.argtypes = argtypes
+            return func
+        c_long, c_ulong = ctypes.c_long, ctypes.c_ulong
+        self._fxConnect = bind("iCOMFXConnect", c_long, [ctypes.c_char_p, c_ulong, ctypes.c_char_p])
+        self._vxConnect = bind("iCOMVXConnect", c_long, [ctypes.c_char_p, c_ulong])
+        self._connectionState = bind("iCOMGetConnectionState", c_long, [c_long])
+        self._disconnect = bind("iCOMDisconnect", c_long, [c_long])
+        self._beginMessage = bind("iCOMBeginMessage", c_long, [c_long])
+        self._waitForMessage = bind("iCOMWaitForMessage", c_long, [c_long, c_ulong])
+        self._deleteMessage = bind("iCOMDeleteMessage", c_long, [c_long])
+        self._sendMessage = bind("iCOMSendMessage", c_long, [c_long])
+        self._errorCode = bind("iCOMGetErrorCode", ctypes.c_short, [c_long])
+        self._errorTag = bind("iCOMGetErrorTag", c_long, [c_long, ctypes.POINTER(c_ulong)])
+        self._messageState = bind("iCOMGetState", ctypes.c_short, [c_long])
+        #ICOMResult	    __stdcall iCOMGetTagValue       (ICOMMsgHandle messageHandle, ICOM_TAG tag, const char part, char* value);
+        self._tagValue = bind("iCOMGetTagValue", c_long, [c_long, c_ulong, ctypes.c_char, ctypes.c_char_p])
+        self._insertTag = bind("iCOMInsertTagVal", c_long, [c_long, c_ulong, ctypes.c_char_p, ctypes.c_ushort])
+        self._sendCancel = bind("iCOMSendCancel", c_long, [c_long])
+        self._sendConfirm = bind("iCOMSendConfirmEx", c_long, [c_long, ctypes.c_int])
+
+    def fxConnect(self, ip, timeout, name):
+        return self._fxConnect(ip.encode('utf-8'), timeout, name.encode('utf-8'))
+
+    def vxConnect(self, ip, timeout):
+        return self._vxConnect(ip.encode('utf-8'), timeout)
+
+    def connectionState(self, handle):
+        return self._connectionState(handle)
+
+    def disconnect(self, handle):
+        return self._disconnect(handle)
+
+    def beginMessage(self, handle):
+        return self._beginMessage(handle)
+
+    def waitForMessage(self, handle, timeout):
+        return self._waitForMessage(handle, timeout)
+
+    def deleteMessage(self, msg):
+        return self._deleteMessage(msg)
+
+    def sendMessage(self, msg):
+        return self._sendMessage(msg)
+
+    def errorCode(self, msg):
+        return self._errorCode(msg)
+
+    def errorTag(self, msg):
+        tag = ctypes.c_ulong()
+        result = self._errorTag(msg, ctypes.byref(tag))
+        return result, tag.value
+
+    def messageState(self, msg):
+        return self._messageState(msg)
+
+    def tagValue(self, msg, tag):
+        val = ctypes.create_string_buffer(self._tagValue(msg, tag, "R".encode(), None))
+        self._tagValue(msg, tag, "R".encode(), val)
+        return val.value.decode("utf-8")
+
+    def insertTag(self, msg, tag, val, cp):
+        return self._insertTag(msg, tag, val.encode(), cp)
+
+    def sendCancel(self, handle):
+        return self._sendCancel(handle)
+
+    def sendConfirm(self, handle, flag):
+        return self._sendConfirm(handle, flag)
+
+
+class StubBackend(Backend):
+    # Stand-in for the DLL and a linac. A sent field goes to CONFIRM SETTINGS;
+    # once confirmed it steps through the delivery states, stepTime seconds
+    # apart, with the beam on for MU / dose rate * beamTimeScale. VX messages
+    # arrive every messageInterval seconds and report the current state and,
+    # while the beam is on, the MU delivered and the axis positions of the
+    # field's control points interpolated to it.
+
+    def __init__(self, stepTime = 0.0, beamTimeScale = 0.0, messageInterval = 0.01):
+        self.stepTime = stepTime
+        self.beamTimeScale = beamTimeScale
+        self.messageInterval = messageInterval
+        self._lock = threading.Lock()
+        self._nextHandle = 1
+        self._connections = set()
+        self._messages = {}             # handle -> list of (tag, cp, value), or a VX state
+        self._state = 1                 # PREPARATORY
+        self._timeline = []             # Future (time, state) changes
+        self._field = {}                # Tag -> value of the last field sent
+        self._controlPoints = ([], [])  # Meterset % and {tag: value} per control point of the last field
+        self._beam = None               # (start, duration) of the beam on the last confirmed field
+        self._delivered = {}            # VX message -> fraction of the field delivered when it was sent
+        self.fieldsSent = 0
+        self.vxMessages = 0             # VX messages handed out, for benchmarking
+
+    def _handle(self):
+        handle = self._nextHandle
+        self._nextHandle += 1
+        return handle
+
+    def _currentState(self):
+        now = time.time()
+        while self._timeline and self._timeline[0][0] <= now:
+            self._state = self._timeline.pop(0)[1]
+        return self._state
+
+    def dropLink(self):
+        # Simulate the network dropping: every connection handle goes stale.
+        with self._lock:
+            self._connections.clear()
+
+    def fxConnect(self, ip, timeout, name):
+        with self._lock:
+            handle = self._handle()
+            self._connections.add(handle)
+            return handle
+
+    def vxConnect(self, ip, timeout):
+        return self.fxConnect(ip, timeout, None)
+
+    def connectionState(self, handle):
+        with self._lock:
+            return ICOM_RESULT_OK if handle in self._connections else NOT_CONNECTED
+
+    def disconnect(self, handle):
+        with self._lock:
+            if handle not in self._connections:
+                return NOT_CONNECTED
+            self._connections.discard(handle)
+            return ICOM_RESULT_OK
+
+    def beginMessage(self, handle):
+        with self._lock:
+            if handle not in self._connections:
+                return INVALID_CONNECTION_HANDLE
+            msg = self._handle()
+            self._messages[msg] = []
+            return msg
+
+    def waitForMessage(self, handle, timeout):
+        time.sleep(min(timeout / 1000.0, self.messageInterval))
+        with self._lock:
+            if handle not in self._connections:
+                return NOT_CONNECTED
+            msg = self._handle()
+            self._messages[msg] = self._currentState()
+            if self._beam is not None:
+                start, duration = self._beam
+                elapsed = time.time() - start
+                if duration > 0:
+                    fraction = elapsed / duration
+                else:
+                    fraction = 1.0 if elapsed >= 0 else 0.0
+                self._delivered[msg] = min(max(fraction, 0.0), 1.0)
+            self.vxMessages += 1
+            return msg
+
+    def deleteMessage(self, msg):
+        with self._lock:
+            self._delivered.pop(msg, None)
+            return ICOM_RESULT_OK if self._messages.pop(msg, None) is not None else INVALID_MESSAGE_HANDLE
+
+    def sendMessage(self, msg):
+        with self._lock:
+            records = self._messages.get(msg)
+            if not isinstance(records, list):
+                return INVALID_MESSAGE_HANDLE
+            self._field = {}
+            for tag, cp, val in records:
+                self._field.setdefault(tag, val)
+            self._controlPoints = self._controlPointsOf(records)
+            self._beam = None
+            self.fieldsSent += 1
+            if self._currentState() == 1:
+                self._timeline = [(time.time() + self.stepTime, 2)]        # CONFIRM SETTINGS
+            return 0                                                        # No error reply
+
+    def errorCode(self, msg):
+        return 0
+
+    def errorTag(self, msg):
+        return INVALID_MESSAGE_HANDLE, 0
+
+    def messageState(self, msg):
+        with self._lock:
+            state = self._messages.get(msg)
+            return state if isinstance(state, int) else INVALID_MESSAGE_HANDLE
+
+    def _controlPointsOf(self, records):
+        # Tags left out of a control point are carried forward from the one before.
+        cps = {}
+        for tag, cp, val in records:
+            if cp > 0:
+                cps.setdefault(cp, {})[tag] = val
+        metersets, values = [], []
+        current = {}
+        for cp in sorted(cps):
+            current = dict(current)
+            current.update(cps[cp])
+            try:
+                metersets.append(float(current.get(STUB_TAG_METERSET)))
+            except (TypeError, ValueError):
+                continue
+            values.append(current)
+        return metersets, values
+
+    def _deliveredValue(self, fraction, tag):
+        # A tag of a VX message, with the field delivered up to fraction.
+        if tag == STUB_TAG_MU:
+            try:
+                return str(round(fraction * float(self._field.get(STUB_TAG_MU, 0)), 2))
+            except ValueError:
+                return ""
+        metersets, values = self._controlPoints
+        if not values:
+            return self._field.get(tag, "")
+        hi = min(bisect.bisect_left(metersets, fraction * 100.0), len(values) - 1)
+        lo = max(hi - 1, 0)
+        a, b = values[lo].get(tag), values[hi].get(tag)
+        if a is None or b is None or metersets[hi] <= metersets[lo]:
+            return b if b is not None else ""
+        try:
+            a, b = float(a), float(b)
+        except ValueError:
+            return b
+        if tag == STUB_TAG_GANTRY and abs(b - a) > 180:
+            b += 360 if b < a else -360        # The short way through 180
+        f = min(max((fraction * 100.0 - metersets[lo]) / (metersets[hi] - metersets[lo]), 0.0), 1.0)
+        return str(a + f * (b - a))
+
+    def tagValue(self, msg, tag):
+        with self._lock:
+            if msg in self._delivered:
+                return self._deliveredValue(self._delivered[msg], tag)
+            return self._field.get(tag, "")
+
+    def insertTag(self, msg, tag, val, cp):
+        with self._lock:
+            records = self._messages.get(msg)
+            if not isinstance(records, list):
+                return INVALID_MESSAGE_HANDLE
+            records.append((tag, cp, val))
+            return ICOM_RESULT_OK
+
+    def sendCancel(self, handle):
+        with self._lock:
+            state = self._currentState()
+            if 4 <= state <= 12:
+                # Interrupted - terminate the field
+                self._timeline = [(time.time() + self.stepTime, 13)]
+            else:
+                self._state, self._timeline = 1, []
+            return ICOM_RESULT_OK
+
+    def sendConfirm(self, handle, flag):
+        with self._lock:
+            if self._currentState() != 2:
+                return ICOM_RESULT_OK
+            try:
+                beamOn = float(self._field.get(STUB_TAG_MU, 0)) / float(self._field.get(STUB_TAG_DOSE_RATE, 400)) * 60.0
+            except (TypeError, ValueError, ZeroDivisionError):
+                beamOn = 0.0
+            t = time.time()
+            timeline = []
+            for state, dt in ((3, self.stepTime), (4, self.stepTime), (5, self.stepTime),
+                              (9, beamOn * self.beamTimeScale), (11, self.stepTime), (13, self.stepTime)):
+                t += dt
+                timeline.append((t, state))
+            self._timeline = timeline
+            self._beam = (timeline[2][0], beamOn * self.beamTimeScale)     # SEGMENT IRRADIATE until SEGMENT TERMINATE
+            return ICOM_RESULT_OK
+
+
+# --- Sidecar protocol: length-prefixed JSON frames over a loopback socket ---
+
+def _sendFrame(sock, obj):
+    data = json.dumps(obj, separators = (',', ':')).encode('utf-8')
+    sock.sendall(_FRAME.pack(len(data)) + data)
+
+
+def _recvFrame(rfile):
+    head = rfile.read(_FRAME.size)
+    if len(head) < _FRAME.size:
+        raise EOFError("bridge connection closed")
+    size = _FRAME.unpack(head)[0]
+    data = rfile.read(size)
+    if len(data) < size:
+        raise EOFError("bridge connection closed")
+    return json.loads(data.decode('utf-8'))
+
+
+class _BridgeHandler(socketserver.BaseRequestHandler):
+    # One per client connection, i.e. one per calling thread in the app.
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        rfile = sock.makefile('rb')
+        try:
+            if _recvFrame(rfile) != self.server.token:
+                return
+            while True:
+                name, args = _recvFrame(rfile)
+                if name not in REMOTE_METHODS:
+                    _sendFrame(sock, [False, "Unknown method %s" % name])
+                    continue
+                try:
+                    reply = [True, getattr(self.server.backend, name)(*args)]
+                except Exception as e:
+                    reply = [False, "%s: %s" % (type(e).__name__, e)]
+                _sendFrame(sock, reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            rfile.close()
+
+
+class BridgeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, backend, token, port = 0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", port), _BridgeHandler)
+        self.backend = backend
+        self.token = token
+
+
+def serve(backend, port = 0):
+    # Sidecar entry point. Prints the port for the parent, then serves until
+    # the parent closes our stdin (or exits), so a sidecar never outlives the app.
+    server = BridgeServer(backend, os.environ.get(TOKEN_ENV, ""), port)
+    t = threading.Thread(target = server.serve_forever)
+    t.daemon = True
+    t.start()
+    sys.stdout.write("%s\n" % server.server_address[1])
+    sys.stdout.flush()
+    sys.stdin.read()
+    server.shutdown()
+    backend.close()
+
+
+class _Channel:
+    # One thread's connection to the sidecar.
+
+    def __init__(self, port, token, generation):
+        self.generation = generation
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        _sendFrame(self.sock, token)
+
+    def call(self, name, args):
+        _sendFrame(self.sock, [name, args])
+        ok, result = _recvFrame(self.rfile)
+        if not ok:
+            raise BridgeError(result)
+        return result
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class SidecarClient(Backend):
+    # Forwards every backend call to a sidecar process. command is the argv
+    # that starts it, e.g. [python32, "iCOMBridge.py", "serve", "--dll", dll].
+    # If the sidecar dies, calls return failure values and the next call
+    # starts a fresh sidecar; old handles are then stale, so the FX/VX
+    # threads see a lost link and reconnect.
+
+    def __init__(self, command):
+        self.command = command
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._proc = None
+        self._port = None
+        self._token = None
+        self._generation = 0
+        self.calls = 0                  # Round trips made, for benchmarking
+
+    def start(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                return
+            token = binascii.hexlify(os.urandom(16)).decode('ascii')
+            env = dict(os.environ)
+            env[TOKEN_ENV] = token
+            self._proc = subprocess.Popen(self.command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, env = env)
+            line = self._proc.stdout.readline()
+            try:
+                self._port = int(line)
+            except ValueError:
+                self._proc.kill()
+                self._proc = None
+                raise BridgeError("iCOM sidecar failed to start: %s" % " ".join(self.command))
+            self._token = token
+            self._generation += 1
+            logging.info("iCOM sidecar started (pid %s, port %s)" % (self._proc.pid, self._port))
+
+    def _channel(self):
+        channel = getattr(self._local, 'channel', None)
+        if (channel is None or channel.generation != self._generation
+                or self._proc is None or self._proc.poll() is not None):
+            if channel is not None:
+                channel.close()
+            self.start()
+            channel = _Channel(self._port, self._token, self._generation)
+            self._local.channel = channel
+        return channel
+
+    def call(self, name, *args):
+        try:
+            self.calls += 1
+            return self._channel().call(name, args)
+        except (OSError, EOFError, ValueError, BridgeError) as e:
+            channel = getattr(self._local, 'channel', None)
+            if channel is not None:
+                channel.close()
+                self._local.channel = None
+            logging.info("ERROR: iCOM sidecar call %s failed - %s" % (name, e))
+            return REMOTE_METHODS[name]
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
+    # Single calls
+    def fxConnect(self, ip, timeout, name):     return self.call('fxConnect', ip, timeout, name)
+    def vxConnect(self, ip, timeout):           return self.call('vxConnect', ip, timeout)
+    def connectionState(self, handle):          return self.call('connectionState', handle)
+    def disconnect(self, handle):               return self.call('disconnect', handle)
+    def beginMessage(self, handle):             return self.call('beginMessage', handle)
+    def waitForMessage(self, handle, timeout):  return self.call('waitForMessage', handle, timeout)
+    def deleteMessage(self, msg):               return self.call('deleteMessage', msg)
+    def sendMessage(self, msg):                 return self.call('sendMessage', msg)
+    def errorCode(self, msg):                   return self.call('errorCode', msg)
+    def errorTag(self, msg):                    return tuple(self.call('errorTag', msg))
+    def messageState(self, msg):                return self.call('messageState', msg)
+    def tagValue(self, msg, tag):               return self.call('tagValue', msg, tag)
+    def insertTag(self, msg, tag, val, cp):     return self.call('insertTag', msg, tag, val, cp)
+    def sendCancel(self, handle):               return self.call('sendCancel', handle)
+    def sendConfirm(self, handle, flag):        return self.call('sendConfirm', handle, flag)
+
+    # Batched calls - one round trip each
+    def insertTags(self, msg, records):
+        failed = self.call('insertTags', msg, [list(r) for r in records])
+        if failed is None:
+            return [(tag, cp, INVALID_MESSAGE_HANDLE) for tag, cp, val in records]
+        return [tuple(f) for f in failed]
+
+    def sendField(self, msg):                   return tuple(self.call('sendField', msg))
+    def pollState(self, handle, timeout):       return tuple(self.call('pollState', handle, timeout))
+    def pollSample(self, handle, timeout, tags, states = None):
+        return tuple(self.call('pollSample', handle, timeout, list(tags), list(states) if states is not None else None))
+
+
+def canLoadDLL():
+    return os.name == "nt" and struct.calcsize("P") == 4
+
+
+def sidecarCommand(python, dll = None):
+    cmd = [python, os.path.abspath(__file__), "serve"]
+    return cmd + (["--dll", os.path.abspath(dll)] if dll else ["--stub"])
+
+
+def openBackend(settings = None, dirname = ""):
+    # Backend chosen by the [icom] section of config.txt:
+    #   mode   - "auto" (in-process on 32-bit Python, otherwise sidecar),
+    #            "inprocess", "sidecar" or "stub" (simulated linac, no DLL)
+    #   dll    - path to iCOMClient.dll
+    #   python - 32-bit Python that runs the sidecar
+    settings = settings or {}
+    mode = settings.get('mode', "auto")
+    dll = os.path.join(dirname, settings.get('dll', "iCOMClient.dll"))
+    if mode == "stub":
+        return StubBackend()
+    if mode == "auto":
+        mode = "inprocess" if canLoadDLL() else "sidecar"
+    if mode == "inprocess":
+        return DLLBackend(dll)
+    python = os.path.join(dirname, settings.get('python', os.path.join("python_3.4", "python.exe")))
+    return SidecarClient(sidecarCommand(python, dll))
+
+
+def benchmark(records, fields = 200, elided = None):
+    # Per-field cost of building and sending a message: in-process stub,
+    # sidecar with one round trip per tag, and sidecar with batched calls -
+    # plus, if elided records are given, batched with redundant tags left out.
+    # Returns (label, tags, message kB, ms per field, round trips per field) rows.
+    variants = [("in-process", True, records),
+                ("sidecar, per tag", False, records),
+                ("sidecar, batched", True, records)]
+    if elided is not None:
+        variants.append(("sidecar, elided", True, elided))
+    results = []
+    stub = StubBackend()
+    sidecar = SidecarClient(sidecarCommand(sys.executable))
+    try:
+        for label, batched, recs in variants:
+            backend = stub if label == "in-process" else sidecar
+            size = len(json.dumps(['insertTags', [0, [list(r) for r in recs]]], separators = (',', ':'))) / 1024.0
+            handle = backend.fxConnect("127.0.0.1", 1000, "BENCH")
+            backend.sendField(backend.beginMessage(handle))          # Warm up
+            calls = getattr(backend, 'calls', 0)
+            start = time.time()
+            for i in range(fields):
+                msg = backend.beginMessage(handle)
+                if batched:
+                    backend.insertTags(msg, recs)
+                    backend.sendField(msg)
+                else:
+                    for tag, cp, val in recs:
+                        backend.insertTag(msg, tag, val, cp)
+                    response = backend.sendMessage(msg)
+                    backend.deleteMessage(response)
+                backend.deleteMessage(msg)
+            elapsed = time.time() - start
+            trips = (getattr(backend, 'calls', 0) - calls) / float(fields)
+            results.append((label, len(recs), size, elapsed / fields * 1000.0, trips))
+            backend.disconnect(handle)
+    finally:
+        sidecar.close()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "iCOM sidecar and IPC benchmark.")
+    sub = parser.add_subparsers(dest = "command")
+    serveParser = sub.add_parser("serve", help = "Run as the sidecar that owns the DLL")
+    serveParser.add_argument("--dll", help = "Path to iCOMClient.dll")
+    serveParser.add_argument("--stub", action = "store_true", help = "Simulate a linac instead of loading the DLL")
+    serveParser.add_argument("--port", type = int, default = 0)
+    benchParser = sub.add_parser("bench", help = "Measure per-field IPC overhead against a stub sidecar")
+    benchParser.add_argument("--fields", type = int, default = 200)
+    benchParser.add_argument("--efs", default = os.path.join("sequences", "photonop", "6MV 10x10cm 100MU.efs"))
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if not args.stub and not args.dll:
+            # Never fall back to a simulated linac when the DLL was expected
+            serveParser.error("--dll is required unless --stub is given")
+        serve(StubBackend() if args.stub else DLLBackend(args.dll), args.port)
+    elif args.command == "bench":
+        from SequenceLibrary import parseEFS, elideRecords
+        records = parseEFS(args.efs)
+        print("%s, %s fields\n" % (os.path.basename(args.efs), args.fields))
+        for label, tags, kb, ms, trips in benchmark(records, args.fields, elideRecords(records)):
+            print("  %-18s %6s tags %8.1f kB %8.3f ms/field  %6.1f round trips/field" % (label, tags, kb, ms, trips))
+    else:
+        parser.print_help()
@@ -0,0 +1,209 @@
+"""
+#
+#  iCOMTags - Registry of the iCOM tags PyiCom reads, writes and decodes
+#
+#  Every tag is keyed by its integer value, as the DLL and parseEFS use it
+#  (e.g. 0x50010009 for X1), with its display name, the key DCM2EFS writes
+#  it under, value type, unit, valid range and scope: header tags are only
+#  sent at control point 0, control point tags at 1 and above. The EFS
+#  parser, the DCM2EFS writer, validateEFS and the tag error decoder in
+#  Beam.send all look tags up here, so a lookup is one int hash.
+#
+#  The MLC leaves are registered per bank: MLCX1 leaf n is 0x50010100 + n
+#  and MLCX2 leaf n is 0x50010200 + n, for n = 1..80.
+#
+#  Ranges are only given where the value is bounded by definition: MU,
+#  dose rate and leaf width above 0, gantry and collimator angles within
+#  -180..360 degrees and the meterset within 0..100 %. The jaws, MLC leaves
+#  and other numeric tags have no range here, since their limits depend on
+#  the linac; those are left for the linac to check.
+#
+#  Tags not in the registry are still parsed and sent as they are; they
+#  are just not named or checked.
+#
+"""
+
+import collections
+
+HEADER = "header"               # Control point 0 only
+CONTROL_POINT = "cp"            # Control point 1 and above
+
+LEAVES = 80                     # Per MLC bank
+
+# kind is 'int', 'float' or 'text'. minimum/maximum limit numbers,
+# inclusive, and positive requires them to be above 0; choices limits text
+# to the values the tag takes. None for no limit. carry is True for tags the
+# linac carries forward from the previous control point when they are left
+# out. address is the tag as written in EFS files, e.g. "5001,9".
+TagInfo = collections.namedtuple("TagInfo",
+    ["tag", "name", "key", "kind", "unit", "minimum", "maximum", "positive", "choices", "scope", "carry", "address"])
+
+DIRECTIONS = ("NONE", "CW", "CC")
+
+_DEFINITIONS = (
+    # tag,      name,                   DCM2EFS key,        kind,    unit,     min,  max,  positive, choices,        scope,         carry
+    (0x50010001, 'MUs',                 'MUs',              'float', "MU",     None, None, True,     None,           HEADER,        False),
+    (0x50010002, 'Radiation Type',      'RadType',          'text',  None,     None, None, False,    None,           CONTROL_POINT, True),
+    (0x50010003, 'Energy',              'Energy',           'text',  None,     None, None, False,    None,           CONTROL_POINT, True),
+    (0x50010004, 'Wedge',               'Wedge',            'text',  None,     None, None, False,    ("IN", "OUT"),  CONTROL_POINT, True),
+    (0x50010006, 'Dose Rate',           None,               'float', "MU/min", None, None, True,     None,           CONTROL_POINT, False),
+    (0x50010007, 'Gantry Angle',        'Gantry',           'float', "deg",    -180, 360,  False,    None,           CONTROL_POINT, True),
+    (0x50010008, 'Collimator Angle',    'Collimator',       'float', "deg",    -180, 360,  False,    None,           CONTROL_POINT, True),
+    (0x50010009, 'X1',                  'X1',               'float', "cm",     None, None, False,    None,           CONTROL_POINT, True),
+    (0x5001000a, 'X2',                  'X2',               'float', "cm",     None, None, False,    None,           CONTROL_POINT, True),
+    (0x5001000b, 'Y1',                  'Y1',               'float', "cm",     None, None, False,    None,           CONTROL_POINT, True),
+    (0x5001000c, 'Y2',                  'Y2',               'float', "cm",     None, None, False,    None,           CONTROL_POINT, True),
+    (0x5001000f, 'Accessory',           'Acc',              'int',   None,     None, None, False,    None,           CONTROL_POINT, True),
+    (0x50010019, 'Gantry Direction',    'GantryDirection',  'text',  None,     None, None, False,    DIRECTIONS,     CONTROL_POINT, True),
+    (0x500100bb, 'Collimator Direction', 'CollimatorDir',   'text',  None,     None, None, False,    DIRECTIONS,     CONTROL_POINT, True),
+    (0x70010001, 'LINAC',               'LINAC',            'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70010002, 'Patient ID',          'PID',              'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70010003, 'Patient Name',        'PName',            'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70010004, 'Plan Name',           'PlanName',         'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70010005, 'Tx Name',             'TxName',           'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70010006, 'Beam ID',             'BeamID',           'int',   None,     None, None, False,    None,           HEADER,        False),
+    (0x70010007, 'Beam Name',           'BeamName',         'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70020004, 'Beam Meterset',       'MeterSet',         'float', "%",      0,    100,  False,    None,           CONTROL_POINT, False),
+    (0x70020005, 'Field Complexity',    'FieldComplexity',  'text',  None,     None, None, False,    None,           HEADER,        False),
+    (0x70020006, 'Leaf Width',          'LeafWidth',        'float', "cm",     None, None, True,     None,           HEADER,        False),
+)
+
+# Tags other modules refer to by name
+TAG_MU           = 0x50010001
+TAG_RAD_TYPE     = 0x50010002
+TAG_ENERGY       = 0x50010003
+TAG_WEDGE        = 0x50010004
+TAG_DOSE_RATE    = 0x50010006
+TAG_GANTRY       = 0x50010007
+TAG_COLLIMATOR   = 0x50010008
+TAG_ACCESSORY    = 0x5001000f
+TAG_MACHINE      = 0x70010001
+TAG_PATIENT_ID   = 0x70010002
+TAG_PATIENT_NAME = 0x70010003
+TAG_METERSET     = 0x70020004
+
+# Error codes the linac returns for a tag
+TAG_ERRORS = {
+    0: 'OK',
+    1: 'Not Supported',
+    2: 'Under Specified',
+    3: 'Over Specified',
+    4: 'Outside Range',
+    5: 'Inconsistency',
+    6: 'Mismatch Text',
+    7: 'Protocol Error',
+    8: 'Not Ready',
+    9: 'Wrong Machine',
+    10: 'Checksum Error',
+    11: 'Version Error',
+    12: 'Not Licensed',
+    -3: 'Invalid Message',
+}
+
+
+def efsAddress(tag):
+    return "%x,%x" % (tag >> 16, tag & 0xffff)
+
+
+def leafTag(bank, leaf):
+    # Tag of MLCX1 (bank 1) or MLCX2 (bank 2) leaf 1..80.
+    if bank not in (1, 2) or not 1 <= leaf <= LEAVES:
+        raise ValueError("No MLCX%s leaf %s" % (bank, leaf))
+    return 0x50010000 + bank * 0x100 + leaf
+
+
+def _register():
+    tags = {}
+    for definition in _DEFINITIONS:
+        tags[definition[0]] = TagInfo(*(definition + (efsAddress(definition[0]),)))
+    for bank in (1, 2):
+        for leaf in range(1, LEAVES + 1):
+            tag = leafTag(bank, leaf)
+            tags[tag] = TagInfo(tag, "MLCX%s Leaf %s" % (bank, leaf), None, 'float', "cm", None, None, False,
+                                None, CONTROL_POINT, True, efsAddress(tag))
+    return tags
+
+TAGS = _register()                                                  # tag -> TagInfo
+TAGS_BY_KEY = dict((info.key, info) for info in TAGS.values() if info.key)
+CARRY_FORWARD_TAGS = frozenset(tag for tag, info in TAGS.items() if info.carry)
+
+_byAddress = dict((info.address, tag) for tag, info in TAGS.items())    # EFS address -> tag, grows as files are read
+
+
+def info(tag):
+    return TAGS.get(tag)
+
+
+def tagName(tag):
+    entry = TAGS.get(tag)
+    return entry.name if entry is not None else None
+
+
+def tagOf(address):
+    # Tag of an EFS address such as "5001,9".
+    tag = _byAddress.get(address)
+    if tag is None:
+        group, element = address.split(",")
+        tag = int(group + element.zfill(4), 16)
+        _byAddress[address] = tag
+    return tag
+
+
+def efsLine(tag, cp, value):
+    # One EFS record. Header tags are always written at control point 0.
+    entry = TAGS.get(tag)
+    if entry is None:
+        return "{0}-{1} {2}\n".format(efsAddress(tag), cp, value)
+    return "{0}-{1} {2}\n".format(entry.address, 0 if entry.scope == HEADER else cp, value)
+
+
+def decodeError(tag, code):
+    # (tag name, error text) for an error reply, None for either if unknown.
+    return tagName(tag), TAG_ERRORS.get(code)
+
+
+def convert(entry, text):
+    # Value of a record as entry's type. Raises ValueError if it is not one.
+    if entry.kind == 'int':
+        return int(text)
+    if entry.kind == 'float':
+        return float(text)
+    return text.strip()
+
+
+def checkRecord(tag, cp, text):
+    # Returns an error string, or None if the record is valid or the tag unknown.
+    entry = TAGS.get(tag)
+    if entry is None:
+        return None
+    if (entry.scope == HEADER) != (cp == 0):
+        return "%s (%s) is a %s tag but is at control point %s" % (
+            entry.name, entry.address, "header" if entry.scope == HEADER else "control point", cp)
+    try:
+        value = convert(entry, text)
+    except ValueError:
+        return "%s (%s) at control point %s is not a%s %s: %r" % (
+            entry.name, entry.address, cp, "n" if entry.kind == 'int' else "", entry.kind, text)
+    if entry.choices is not None and value not in entry.choices:
+        return "%s (%s) at control point %s is %s, expected one of %s" % (
+            entry.name, entry.address, cp, value, ", ".join(entry.choices))
+    unit = " " + entry.unit if entry.unit else ""
+    if entry.positive and value <= 0:
+        return "%s (%s) at control point %s is %s%s, must be above 0" % (
+            entry.name, entry.address, cp, value, unit)
+    if ((entry.minimum is not None and value < entry.minimum) or
+            (entry.maximum is not None and value > entry.maximum)):
+        return "%s (%s) at control point %s is %s%s, outside %s..%s%s" % (
+            entry.name, entry.address, cp, value, unit,
+            "" if entry.minimum is None else entry.minimum,
+            "" if entry.maximum is None else entry.maximum, unit)
+    return None
+
+
+def checkRecords(records):
+    # First error in (tag, cp, value) records, or None. Each value is converted once.
+    for tag, cp, text in records:
+        error = checkRecord(tag, cp, text)
+        if error is not None:
+            return error
+    return None